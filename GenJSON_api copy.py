@@ -18,6 +18,7 @@ from datetime import datetime
 from pathlib import Path
 # from utils.generate_json_utils import call_ollama,FLAT_CATEGORY_PROMPT_TEMPLATE,save_json
 from doc_utils import load_and_split_document
+from task_registry import TaskRegistry, default_spill_dir
 from section_base_generater import *
 
 
@@ -27,7 +28,8 @@ logging.basicConfig(level=logging.INFO,
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
-api_tasks = {}
+# 任务登记表：已完成 / 失败的任务按 LRU / TTL 淘汰，超限时结果落盘，再次查询时自动读回
+api_tasks = TaskRegistry(spill_dir=default_spill_dir("GenJSON_api"), name="GenJSON_api")
 # 这是前端要给到的参数
 class ReportRequest(BaseModel):
     task_id: str
@@ -384,7 +386,8 @@ async def health_check():
     返回:
     dict: 包含系统健康状态的信息
     """
-    active_tasks = len([task for task_id, task in api_tasks.items() if task["status"] == "processing"])
+    # 落盘的都是已结束任务，统计执行中任务时不需要读回
+    active_tasks = api_tasks.active_count()
     return {
         "status": "healthy",
         "active_tasks": active_tasks,
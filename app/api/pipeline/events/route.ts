@@ -0,0 +1,46 @@
+// app/api/pipeline/events/route.ts
+// 透传 Python 服务的 SSE 进度流：只推送进度增量，任务结束时推送一次完整结果
+import { NextRequest, NextResponse } from 'next/server'
+
+export const runtime = 'nodejs'
+export const dynamic = 'force-dynamic'
+
+export async function GET(req: NextRequest) {
+  try {
+    const { searchParams } = new URL(req.url)
+    const queryId = searchParams.get('query_id') // Python 返回的 unique_key
+
+    if (!queryId) {
+      return NextResponse.json({ ok: false, message: '缺少 query_id' }, { status: 400 })
+    }
+
+    // 在 Docker 容器中，使用宿主机的实际 IP 地址来访问主机上的服务
+    const pythonServiceUrl = process.env.PYTHON_PIPELINE_SERVICE_URL || 'http://192.168.3.10:8005' // 使用宿主机 IP 地址
+
+    const headers: Record<string, string> = { Accept: 'text/event-stream' }
+    const lastEventId = req.headers.get('last-event-id')
+    if (lastEventId) headers['Last-Event-ID'] = lastEventId
+
+    const res = await fetch(`${pythonServiceUrl}/pipeline/events?query_id=${encodeURIComponent(queryId)}`, {
+      method: 'GET',
+      headers,
+      signal: req.signal, // 浏览器断开时同时断开上游连接
+    })
+
+    if (!res.ok || !res.body) {
+      return NextResponse.json({ ok: false, message: `进度流连接失败: ${res.status}` }, { status: 502 })
+    }
+
+    return new Response(res.body, {
+      headers: {
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache, no-transform',
+        'Connection': 'keep-alive',
+        'X-Accel-Buffering': 'no',
+      },
+    })
+
+  } catch (error: any) {
+    return NextResponse.json({ ok: false, message: error.message }, { status: 500 })
+  }
+}
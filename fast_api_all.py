@@ -25,6 +25,7 @@ import layout_parsing_batch_img_API
 
 from pathlib import Path
 import json_feature_extraction_api
+from task_registry import TaskRegistry, default_spill_dir
 
 
 from docx import Document
@@ -43,7 +44,8 @@ app = FastAPI()
 
 # 存储任务状态的字典
 # 键为task_id，值为字典，包含状态、进度、结果等信息
-api_tasks = {}
+# 已完成 / 失败的任务按 LRU / TTL 淘汰，超限时结果落盘，再次查询时自动读回
+api_tasks = TaskRegistry(spill_dir=default_spill_dir("fast_api_all"), name="fast_api_all")
 
 
 # 这是前端要给到的参数？？？
@@ -489,7 +491,8 @@ async def health_check():
     返回:
     dict: 包含系统健康状态的信息
     """
-    active_tasks = len([task for task_id, task in api_tasks.items() if task["status"] == "processing"])
+    # 落盘的都是已结束任务，统计执行中任务时不需要读回
+    active_tasks = api_tasks.active_count()
     return {
         "status": "healthy",
         "active_tasks": active_tasks,
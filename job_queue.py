@@ -0,0 +1,375 @@
+# filename: job_queue.py
+# 基于 SQLite 的持久化任务队列 + 工作进程池（无需 Redis 等外部服务）
+# - 队列表只负责派发（排队 / 执行中 / 结束、心跳、重试次数），SQLite WAL 模式，多个 API 进程 / 工作进程共享
+# - 面向前端的进度与结果写入 task_status 状态存储（memory / sqlite 可选），队列状态变化同步写一份
+# - 工作进程从队列里领取任务执行，执行中定期写心跳；进程崩溃或服务重启后，
+#   心跳超时 / 所属进程已不存在的 running 任务会被重新放回队列，不会丢失
+
+import os
+import time
+import socket
+import sqlite3
+import importlib
+import threading
+import types
+import traceback
+import multiprocessing as mp
+from typing import Any, Callable, Dict, List, Optional
+
+import json_io
+import task_status
+
+# 任务状态
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_SUCCESS = "success"
+STATUS_FAILED = "failed"
+ACTIVE_STATUSES = (STATUS_QUEUED, STATUS_RUNNING)
+
+DEFAULT_POLL_INTERVAL_S: float = 1.0     # 队列为空时工作进程的轮询间隔
+DEFAULT_HEARTBEAT_S: float = 15.0        # 执行中任务的心跳间隔
+DEFAULT_STALE_AFTER_S: float = 300.0     # 心跳超过该时长未更新的 running 任务视为失联，重新入队
+DEFAULT_MAX_ATTEMPTS: int = 3            # 同一任务最多执行次数（含因失联重新入队的次数）
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id       TEXT PRIMARY KEY,
+    payload      TEXT,
+    status       TEXT NOT NULL,
+    worker       TEXT,
+    attempts     INTEGER NOT NULL DEFAULT 0,
+    created_at   REAL NOT NULL,
+    updated_at   REAL NOT NULL,
+    heartbeat_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_at);
+"""
+
+
+def worker_identity() -> str:
+    """工作者标识："主机名:进程号"，用于判断 running 任务的执行进程是否还活着"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobQueue:
+    """
+    SQLite 任务队列；每个线程使用各自的连接，可在多进程间共享同一个数据库文件
+
+    Args:
+        db_path: 队列数据库文件
+        status_url: 状态存储地址（见 task_status.open_status_store），默认与队列同一个 SQLite 文件
+    """
+
+    def __init__(self, db_path: str, status_url: Optional[str] = None,
+                 stale_after_s: float = DEFAULT_STALE_AFTER_S,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        self.db_path = os.path.abspath(db_path)
+        self.status_url = status_url or f"sqlite:{self.db_path}"
+        self.status = task_status.open_status_store(self.status_url)
+        self.stale_after_s = stale_after_s
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None：自己控制事务（领取任务时用 BEGIN IMMEDIATE 抢写锁）
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+        self.status.close()
+
+    # ---------- 入队 / 查询 ----------
+    def enqueue(self, job_id: str, payload: Dict[str, Any]) -> bool:
+        """
+        提交任务；同一 job_id 已在排队或执行中时不重复提交
+
+        Returns:
+            True 表示新入队，False 表示已有同名任务在排队 / 执行
+        """
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT status FROM jobs WHERE job_id=?", (job_id,)).fetchone()
+            if row is not None and row["status"] in ACTIVE_STATUSES:
+                conn.execute("COMMIT")
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, payload, status, worker, attempts,"
+                " created_at, updated_at, heartbeat_at) VALUES (?, ?, ?, NULL, 0, ?, ?, NULL)",
+                (job_id, json_io.dumps(payload, pretty=False), STATUS_QUEUED, now, now))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self.status.put(job_id, {"status": STATUS_QUEUED, "percent": 0, "current_step": "init",
+                                 "message": "任务已进入队列"})
+        return True
+
+    def is_active(self, job_id: str) -> bool:
+        row = self._conn().execute("SELECT status FROM jobs WHERE job_id=?", (job_id,)).fetchone()
+        return row is not None and row["status"] in ACTIVE_STATUSES
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """任务状态记录：{"status", "percent", "current_step", "message", "result", "branches"}"""
+        return self.status.get(job_id)
+
+    def counts(self) -> Dict[str, int]:
+        rows = self._conn().execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {r["status"]: r["n"] for r in rows}
+
+    # ---------- 工作进程侧 ----------
+    def claim(self, worker: str) -> Optional[Dict[str, Any]]:
+        """领取最早入队的任务并标记为 running；队列为空时返回 None"""
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT job_id, payload, attempts FROM jobs WHERE status=? ORDER BY created_at LIMIT 1",
+                (STATUS_QUEUED,)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE jobs SET status=?, worker=?, attempts=attempts+1,"
+                " updated_at=?, heartbeat_at=? WHERE job_id=?",
+                (STATUS_RUNNING, worker, now, now, row["job_id"]))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self.status.update(row["job_id"], status=STATUS_RUNNING, message="任务已启动")
+        return {"job_id": row["job_id"], "payload": json_io.loads(row["payload"]),
+                "attempts": row["attempts"] + 1}
+
+    def update_progress(self, job_id: str, step_key: str, percent: int, desc: str,
+                        branches: Optional[Dict[str, int]] = None) -> None:
+        """写进度（只写状态存储；队列表的心跳由心跳线程负责）"""
+        self.status.update(job_id, percent=percent, current_step=step_key, message=desc, branches=branches)
+
+    def finish(self, job_id: str, status: str, message: str, result: Optional[Dict[str, Any]] = None) -> None:
+        """任务结束：队列表记终态，状态存储写入最终结果"""
+        self._conn().execute("UPDATE jobs SET status=?, updated_at=? WHERE job_id=?",
+                             (status, time.time(), job_id))
+        rec = self.status.get(job_id) or {}
+        rec.update({"status": status, "percent": 100, "current_step": "finished",
+                    "message": message, "result": result})
+        self.status.put(job_id, rec)
+
+    def heartbeat(self, job_id: str) -> None:
+        self._conn().execute("UPDATE jobs SET heartbeat_at=? WHERE job_id=? AND status=?",
+                             (time.time(), job_id, STATUS_RUNNING))
+
+    def recover(self, only_worker_prefix: Optional[str] = None) -> int:
+        """
+        把失联的 running 任务放回队列：心跳超时的，或本机上执行进程已不存在的
+        超过 max_attempts 的任务直接标记为失败，避免反复把进程带崩的任务无限重试
+
+        Args:
+            only_worker_prefix: 只处理 worker 以此开头的任务（如 "主机名:"），None 表示全部
+
+        Returns:
+            处理的任务数
+        """
+        now = time.time()
+        host = socket.gethostname()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute("SELECT job_id, worker, attempts, heartbeat_at FROM jobs WHERE status=?",
+                                (STATUS_RUNNING,)).fetchall()
+            changed = []
+            for r in rows:
+                worker = r["worker"] or ""
+                if only_worker_prefix and not worker.startswith(only_worker_prefix):
+                    continue
+                stale = (r["heartbeat_at"] or 0) < now - self.stale_after_s
+                w_host, _, w_pid = worker.rpartition(":")
+                dead = w_host == host and w_pid.isdigit() and not _pid_alive(int(w_pid))
+                if not (stale or dead):
+                    continue
+                if r["attempts"] >= self.max_attempts:
+                    status, message = STATUS_FAILED, f"任务执行 {r['attempts']} 次均未完成，已放弃"
+                else:
+                    status, message = STATUS_QUEUED, "执行进程已退出，任务重新排队"
+                conn.execute("UPDATE jobs SET status=?, worker=NULL, updated_at=? WHERE job_id=?",
+                             (status, now, r["job_id"]))
+                changed.append((r["job_id"], status, message))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        for job_id, status, message in changed:
+            self.status.update(job_id, status=status, message=message,
+                               percent=100 if status == STATUS_FAILED else None)
+        if changed:
+            print(f"[JobQueue] 回收失联任务 {len(changed)} 个")
+        return len(changed)
+
+
+def _resolve_handler(ref: str) -> Callable:
+    """'模块名:函数名' -> 函数"""
+    module_name, _, func_name = ref.partition(":")
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+def worker_main(db_path: str, handler_ref: str, status_url: Optional[str] = None, stop_flag=None,
+                poll_interval_s: float = DEFAULT_POLL_INTERVAL_S,
+                heartbeat_s: float = DEFAULT_HEARTBEAT_S) -> None:
+    """
+    工作进程主循环：领取任务 -> 调用 handler(job_id, payload, progress) -> 写回终态
+
+    handler 返回 (status, message, result)；progress(step_key, percent, desc, branches=None) 写进度
+    stop_flag 为共享的无锁标志（RawValue），置 1 后处理完当前任务即退出
+    """
+    handler = _resolve_handler(handler_ref)
+    queue = JobQueue(db_path, status_url)
+    me = worker_identity()
+    print(f"[JobQueue] 工作进程启动: {me}")
+
+    while stop_flag is None or not stop_flag.value:
+        try:
+            job = queue.claim(me)
+        except sqlite3.OperationalError as e:
+            print(f"[JobQueue] 领取任务失败: {e}")
+            job = None
+        if job is None:
+            time.sleep(poll_interval_s)
+            continue
+
+        job_id = job["job_id"]
+        print(f"[JobQueue] {me} 开始执行 {job_id}（第 {job['attempts']} 次）")
+        done = threading.Event()
+
+        def beat():
+            # 单个步骤可能长时间没有进度更新（如 LLM 调用），单独的心跳线程证明进程还活着
+            hb_queue = JobQueue(db_path, status_url)
+            while not done.wait(heartbeat_s):
+                try:
+                    hb_queue.heartbeat(job_id)
+                except sqlite3.OperationalError:
+                    pass
+            hb_queue.close()
+
+        hb = threading.Thread(target=beat, name=f"heartbeat-{job_id}", daemon=True)
+        hb.start()
+
+        def progress(step_key, percent, desc, branches=None):
+            queue.update_progress(job_id, step_key, percent, desc, branches)
+
+        try:
+            status, message, result = handler(job_id, job["payload"], progress)
+        except Exception as e:
+            traceback.print_exc()
+            status, message, result = STATUS_FAILED, f"系统异常: {e}", None
+        finally:
+            done.set()
+            hb.join()
+        queue.finish(job_id, status, message, result)
+        print(f"[JobQueue] {me} 完成 {job_id}: {status}")
+
+    queue.close()
+
+
+class WorkerPool:
+    """
+    工作进程池：启动 N 个独立进程从同一个队列领取任务
+    使用 spawn 启动方式，子进程不继承父进程（uvicorn / 线程池 / 连接池）的状态
+    状态后端为 memory 时进程间无法共享进度，改为在当前进程内起 N 个工作线程
+    """
+
+    def __init__(self, db_path: str, handler_ref: str, workers: int = 1,
+                 status_url: Optional[str] = None,
+                 poll_interval_s: float = DEFAULT_POLL_INTERVAL_S,
+                 heartbeat_s: float = DEFAULT_HEARTBEAT_S):
+        self.db_path = db_path
+        self.handler_ref = handler_ref
+        self.workers = max(1, int(workers))
+        self.status_url = status_url
+        self.poll_interval_s = poll_interval_s
+        self.heartbeat_s = heartbeat_s
+        self.use_threads = bool(status_url) and task_status.backend_name(status_url) == "memory"
+        if self.use_threads:
+            self._stop = types.SimpleNamespace(value=0)
+        else:
+            self._ctx = mp.get_context("spawn")
+            # 不用 mp.Event：工作进程被强杀时可能留下未释放的锁，导致 stop() 卡死
+            self._stop = self._ctx.RawValue("b", 0)
+        self._procs: List[Any] = []
+
+    def _recover(self) -> None:
+        # 本机上已不存在的执行进程遗留的 running 任务放回队列
+        JobQueue(self.db_path, self.status_url).recover(only_worker_prefix=f"{socket.gethostname()}:")
+
+    def start(self) -> "WorkerPool":
+        self._recover()
+        args = (self.db_path, self.handler_ref, self.status_url, self._stop, self.poll_interval_s, self.heartbeat_s)
+        for i in range(self.workers):
+            if self.use_threads:
+                p = threading.Thread(target=worker_main, args=args, name=f"pipeline-worker-{i}", daemon=True)
+            else:
+                p = self._ctx.Process(target=worker_main, args=args, name=f"pipeline-worker-{i}", daemon=True)
+            p.start()
+            self._procs.append(p)
+        kind = "工作线程" if self.use_threads else "工作进程"
+        print(f"[JobQueue] 已启动 {len(self._procs)} 个{kind}，队列: {self.db_path}")
+        return self
+
+    def alive(self) -> int:
+        return sum(1 for p in self._procs if p.is_alive())
+
+    def stop(self, timeout_s: float = 10.0) -> None:
+        """通知工作进程退出；超时仍在执行任务的进程直接终止，其任务重新入队（线程无法终止，随进程退出）"""
+        self._stop.value = 1
+        deadline = time.time() + timeout_s
+        for p in self._procs:
+            p.join(max(0.0, deadline - time.time()))
+        for p in self._procs:
+            if not self.use_threads and p.is_alive():
+                p.terminate()
+                p.join()
+        self._procs.clear()
+        self._recover()
+
+
+if __name__ == "__main__":
+    # 独立运行工作进程（与 API 进程分开扩容）：
+    #   python job_queue.py /data/cwd_cq/out/_jobs/pipeline_jobs.sqlite3 pipeline_api:execute_job 4 [状态存储地址]
+    # 状态存储需与 API 进程一致且可跨进程共享（sqlite），默认与队列同一个文件
+    import sys
+    if len(sys.argv) < 3:
+        print("用法: python job_queue.py <db_path> <模块:处理函数> [工作进程数] [状态存储地址]")
+        sys.exit(1)
+    pool = WorkerPool(sys.argv[1], sys.argv[2], workers=int(sys.argv[3]) if len(sys.argv) > 3 else 1,
+                      status_url=sys.argv[4] if len(sys.argv) > 4 else None).start()
+    try:
+        while pool.alive():
+            time.sleep(5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.stop()
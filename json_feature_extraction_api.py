@@ -15,6 +15,8 @@ from docx.oxml.ns import qn
 from docx.opc.constants import RELATIONSHIP_TYPE as RT
 from docx.shared import Pt, RGBColor
 
+import json_io
+
 # ====== 可调阈值 ======
 LARGE_TEXT_MIN_W = 500   # 把 text 纠正为 image 的最小宽
 LARGE_TEXT_MIN_H = 400   # 把 text 纠正为 image 的最小高
@@ -95,8 +97,7 @@ def add_hyperlink(paragraph, text: str, target_ref: str, font_name: str = "SimSu
 
 # ====== 基础工具 ======
 def load_json(json_path: Path):
-    with open(json_path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return json_io.load(str(json_path))
 
 
 def get_page_tag(data: dict):
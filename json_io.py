@@ -0,0 +1,70 @@
+# filename: json_io.py
+# 流水线各步骤产物（_tables.json / _blocks*.json 等）共用的 JSON 读写层
+# - 安装了 orjson 时用 orjson 编解码（比标准库快数倍），否则回退标准库 json
+# - 默认输出紧凑格式；设置环境变量 PIPELINE_JSON_PRETTY=1（调试时）才缩进 2 格，便于人工查看
+# - 需要 Decimal 精确数值的读取（如 table_save_in_database.import_json）走标准库的 parse_float/parse_int
+# optional: pip install orjson
+
+import os
+import json
+from decimal import Decimal
+from typing import Any, Optional
+
+try:
+    import orjson
+except ImportError:  # orjson 可选
+    orjson = None
+
+JSON_PRETTY: bool = os.getenv("PIPELINE_JSON_PRETTY", "").strip().lower() in ("1", "true", "yes", "on")
+
+if orjson is not None:
+    _ORJSON_OPTS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+def _pretty(pretty: Optional[bool]) -> bool:
+    return JSON_PRETTY if pretty is None else pretty
+
+
+def dumpb(obj: Any, pretty: Optional[bool] = None) -> bytes:
+    """序列化为 UTF-8 字节（中文不转义）"""
+    if orjson is not None:
+        opts = _ORJSON_OPTS | (orjson.OPT_INDENT_2 if _pretty(pretty) else 0)
+        return orjson.dumps(obj, option=opts)
+    return dumps(obj, pretty).encode("utf-8")
+
+
+def dumps(obj: Any, pretty: Optional[bool] = None) -> str:
+    """序列化为字符串（中文不转义）"""
+    if orjson is not None:
+        return dumpb(obj, pretty).decode("utf-8")
+    if _pretty(pretty):
+        return json.dumps(obj, ensure_ascii=False, indent=2)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def loads(data) -> Any:
+    """反序列化 str / bytes"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dump(obj: Any, path: str, pretty: Optional[bool] = None) -> None:
+    """写 JSON 文件（覆盖）"""
+    with open(path, "wb") as f:
+        f.write(dumpb(obj, pretty))
+
+
+def load(path: str, decimal: bool = False) -> Any:
+    """
+    读 JSON 文件
+
+    Args:
+        path: 文件路径
+        decimal: True 时数值解析为 Decimal（标准库实现，保证与原文数值完全一致）
+    """
+    if decimal:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f, parse_float=Decimal, parse_int=Decimal)
+    with open(path, "rb") as f:
+        return loads(f.read())
@@ -1,7 +1,9 @@
 
-import os, json, traceback, time
-from typing import Optional, Dict, Any, List, Callable
-from fastapi import FastAPI, BackgroundTasks, Query
+import os, json, traceback, time, inspect, asyncio
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Optional, Dict, Any, List, Callable, Tuple, NamedTuple
+from fastapi import FastAPI, Query, Request, Header
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 
 # ===== 显式常量定义 =====
@@ -9,12 +11,15 @@ DEFAULT_OUTPUT_FILE_PATH: str = "/data/cwd_cq/out"
 DEFAULT_INPUT_FILE_PATH: str = "/home/xzh/ocr_flie/pdf_output"
 DEFAULT_RUN_PICTURE: bool = True
 DEFAULT_USE_MERGED_FOR_MERGE: bool = True
+DEFAULT_PIPELINE_MAX_WORKERS: int = 3  # 步骤 DAG 的并行线程数（标题切块链 / 表格识别 / 图片识别）
 
 # ===== 导入你的源文件 =====
 import title_recognition as mod_title_rec
 import title_position_calculator as mod_pos
 import clear_empty_blocks_manager as mod_clear
 import table_recognition as mod_table
+import json_io
+import job_queue
 import table_title_completely_merge_with_content as mod_merge
 from picture_recognition import EnhancedImageProcessor
 
@@ -24,8 +29,31 @@ SERVER_HOST: str = "0.0.0.0"
 SERVER_PORT: int = 8005
 SERVER_WORKERS: int = 1
 
-# ===== 全局任务状态存储 =====
-GLOBAL_TASK_STORE: Dict[str, Dict[str, Any]] = {}
+# ===== 任务队列（SQLite 持久化，多进程共享） =====
+JOB_QUEUE_DB_PATH: str = os.path.join(DEFAULT_OUTPUT_FILE_PATH, "_jobs", "pipeline_jobs.sqlite3")
+JOB_WORKERS: int = 2  # 每个 API 进程启动的流水线工作进程数；0 表示不在本进程启动（单独运行 job_queue.py）
+JOB_HANDLER: str = "pipeline_api:execute_job"
+# 任务进度 / 结果的状态存储："sqlite"（多进程共享，默认与队列同一个文件）或 "memory"（仅单进程，任务在本进程线程中执行）
+TASK_STATUS_BACKEND: str = "sqlite"
+
+# 进度推送（/pipeline/events SSE 与 /pipeline/status/wait 长轮询）
+EVENTS_POLL_INTERVAL_S: float = 0.5   # 检查状态版本号的间隔（只读一个整数，很便宜）
+EVENTS_KEEPALIVE_S: float = 15.0      # SSE 无变化时的保活注释间隔，防止代理断开空闲连接
+LONG_POLL_MAX_WAIT_S: float = 30.0    # 长轮询单次最长等待
+
+def task_status_url() -> str:
+    if TASK_STATUS_BACKEND == "sqlite":
+        return f"sqlite:{JOB_QUEUE_DB_PATH}"
+    return TASK_STATUS_BACKEND
+
+_job_queue: Optional[job_queue.JobQueue] = None
+_worker_pool: Optional[job_queue.WorkerPool] = None
+
+def get_job_queue() -> job_queue.JobQueue:
+    global _job_queue
+    if _job_queue is None:
+        _job_queue = job_queue.JobQueue(JOB_QUEUE_DB_PATH, task_status_url())
+    return _job_queue
 
 # ============== 工具函数 ==============
 def _abspath(p: Optional[str]) -> Optional[str]:
@@ -40,20 +68,113 @@ def _build_output_dir(output_file_path: str, agent_user_id: int, task_id: str) -
     os.makedirs(output_dir, exist_ok=True)
     return output_dir
 
-def _wrap_blocks_if_needed(merged_path: str, json_file_name: str, output_dir: str) -> str:
-    with open(merged_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+def _accepts_kwarg(func: Callable, name: str) -> bool:
+    """下游步骤是否显式声明了某个关键字参数（只认具名参数，**kwargs 不算，避免数据被静默丢弃）"""
+    try:
+        params = inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return False
+    p = params.get(name)
+    return p is not None and p.kind in (inspect.Parameter.POSITIONAL_OR_KEYWORD, inspect.Parameter.KEYWORD_ONLY)
+
+def _load_blocks_doc(merged_path: str) -> Tuple[Optional[Dict[str, Any]], bool]:
+    """
+    读取空块合并结果并规范成 {"blocks": [...]} 结构（只在内存中包装，不落盘）
+
+    Returns:
+        (blocks_doc, needs_wrap)：needs_wrap 为 True 表示原文件是裸列表，
+        下游若要文件路径需另写包装版；结构无法识别时 blocks_doc 为 None
+    """
+    data = json_io.load(merged_path)
     if isinstance(data, dict) and "blocks" in data:
-        return merged_path
+        return data, False
     if isinstance(data, list):
-        wrapped = {"blocks": data}
-        os.makedirs(output_dir, exist_ok=True)
-        wrapped_path = os.path.join(output_dir, f"{json_file_name}_blocks_merge_wrapped.json")
-        with open(wrapped_path, "w", encoding="utf-8") as wf:
-            json.dump(wrapped, wf, ensure_ascii=False, indent=2)
-        return _abspath(wrapped_path)
+        return {"blocks": data}, True
+    return None, False
+
+def _write_wrapped_blocks(blocks_doc: Dict[str, Any], json_file_name: str, output_dir: str) -> str:
+    os.makedirs(output_dir, exist_ok=True)
+    wrapped_path = os.path.join(output_dir, f"{json_file_name}_blocks_merge_wrapped.json")
+    json_io.dump(blocks_doc, wrapped_path)
+    return _abspath(wrapped_path)
+
+def _wrap_blocks_if_needed(merged_path: str, json_file_name: str, output_dir: str) -> str:
+    blocks_doc, needs_wrap = _load_blocks_doc(merged_path)
+    if blocks_doc is not None and needs_wrap:
+        return _write_wrapped_blocks(blocks_doc, json_file_name, output_dir)
     return merged_path
 
+# ============== 步骤 DAG ==============
+class PipelineStep(NamedTuple):
+    key: str                    # 步骤标识，如 "step4"
+    branch: str                 # 所属分支（进度按分支汇报），如 "tables" / "picture"
+    deps: Tuple[str, ...]       # 依赖的步骤 key
+    fn: Callable[[], None]
+    desc: str                   # 开始时的进度描述
+
+def run_step_dag(steps: List[PipelineStep], report: Callable[..., None],
+                 max_workers: int = DEFAULT_PIPELINE_MAX_WORKERS,
+                 base_percent: int = 0, end_percent: int = 100) -> None:
+    """
+    按依赖关系并行执行步骤：依赖都完成的步骤立即提交到线程池
+
+    Args:
+        steps: 步骤列表
+        report: 进度回调 report(step_key, percent, desc, branches=...)，branches 为各分支完成百分比
+        max_workers: 并行线程数
+        base_percent / end_percent: 整体进度在这两个值之间按完成步骤数线性推进
+
+    任一步骤失败后不再提交新步骤，等已在运行的步骤结束后抛出第一个异常
+    """
+    by_key = {st.key: st for st in steps}
+    for st in steps:
+        missing = [d for d in st.deps if d not in by_key]
+        if missing:
+            raise ValueError(f"步骤 {st.key} 依赖未知步骤: {missing}")
+
+    branch_total: Dict[str, int] = {}
+    for st in steps:
+        branch_total[st.branch] = branch_total.get(st.branch, 0) + 1
+    branch_done = {b: 0 for b in branch_total}
+    done: set = set()
+    started: set = set()
+    running: Dict[Future, PipelineStep] = {}
+    error: Optional[BaseException] = None
+
+    def branch_percents() -> Dict[str, int]:
+        return {b: int(100 * branch_done[b] / branch_total[b]) for b in branch_total}
+
+    def overall() -> int:
+        return base_percent + int((end_percent - base_percent) * len(done) / max(1, len(steps)))
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pipeline-step") as pool:
+        while True:
+            if error is None:
+                for st in steps:
+                    if st.key in started:
+                        continue
+                    if all(d in done for d in st.deps):
+                        started.add(st.key)
+                        report(st.key, overall(), st.desc, branches=branch_percents())
+                        running[pool.submit(st.fn)] = st
+            if not running:
+                break
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for fut in finished:
+                st = running.pop(fut)
+                exc = fut.exception()
+                if exc is not None:
+                    error = error or exc
+                    continue
+                done.add(st.key)
+                branch_done[st.branch] += 1
+                report(st.key, overall(), f"{st.desc.rstrip('.')} 完成", branches=branch_percents())
+
+    if error is not None:
+        raise error
+    if len(done) != len(steps):
+        raise RuntimeError(f"步骤依赖存在环: {sorted(set(by_key) - done)}")
+
 # ============== 缓存检查逻辑 ==============
 def check_cache_result(req_data: 'PipelineRequest') -> Optional[Dict[str, Any]]:
     """
@@ -151,9 +272,14 @@ def run_pipeline_sync(
         use_merged_blocks_for_merge: bool = DEFAULT_USE_MERGED_FOR_MERGE,
         progress_callback: Callable[[str, int, str], None] = None
 ) -> Dict[str, Any]:
-    def report_progress(step_key: str, percent: int, desc: str):
+    pass_branches = progress_callback is not None and _accepts_kwarg(progress_callback, "branches")
+
+    def report_progress(step_key: str, percent: int, desc: str, branches: Optional[Dict[str, int]] = None):
         if progress_callback:
-            progress_callback(step_key, percent, desc)
+            if pass_branches and branches is not None:
+                progress_callback(step_key, percent, desc, branches=branches)
+            else:
+                progress_callback(step_key, percent, desc)
 
     output_dir = _build_output_dir(output_file_path, agent_user_id, task_id)
     
@@ -177,6 +303,8 @@ def run_pipeline_sync(
     
     log = []
     print("u"*40)
+    paths: Dict[str, str] = {}          # 各步骤产出文件的绝对路径，供下游步骤读取
+    handoff: Dict[str, Any] = {}        # 下游显式声明了对应参数时才交接的内存数据
     
     try:
         report_progress("init", 5, "初始化任务")
@@ -185,7 +313,7 @@ def run_pipeline_sync(
         log.append(f"输入文件: {file_path}")
         log.append(f"输出目录: {output_dir}")
         
-        # Step 1: 标题识别
+        # Step 1: 标题识别（其余步骤都依赖它产出的 text）
         report_progress("step1", 15, "执行标题识别...")
         log.append("Step 1: 标题识别")
         text, json_file_name, title_json_path = mod_title_rec.main(file_path, output_dir=output_dir)
@@ -195,67 +323,76 @@ def run_pipeline_sync(
         file_outputs["step1_title_recognition"]["file_name"] = os.path.basename(title_json_path)
         meta["document_name"] = json_file_name
         log.append(f"✓ Step 1 完成: {title_json_path}")
-        
-        # Step 2: 标题定位与切块
-        report_progress("step2", 30, "执行标题定位与切块...")
-        log.append("Step 2: 标题定位与切块")
-        blocks_json_path = mod_pos.main(text, title_json_path, output_dir=output_dir)
-        if not blocks_json_path:
-            raise RuntimeError("Step 2 标题定位失败")
-        file_outputs["step2_title_position_blocks"]["file_path"] = _abspath(blocks_json_path)
-        file_outputs["step2_title_position_blocks"]["file_name"] = os.path.basename(blocks_json_path)
-        log.append(f"✓ Step 2 完成: {blocks_json_path}")
-        
-        # Step 3: 空块合并
-        report_progress("step3", 45, "执行空块合并...")
-        log.append("Step 3: 空块合并")
-        blocks_merge_json_path = mod_clear.main(
-            json_file_name=json_file_name, 
-            input_blocks_path=blocks_json_path, 
-            output_dir=output_dir
-        )
-        blocks_for_merge = file_outputs["step2_title_position_blocks"]["file_path"]
-        if blocks_merge_json_path:
-            file_outputs["step3_blocks_merge"]["file_path"] = _abspath(blocks_merge_json_path)
-            file_outputs["step3_blocks_merge"]["file_name"] = os.path.basename(blocks_merge_json_path)
-            if use_merged_blocks_for_merge and blocks_merge_json_path:
-                wrapped_path = _wrap_blocks_if_needed(blocks_merge_json_path, json_file_name, output_dir)
-                file_outputs["step3_blocks_merge_wrapped"]["file_path"] = wrapped_path
-                file_outputs["step3_blocks_merge_wrapped"]["file_name"] = os.path.basename(wrapped_path)
-                blocks_for_merge = wrapped_path
-        log.append(f"✓ Step 3 完成: {blocks_merge_json_path}")
-        
-        # Step 4: 表格识别
-        report_progress("step4", 60, "执行表格识别...")
-        log.append("Step 4: 表格识别")
-        tables_json_path = mod_table.main(
-            text, json_file_name, output_dir=output_dir, 
-            input_file_path=input_file_path, 
-            agent_user_id=agent_user_id, task_id=task_id
-        )
-        if not tables_json_path:
-            raise RuntimeError("Step 4 表格识别失败")
-        file_outputs["step4_table_recognition"]["file_path"] = _abspath(tables_json_path)
-        file_outputs["step4_table_recognition"]["file_name"] = os.path.basename(tables_json_path)
-        log.append(f"✓ Step 4 完成: {tables_json_path}")
-        
-        # Step 5: 表格标题合并
-        report_progress("step5", 75, "执行表格标题合并...")
-        log.append("Step 5: 表格标题合并")
-        tables_with_heading_json_path = mod_merge.main(
-            json_file_name, tables_json_path, 
-            blocks_json_path=blocks_for_merge, 
-            output_dir=output_dir
-        )
-        if not tables_with_heading_json_path:
-            raise RuntimeError("Step 5 表格标题合并失败")
-        file_outputs["step5_tables_with_heading"]["file_path"] = _abspath(tables_with_heading_json_path)
-        file_outputs["step5_tables_with_heading"]["file_name"] = os.path.basename(tables_with_heading_json_path)
-        log.append(f"✓ Step 5 完成: {tables_with_heading_json_path}")
-        
-        # Step 6: 图片识别
-        report_progress("step6", 90, "执行图片识别...")
-        if run_picture:
+
+        def step2():
+            log.append("Step 2: 标题定位与切块")
+            blocks_json_path = mod_pos.main(text, title_json_path, output_dir=output_dir)
+            if not blocks_json_path:
+                raise RuntimeError("Step 2 标题定位失败")
+            paths["step2"] = _abspath(blocks_json_path)
+            file_outputs["step2_title_position_blocks"]["file_path"] = _abspath(blocks_json_path)
+            file_outputs["step2_title_position_blocks"]["file_name"] = os.path.basename(blocks_json_path)
+            log.append(f"✓ Step 2 完成: {blocks_json_path}")
+
+        def step3():
+            log.append("Step 3: 空块合并")
+            blocks_merge_json_path = mod_clear.main(
+                json_file_name=json_file_name, 
+                input_blocks_path=paths["step2"], 
+                output_dir=output_dir
+            )
+            if blocks_merge_json_path:
+                file_outputs["step3_blocks_merge"]["file_path"] = _abspath(blocks_merge_json_path)
+                file_outputs["step3_blocks_merge"]["file_name"] = os.path.basename(blocks_merge_json_path)
+                if use_merged_blocks_for_merge and _accepts_kwarg(mod_merge.main, "blocks_data"):
+                    # Step 5 能直接接收内存中的 blocks：只解析一次交给它，不再写包装版文件
+                    blocks_doc, _ = _load_blocks_doc(blocks_merge_json_path)
+                    if blocks_doc is not None:
+                        handoff["blocks_data"] = blocks_doc
+                    paths["step3"] = _abspath(blocks_merge_json_path)
+                elif use_merged_blocks_for_merge:
+                    # Step 5 只认文件路径：与原流程一致，裸列表时写出包装版供其读取
+                    wrapped_path = _wrap_blocks_if_needed(blocks_merge_json_path, json_file_name, output_dir)
+                    file_outputs["step3_blocks_merge_wrapped"]["file_path"] = wrapped_path
+                    file_outputs["step3_blocks_merge_wrapped"]["file_name"] = os.path.basename(wrapped_path)
+                    paths["step3"] = wrapped_path
+            log.append(f"✓ Step 3 完成: {blocks_merge_json_path}")
+
+        def step4():
+            log.append("Step 4: 表格识别")
+            # Step 5 能直接接收内存中的 tables 时，顺带取回刚写出的文档，省去它重读/重解析一遍
+            pass_tables = _accepts_kwarg(mod_merge.main, "tables_data")
+            result = mod_table.main(
+                text, json_file_name, output_dir=output_dir, 
+                input_file_path=input_file_path, 
+                agent_user_id=agent_user_id, task_id=task_id,
+                return_tables=pass_tables
+            )
+            tables_json_path, tables_doc = result if pass_tables else (result, None)
+            if tables_doc is not None:
+                handoff["tables_data"] = tables_doc
+            if not tables_json_path:
+                raise RuntimeError("Step 4 表格识别失败")
+            paths["step4"] = _abspath(tables_json_path)
+            file_outputs["step4_table_recognition"]["file_path"] = _abspath(tables_json_path)
+            file_outputs["step4_table_recognition"]["file_name"] = os.path.basename(tables_json_path)
+            log.append(f"✓ Step 4 完成: {tables_json_path}")
+
+        def step5():
+            log.append("Step 5: 表格标题合并")
+            tables_with_heading_json_path = mod_merge.main(
+                json_file_name, paths["step4"], 
+                blocks_json_path=paths.get("step3", paths["step2"]), 
+                output_dir=output_dir,
+                **handoff
+            )
+            if not tables_with_heading_json_path:
+                raise RuntimeError("Step 5 表格标题合并失败")
+            file_outputs["step5_tables_with_heading"]["file_path"] = _abspath(tables_with_heading_json_path)
+            file_outputs["step5_tables_with_heading"]["file_name"] = os.path.basename(tables_with_heading_json_path)
+            log.append(f"✓ Step 5 完成: {tables_with_heading_json_path}")
+
+        def step6():
             log.append("Step 6: 图片识别")
             proc = EnhancedImageProcessor(input_file_path, agent_user_id, task_id)
             results = proc.process_text_with_images(text)
@@ -263,8 +400,20 @@ def run_pipeline_sync(
             file_outputs["step6_picture_recognition"]["file_path"] = _abspath(picture_json_path)
             file_outputs["step6_picture_recognition"]["file_name"] = os.path.basename(picture_json_path)
             log.append(f"✓ Step 6 完成: {picture_json_path}")
+
+        # 表格分支 2→3→5 与 4→5 并行；图片分支只依赖 text，与表格分支并行，总耗时取两者较大值
+        steps = [
+            PipelineStep("step2", "tables", (), step2, "执行标题定位与切块..."),
+            PipelineStep("step3", "tables", ("step2",), step3, "执行空块合并..."),
+            PipelineStep("step4", "tables", (), step4, "执行表格识别..."),
+            PipelineStep("step5", "tables", ("step3", "step4"), step5, "执行表格标题合并..."),
+        ]
+        if run_picture:
+            steps.append(PipelineStep("step6", "picture", (), step6, "执行图片识别..."))
         else:
             log.append("Step 6: 跳过图片识别")
+        run_step_dag(steps, report_progress, max_workers=DEFAULT_PIPELINE_MAX_WORKERS,
+                     base_percent=15, end_percent=95)
         
         report_progress("finished", 100, "所有步骤完成")
         log.append("✅ 流水线执行完成")
@@ -308,66 +457,79 @@ class StatusResponse(BaseModel):
     percent: int
     message: str
     result: Optional[Dict[str, Any]] = None
+    branches: Optional[Dict[str, int]] = None  # 各并行分支（tables / picture）的完成百分比
+
+@app.on_event("startup")
+def _start_job_workers():
+    global _worker_pool
+    get_job_queue()
+    if TASK_STATUS_BACKEND == "memory" and SERVER_WORKERS > 1:
+        print("⚠️ memory 状态存储只在本进程可见，SERVER_WORKERS > 1 时请使用 sqlite")
+    if JOB_WORKERS > 0:
+        _worker_pool = job_queue.WorkerPool(JOB_QUEUE_DB_PATH, JOB_HANDLER, workers=JOB_WORKERS,
+                                            status_url=task_status_url()).start()
+
+@app.on_event("shutdown")
+def _stop_job_workers():
+    # 未执行完的任务会重新入队，下次启动后继续
+    if _worker_pool is not None:
+        _worker_pool.stop()
+
+@app.on_event("shutdown")
+def _close_llm_http_client():
+    # 服务关闭时释放 table_recognition 的共享 LLM 连接池
+    # （异步连接池与解析任务自己的事件循环绑定，随任务结束关闭，这里不涉及）
+    mod_table.close_http_client()
+
+# ============== 任务执行（在工作进程中运行） ==============
+def execute_job(job_id: str, payload: Dict[str, Any], progress: Callable[..., None]) -> Tuple[str, str, Optional[Dict[str, Any]]]:
+    """
+    job_queue 工作进程的任务处理函数
 
-# ============== 后台任务包装器 ==============
-def background_process_wrapper(req_data: PipelineRequest, unique_key: str):
-    GLOBAL_TASK_STORE[unique_key] = {
-        "status": "running", "percent": 0, "current_step": "init",
-        "message": "任务已启动", "result": None
-    }
+    Args:
+        job_id: 任务ID（"{agentUserId}_{task_id}"）
+        payload: PipelineRequest 的字段
+        progress: 进度回调 progress(step_key, percent, desc, branches=None)
 
-    def update_store(step_key, percent, desc):
-        if unique_key in GLOBAL_TASK_STORE:
-            GLOBAL_TASK_STORE[unique_key]["percent"] = percent
-            GLOBAL_TASK_STORE[unique_key]["current_step"] = step_key
-            GLOBAL_TASK_STORE[unique_key]["message"] = desc
+    Returns:
+        (status, message, result)
+    """
+    req_data = PipelineRequest(**payload)
+    full_file_path = os.path.join(req_data.input_file_path, str(req_data.task_id), req_data.file_name)
+    print(f"Processing file: {full_file_path}")
 
-    try:
-        full_file_path = os.path.join(req_data.input_file_path, str(req_data.task_id), req_data.file_name)
-        print(f"Processing file: {full_file_path}")
-        
-        final_result = run_pipeline_sync(
-            file_path=full_file_path,
-            task_id=req_data.task_id,
-            agent_user_id=req_data.agentUserId,
-            output_file_path=req_data.output_file_path,
-            input_file_path=req_data.input_file_path,
-            run_picture=DEFAULT_RUN_PICTURE,
-            use_merged_blocks_for_merge=DEFAULT_USE_MERGED_FOR_MERGE,
-            progress_callback=update_store
-        )
-
-        status_str = "success" if final_result["status"] == 1 else "failed"
-        GLOBAL_TASK_STORE[unique_key].update({
-            "status": status_str, "percent": 100, "current_step": "finished",
-            "message": final_result["message"], "result": final_result
-        })
+    final_result = run_pipeline_sync(
+        file_path=full_file_path,
+        task_id=req_data.task_id,
+        agent_user_id=req_data.agentUserId,
+        output_file_path=req_data.output_file_path,
+        input_file_path=req_data.input_file_path,
+        run_picture=DEFAULT_RUN_PICTURE,
+        use_merged_blocks_for_merge=DEFAULT_USE_MERGED_FOR_MERGE,
+        progress_callback=progress
+    )
+    status_str = job_queue.STATUS_SUCCESS if final_result["status"] == 1 else job_queue.STATUS_FAILED
+    return status_str, final_result["message"], final_result
 
-    except Exception as e:
-        traceback.print_exc()
-        GLOBAL_TASK_STORE[unique_key].update({
-            "status": "failed", "percent": 100, 
-            "message": f"系统异常: {str(e)}", "result": None
-        })
+def _running_response(unique_key: str) -> Dict[str, Any]:
+    return {
+        "ok": True, "message": "任务已在运行中", "query_id": unique_key,
+        "status_url": f"/pipeline/status?query_id={unique_key}"
+    }
 
 @app.post("/pipeline/run", response_model=RunResponse)
-async def run_pipeline(req: PipelineRequest, background_tasks: BackgroundTasks):
+def run_pipeline(req: PipelineRequest):
     unique_key = f"{req.agentUserId}_{req.task_id}"
     
-    if unique_key in GLOBAL_TASK_STORE and GLOBAL_TASK_STORE[unique_key]["status"] == "running":
-        return {
-            "ok": True, "message": "任务已在运行中", "query_id": unique_key,
-            "status_url": f"/pipeline/status?query_id={unique_key}"
-        }
-    
-    background_tasks.add_task(background_process_wrapper, req, unique_key)
+    if not get_job_queue().enqueue(unique_key, req.model_dump()):
+        return _running_response(unique_key)
     return {
         "ok": True, "message": "任务已接收，正在后台处理", "query_id": unique_key,
         "status_url": f"/pipeline/status?query_id={unique_key}"
     }
 
 @app.post("/pipeline/run_check", response_model=RunResponse)
-async def run_pipeline_check(req: PipelineRequest, background_tasks: BackgroundTasks):
+def run_pipeline_check(req: PipelineRequest):
     """
     智能接口：优先检查缓存，有缓存直接返回，无缓存才运行
     """
@@ -375,23 +537,20 @@ async def run_pipeline_check(req: PipelineRequest, background_tasks: BackgroundT
     
     cached_result = check_cache_result(req)
     if cached_result:
-        GLOBAL_TASK_STORE[unique_key] = {
-            "status": "success", "percent": 100, "current_step": "finished",
+        if get_job_queue().is_active(unique_key):
+            return _running_response(unique_key)
+        get_job_queue().status.put(unique_key, {
+            "status": job_queue.STATUS_SUCCESS, "percent": 100, "current_step": "finished",
             "message": "文件已存在，跳过处理 (Cached)", "result": cached_result
-        }
+        })
         return {
             "ok": True, "message": "检测到文件已存在，无需处理", 
             "query_id": unique_key,
             "status_url": f"/pipeline/status?query_id={unique_key}"
         }
 
-    if unique_key in GLOBAL_TASK_STORE and GLOBAL_TASK_STORE[unique_key]["status"] == "running":
-        return {
-            "ok": True, "message": "任务已在运行中", "query_id": unique_key,
-            "status_url": f"/pipeline/status?query_id={unique_key}"
-        }
-
-    background_tasks.add_task(background_process_wrapper, req, unique_key)
+    if not get_job_queue().enqueue(unique_key, req.model_dump()):
+        return _running_response(unique_key)
     return {
         "ok": True, "message": "未检测到结果，任务已启动后台处理", 
         "query_id": unique_key,
@@ -399,15 +558,105 @@ async def run_pipeline_check(req: PipelineRequest, background_tasks: BackgroundT
     }
 
 @app.get("/pipeline/status", response_model=StatusResponse)
-async def get_pipeline_status(query_id: str = Query(..., description="任务的唯一ID")):
-    task_info = GLOBAL_TASK_STORE.get(query_id)
+def get_pipeline_status(query_id: str = Query(..., description="任务的唯一ID")):
+    task_info = get_job_queue().get(query_id)
     if not task_info:
         return {"ok": False, "status": "not_found", "percent": 0, "message": "任务不存在", "result": None}
     return {
         "ok": True, "status": task_info["status"], "percent": task_info["percent"],
-        "message": task_info["message"], "result": task_info["result"]
+        "message": task_info["message"], "result": task_info["result"],
+        "branches": task_info.get("branches")
     }
 
+# ============== 进度推送 ==============
+PROGRESS_FIELDS = ("status", "percent", "current_step", "message", "branches")
+TERMINAL_STATUSES = (job_queue.STATUS_SUCCESS, job_queue.STATUS_FAILED)
+
+def _progress_delta(prev: Optional[Dict[str, Any]], cur: Dict[str, Any]) -> Dict[str, Any]:
+    """相对上一次推送变化了的进度字段（首次推送给全部进度字段），不含 result"""
+    delta = {k: cur.get(k) for k in PROGRESS_FIELDS if prev is None or prev.get(k) != cur.get(k)}
+    delta["version"] = cur.get("version")
+    return delta
+
+def _sse(event: str, data: Dict[str, Any], event_id: Optional[int] = None) -> str:
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {json_io.dumps(data, pretty=False)}\n\n"
+
+@app.get("/pipeline/events")
+async def pipeline_events(
+        request: Request,
+        query_id: str = Query(..., description="任务的唯一ID"),
+        last_event_id: Optional[str] = Header(default=None, alias="Last-Event-ID")
+):
+    """
+    SSE 进度流：
+    - event: progress —— 进度有变化时推送变化的字段（percent / current_step / message / branches / status）
+    - event: result   —— 任务结束时推送一次完整结果，随后关闭连接
+    - event: not_found —— 任务不存在
+    断线重连时浏览器带 Last-Event-ID（即版本号），版本未变则不重复推送 progress；
+    但任务已结束时仍补发 result 并关闭，避免收到 result 后自动重连的客户端一直挂着收 keepalive
+    """
+    store = get_job_queue().status
+
+    async def stream():
+        last_version = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+        last: Optional[Dict[str, Any]] = None
+        idle = 0.0
+        while not await request.is_disconnected():
+            version = await asyncio.to_thread(store.get_version, query_id)
+            # 版本变化时读完整记录；连接后的第一轮也要读（重连时版本可能未变，但需要知道任务是否已结束）
+            need_rec = version is not None and (version != last_version or last is None)
+            rec = await asyncio.to_thread(store.get, query_id) if need_rec else None
+            if version is None or (need_rec and rec is None):
+                # 任务不存在，或在两次读取之间被淘汰：结束流，不空转重试
+                yield _sse("not_found", {"ok": False, "status": "not_found", "message": "任务不存在"})
+                return
+            if rec is not None:
+                if rec["status"] in TERMINAL_STATUSES:
+                    yield _sse("result", {"ok": True, **rec}, rec["version"])
+                    return
+                if rec["version"] != last_version:
+                    last_version = rec["version"]
+                    yield _sse("progress", _progress_delta(last, rec), last_version)
+                    idle = 0.0
+                last = rec
+            elif idle >= EVENTS_KEEPALIVE_S:
+                yield ": keepalive\n\n"
+                idle = 0.0
+            await asyncio.sleep(EVENTS_POLL_INTERVAL_S)
+            idle += EVENTS_POLL_INTERVAL_S
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/pipeline/status/wait")
+async def wait_pipeline_status(
+        query_id: str = Query(..., description="任务的唯一ID"),
+        since_version: int = Query(0, description="客户端已知的版本号，状态版本大于它时立即返回"),
+        timeout: float = Query(LONG_POLL_MAX_WAIT_S, description="最长等待秒数")
+):
+    """
+    长轮询（不支持 SSE 时的回退）：状态版本号超过 since_version 或超时才返回
+    只返回进度字段；任务结束后才带上 result
+    """
+    store = get_job_queue().status
+    deadline = time.monotonic() + max(0.0, min(timeout, LONG_POLL_MAX_WAIT_S))
+    while True:
+        version = await asyncio.to_thread(store.get_version, query_id)
+        if version is None:
+            return {"ok": False, "status": "not_found", "message": "任务不存在", "version": None, "changed": False}
+        if version > since_version or time.monotonic() >= deadline:
+            break
+        await asyncio.sleep(EVENTS_POLL_INTERVAL_S)
+    rec = await asyncio.to_thread(store.get, query_id)
+    if rec is None:
+        return {"ok": False, "status": "not_found", "message": "任务不存在", "version": None, "changed": False}
+    body = {"ok": True, "changed": rec["version"] > since_version, "version": rec["version"],
+            **{k: rec.get(k) for k in PROGRESS_FIELDS}}
+    if rec["status"] in TERMINAL_STATUSES:
+        body["result"] = rec["result"]
+    return body
+
 class StatisticsRequest(BaseModel):
     file_name: str = Field(..., description="文件名称 (例如 test.docx)", example="证书文档.docx")
     task_id: str = Field(..., description="任务ID")
@@ -458,44 +707,39 @@ def get_document_statistics(file_path: str, task_id: str, agent_user_id: int, ou
         
         # 读取文本块信息
         blocks_file_path = os.path.join(output_dir, f"{file_name_without_ext}_blocks.json")
-        if os.path.exists(blocks_file_path):
-            with open(blocks_file_path, 'r', encoding='utf-8') as f:
-                blocks_data = json.load(f)
-                if "total_blocks" in blocks_data:
-                    statistics["text_blocks_count"] = blocks_data["total_blocks"]
-                elif "blocks" in blocks_data:
-                    statistics["text_blocks_count"] = len(blocks_data["blocks"])
+        blocks_data = json_io.load(blocks_file_path) if os.path.exists(blocks_file_path) else None
+        if blocks_data is not None:
+            if "total_blocks" in blocks_data:
+                statistics["text_blocks_count"] = blocks_data["total_blocks"]
+            elif "blocks" in blocks_data:
+                statistics["text_blocks_count"] = len(blocks_data["blocks"])
         
         # 读取表格信息
         tables_file_path = os.path.join(output_dir, f"{file_name_without_ext}_tables_with_heading.json")
         if os.path.exists(tables_file_path):
-            with open(tables_file_path, 'r', encoding='utf-8') as f:
-                tables_data = json.load(f)
-                if "tables" in tables_data:
-                    statistics["tables_count"] = len(tables_data["tables"])
+            tables_data = json_io.load(tables_file_path)
+            if "tables" in tables_data:
+                statistics["tables_count"] = len(tables_data["tables"])
         
         # 读取图片信息
         picture_file_path = os.path.join(output_dir, f"{file_name_without_ext}_picture.json")
         if os.path.exists(picture_file_path):
-            with open(picture_file_path, 'r', encoding='utf-8') as f:
-                picture_data = json.load(f)
-                if "total_images" in picture_data:
-                    statistics["images_count"] = picture_data["total_images"]
-                elif "results" in picture_data:
-                    statistics["images_count"] = len(picture_data["results"])
+            picture_data = json_io.load(picture_file_path)
+            if "total_images" in picture_data:
+                statistics["images_count"] = picture_data["total_images"]
+            elif "results" in picture_data:
+                statistics["images_count"] = len(picture_data["results"])
         
-        # 尝试从文本块信息中获取页数信息
-        if os.path.exists(blocks_file_path):
-            with open(blocks_file_path, 'r', encoding='utf-8') as f:
-                blocks_data = json.load(f)
-                if "blocks" in blocks_data and blocks_data["blocks"]:
-                    # 从最后一个block获取最大行号作为总页数
-                    max_line = 0
-                    for block in blocks_data["blocks"]:
-                        if "line_end" in block and block["line_end"] > max_line:
-                            max_line = block["line_end"]
-                    # 这里假设每页大约有40行，这是一个粗略估计
-                    statistics["total_pages"] = max(1, round(max_line / 40))
+        # 尝试从文本块信息中获取页数信息（复用上面已读取的 blocks_data）
+        if blocks_data is not None:
+            if "blocks" in blocks_data and blocks_data["blocks"]:
+                # 从最后一个block获取最大行号作为总页数
+                max_line = 0
+                for block in blocks_data["blocks"]:
+                    if "line_end" in block and block["line_end"] > max_line:
+                        max_line = block["line_end"]
+                # 这里假设每页大约有40行，这是一个粗略估计
+                statistics["total_pages"] = max(1, round(max_line / 40))
         
         return {"ok": True, "message": "统计信息获取成功", "statistics": statistics}
     
@@ -1,13 +1,21 @@
 
 from __future__ import annotations
 from pydantic_settings import BaseSettings, SettingsConfigDict
-import os, re, json, bisect, shutil
-from typing import List, Dict, Optional, Tuple
-from datetime import datetime
+import os, re, json, bisect, shutil, atexit, threading, time, random, asyncio, weakref
+from typing import List, Dict, Optional, Tuple, Iterator
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
 import httpx
+import numpy as np
 import pandas as pd  # NEW
 from openpyxl import load_workbook  # NEW
 import hashlib  # 新增
+import uuid
+import table_sidecar
+import json_io
 
 
 # 在工具函数区域添加
@@ -40,7 +48,43 @@ class Settings(BaseSettings):
     OLLAMA_BASE_URL: str | None = "http://localhost:11434"
     GEMINI_API_KEY: str | None = None
 
-    TIMEOUT_S: int = 6000
+    # ---------- 新增：多提供方 / 按步骤路由 ----------
+    OPENAI_BASE_URL: str = "https://api.openai.com/v1"  # OpenAI 兼容接口地址（vLLM / 网关也可）
+    OPENAI_MODEL_ID: str = "gpt-4o-mini"
+    OLLAMA_MODEL_ID: str = "qwen2.5:7b-instruct"
+    LLM_STUB_RESPONSE: str = "{}"  # stub 提供方固定返回的内容
+    # 步骤 -> "provider" 或 "provider:model"，未配置的步骤用 MODEL_PROVIDER / MODEL_ID
+    # 步骤名：title / headers / layout / sheet_analysis / key_columns
+    # 例：{"key_columns": "ollama:qwen2.5:7b-instruct"}
+    LLM_STEP_PROVIDERS: Dict[str, str] = {}
+
+    TIMEOUT_S: int = 6000  # 单次 call 的总时限（含重试等待）
+
+    # ---------- 新增：单请求超时 / 重试 / 限流 ----------
+    LLM_CALL_TIMEOUT_S: float = 300.0  # 单个 HTTP 请求的读超时（秒），超时按可重试错误处理
+    LLM_CONNECT_TIMEOUT_S: float = 10.0
+    LLM_MAX_RETRIES: int = 4           # 429 / 5xx / 网络错误的最大重试次数
+    LLM_BACKOFF_BASE_S: float = 1.0    # 指数退避基数：base * 2^attempt，加随机抖动
+    LLM_BACKOFF_MAX_S: float = 60.0    # 单次退避等待上限（Retry-After 也会被截断到该值）
+    # 按提供方的并发上限与令牌桶（rate_per_s 为每秒请求数，burst 为桶容量；rate_per_s<=0 表示不限速）
+    LLM_PROVIDER_LIMITS: Dict[str, Dict[str, float]] = {
+        "deepseek": {"max_concurrency": 8, "rate_per_s": 5.0, "burst": 10},
+        "ollama": {"max_concurrency": 2, "rate_per_s": 0.0, "burst": 1},
+    }
+    LLM_DEFAULT_LIMITS: Dict[str, float] = {"max_concurrency": 4, "rate_per_s": 0.0, "burst": 1}
+
+    # ---------- 新增：LLM HTTP 连接池 ----------
+    LLM_MAX_CONNECTIONS: int = 16         # 连接池最大连接数
+    LLM_MAX_KEEPALIVE: int = 8            # 最大保活连接数
+    LLM_KEEPALIVE_EXPIRY_S: float = 60.0  # 空闲连接保活时长（秒）
+    LLM_HTTP2: bool = True                # 启用 HTTP/2（需安装 h2，缺失时自动回退 HTTP/1.1）
+
+    # ---------- 新增：LLM 响应缓存 ----------
+    LLM_CACHE_ENABLED: bool = True
+    LLM_CACHE_DIR: str = "./out/.llm_cache"
+    LLM_CACHE_TTL_S: int = 30 * 24 * 3600  # 缓存有效期（秒），0 表示永不过期
+    LLM_CACHE_MAX_MB: int = 512            # 缓存目录大小上限（MB），0 表示不限制
+
     OUTPUT_DIR: str = "./out"
 
     # ---------- 新增：附件目录/预览预算 ----------
@@ -48,6 +92,9 @@ class Settings(BaseSettings):
     ATTACHMENT_SEARCH_DIRS: List[str] = ["/data/cwd_cq/out", "."]  # NEW
     SHEET_PREVIEW_ROWS: int = 40  # NEW
     SHEET_PREVIEW_COLS: int = 32  # NEW
+    # 附件落盘方式，按顺序尝试：hardlink（同一文件系统，零拷贝）/ reflink（支持写时复制的文件系统）/ copy
+    # 注意：hardlink 与源文件共用同一份数据，若有程序原地改写落盘副本会同步改到源文件，此时去掉 hardlink
+    ATTACHMENT_STAGE_METHODS: List[str] = ["hardlink", "reflink", "copy"]
 
     # ========== 新增：路径参数 ==========
     INPUT_FILE_PATH: str = ""  # 基础输入路径
@@ -59,11 +106,46 @@ class Settings(BaseSettings):
     TITLE_CONTEXT_LINES: int = 16
     TITLE_CONTEXT_CHARS: int = 1200
 
+    # ---------- 新增：并发分析 ----------
+    SHEET_CONCURRENCY: int = 4  # 附件/工作表并发分析的最大线程数（1 表示串行）
+
+    # ---------- 新增：超大附件流式处理 ----------
+    XLSX_STREAM_MIN_ROWS: int = 20000  # 工作簿中任一 sheet 行数达到该值时整本走只读流式模式（0 表示关闭）
+    DATA_ROWS_CHUNK_SIZE: int = 5000   # 流式模式下 data_rows 分块写出的行数
+
+    # ---------- 新增：简单表规则预判 ----------
+    HEURISTIC_FAST_PATH: bool = True          # 单行表头、无合并表头、列类型一致的简单表直接由规则给出表头与布局
+    HEURISTIC_MIN_CONFIDENCE: float = 0.85    # 规则置信度低于该值时仍调用 LLM
+
+    # ---------- 新增：列类型画像 ----------
+    KEY_COLUMN_LOCAL_PROFILE: bool = True     # 空列/日期列/纯数值列按画像直接判定角色，不交给 LLM
+    KEY_COLUMN_PROFILE_MIN_RATIO: float = 0.95  # 本地判定所需的 数值/日期 占比下限
+
+    # ---------- 新增：data_rows 旁路文件 ----------
+    DATA_ROWS_SIDECAR: str = "off"        # off / parquet / jsonl；非 off 时大子表的 data_rows 单独落盘，主 JSON 只留 data_rows_ref
+    DATA_ROWS_SIDECAR_MIN_ROWS: int = 1000  # 行数达到该值的子表才写 sidecar
+
+    # ---------- 新增：增量重解析 ----------
+    INCREMENTAL_REEXTRACT: bool = True  # 重跑时读取上次的 _tables.json，附件内容与上文均未变化的表格直接复用
+
+    # ---------- 新增：单次整表分析 ----------
+    LLM_SINGLE_SHOT_ANALYSIS: bool = False  # True 时每个 sheet 用一个提示词同时拿到表头/布局/列角色，解析失败的部分回退分步请求
+
 
 settings = Settings()
 os.makedirs(settings.OUTPUT_DIR, exist_ok=True)
 os.makedirs(settings.ATTACHMENT_OUT_DIR, exist_ok=True)  # NEW
 
+
+def make_job_settings(base: Optional[Settings] = None, **overrides) -> Settings:
+    """
+    生成单个任务专用的配置副本（基于全局 settings 覆盖部分字段），不修改全局单例
+    同一进程内并发处理多个文档时，每个任务各持一份，互不影响
+    """
+    base = base or settings
+    updates = {k: v for k, v in overrides.items() if v is not None and v != ""}
+    return base.model_copy(update=updates) if updates else base
+
 # =========================
 # 工具函数（保留 + 新增）
 # =========================
@@ -100,9 +182,172 @@ def find_xlsx_mentions(text: str) -> List[Dict]:
     return hits
 
 
+# ---------- NEW: 文档行索引（每次解析只建一次，供标题上下文定位） ----------
+class DocumentLineIndex:
+    """
+    文档行索引：
+    - mention_lines: 含 xlsx 引用的行号（升序），用于 bisect 查找某区间内最近的引用
+    - blank: 空行位图
+    - prev_content[k]: 行号 <= k 的最近一个“有内容且不含 xlsx 引用”的行，没有则为 -1
+    - offsets: 各行字符长度的前缀和，用于 O(1) 计算窗口拼接后的长度
+    """
+
+    def __init__(self, lines: List[str], hits: Optional[List[Dict]] = None):
+        self.lines = lines
+        n = len(lines)
+        if hits is None:
+            hits = [{"line_idx": i} for i, ln in enumerate(lines) if _XLSX_RE.search(ln)]
+        self.mention_lines: List[int] = sorted({h["line_idx"] for h in hits})
+        self.blank = np.fromiter((not ln.strip() for ln in lines), dtype=bool, count=n)
+        is_mention = np.zeros(n, dtype=bool)
+        is_mention[self.mention_lines] = True
+        content_idx = np.where(~self.blank & ~is_mention, np.arange(n), -1)
+        self.prev_content = np.maximum.accumulate(content_idx) if n else content_idx
+        self.offsets = np.concatenate(([0], np.cumsum(np.fromiter((len(ln) for ln in lines), dtype=np.int64, count=n))))
+
+    def __len__(self) -> int:
+        return len(self.lines)
+
+    def last_content_at_or_before(self, k: int) -> int:
+        """行号 <= k 的最近内容行，没有返回 -1"""
+        k = min(k, len(self.lines) - 1)
+        return int(self.prev_content[k]) if k >= 0 else -1
+
+    def last_mention_in(self, lo: int, hi: int) -> Optional[int]:
+        """[lo, hi] 区间内行号最大的 xlsx 引用行，没有返回 None"""
+        if hi < lo:
+            return None
+        pos = bisect.bisect_right(self.mention_lines, hi) - 1
+        if pos >= 0 and self.mention_lines[pos] >= lo:
+            return self.mention_lines[pos]
+        return None
+
+    def joined_len(self, begin: int, end: int) -> int:
+        """lines[begin:end + 1] 用 "\n" 拼接后的长度"""
+        end = min(end, len(self.lines) - 1)
+        if end < begin:
+            return 0
+        return int(self.offsets[end + 1] - self.offsets[begin]) + (end - begin)
+
+
+# ---------- NEW: 增量重解析（输入指纹） ----------
+_FINGERPRINT_VERSION = 1  # 解析逻辑有不兼容变化时递增，使旧结果全部失效
+
+# 会影响解析结果的配置项，参与指纹计算
+_FINGERPRINT_SETTINGS = (
+    "MODEL_PROVIDER", "MODEL_ID", "LLM_STEP_PROVIDERS",
+    "SHEET_PREVIEW_ROWS", "SHEET_PREVIEW_COLS", "TITLE_CONTEXT_LINES", "TITLE_CONTEXT_CHARS",
+    "HEURISTIC_FAST_PATH", "HEURISTIC_MIN_CONFIDENCE", "LLM_SINGLE_SHOT_ANALYSIS",
+    "KEY_COLUMN_LOCAL_PROFILE", "KEY_COLUMN_PROFILE_MIN_RATIO",
+)
+
+
+_CONTENT_HASH_MEMO_MAX = 4096  # 内容哈希记忆的条目上限（LRU），常驻的 API 进程里不随处理过的文件数增长
+_CONTENT_HASH_MEMO: "OrderedDict[Tuple, str]" = OrderedDict()
+_CONTENT_HASH_MEMO_LOCK = threading.Lock()
+
+
+def file_content_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """文件内容 sha256；按 (设备, inode, 大小, mtime) 做 LRU 记忆，同一文件（含硬链接）不重复读取"""
+    st = os.stat(path)
+    memo_key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    with _CONTENT_HASH_MEMO_LOCK:
+        cached = _CONTENT_HASH_MEMO.get(memo_key)
+        if cached is not None:
+            _CONTENT_HASH_MEMO.move_to_end(memo_key)
+            return cached
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            h.update(block)
+    digest = h.hexdigest()
+    with _CONTENT_HASH_MEMO_LOCK:
+        _CONTENT_HASH_MEMO[memo_key] = digest
+        _CONTENT_HASH_MEMO.move_to_end(memo_key)
+        while len(_CONTENT_HASH_MEMO) > _CONTENT_HASH_MEMO_MAX:
+            _CONTENT_HASH_MEMO.popitem(last=False)
+    return digest
+
+
+def _shift_line_ref(v, delta: int):
+    """把行号字段（int / "12" / "L12"）整体平移 delta，其它值原样返回"""
+    if not delta or isinstance(v, bool):
+        return v
+    if isinstance(v, int):
+        return v + delta
+    if isinstance(v, str):
+        m = re.fullmatch(r"(L?)(\d+)", v.strip())
+        if m:
+            return f"{m.group(1)}{int(m.group(2)) + delta}"
+    return v
+
+
 # ---------- NEW: 附件定位/落盘 ----------
+def _reflink(src: str, dst: str) -> None:
+    """写时复制克隆（Linux FICLONE，btrfs/xfs 等支持）；不支持时抛 OSError"""
+    import fcntl
+    FICLONE = 0x40049409
+    with open(src, "rb") as fs, open(dst, "wb") as fd:
+        try:
+            fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+        except OSError:
+            fd.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def _stage_file(src: str, dst: str, methods: Optional[List[str]] = None) -> str:
+    """
+    把附件放到落盘目录，目标已是相同内容时跳过：
+    - 同一文件（同 inode，如已硬链接）或 大小+mtime 相同 -> 直接复用
+    - 仅 mtime 不同但大小相同 -> 比较内容哈希，相同则只同步 mtime
+    - 否则按 ATTACHMENT_STAGE_METHODS 依次尝试 硬链接 / reflink / 复制（先写临时文件再原子替换）
+
+    Returns:
+        本次采用的方式：same / skip / hardlink / reflink / copy
+    """
+    if os.path.abspath(src) == os.path.abspath(dst):
+        return "same"
+    try:
+        dst_st = os.stat(dst)
+    except FileNotFoundError:
+        dst_st = None
+    if dst_st is not None:
+        src_st = os.stat(src)
+        if os.path.samestat(src_st, dst_st):
+            return "skip"
+        if src_st.st_size == dst_st.st_size:
+            if src_st.st_mtime_ns == dst_st.st_mtime_ns:
+                return "skip"
+            if file_content_hash(src) == file_content_hash(dst):
+                os.utime(dst, ns=(src_st.st_atime_ns, src_st.st_mtime_ns))
+                return "skip"
+
+    tmp = f"{dst}.tmp{os.getpid()}_{threading.get_ident()}"
+    for method in (methods if methods is not None else settings.ATTACHMENT_STAGE_METHODS):
+        try:
+            if method == "hardlink":
+                os.link(src, tmp)
+            elif method == "reflink":
+                _reflink(src, tmp)
+            else:
+                shutil.copy2(src, tmp)
+        except (OSError, ImportError):
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            continue
+        os.replace(tmp, dst)
+        return method
+    # 所有方式都失败时退回普通复制（错误直接抛出）
+    shutil.copy2(src, dst)
+    return "copy"
+
+
 def resolve_and_stage_attachment(name: str, input_base_path: str = "",
-                                     agent_user_id: str = "", task_id: str = "") -> Optional[str]:
+                                     agent_user_id: str = "", task_id: str = "",
+                                     cache: Optional[Dict] = None,
+                                     s: Optional[Settings] = None) -> Optional[str]:
     """
     附件定位/落盘，支持路径拼接
 
@@ -111,7 +356,33 @@ def resolve_and_stage_attachment(name: str, input_base_path: str = "",
         input_base_path: 基础输入路径
         agent_user_id: 用户ID
         task_id: 任务ID
+        cache: 单次任务内的定位结果缓存（同一附件被多次引用时不再重复探测/落盘），None 表示不缓存
+        s: 任务配置（落盘目录/搜索目录/落盘方式），None 表示全局 settings
     """
+    s = s or settings
+    cache_key = (name, input_base_path, str(agent_user_id), str(task_id))
+    if cache is not None and cache_key in cache:
+        return cache[cache_key]
+
+    src, how = _locate_attachment(name, input_base_path, agent_user_id, task_id,
+                                  search_dirs=s.ATTACHMENT_SEARCH_DIRS)
+    dst = None
+    if src is None:
+        print(f"  ✗ 文件未找到: {name}")
+    else:
+        dst = os.path.join(s.ATTACHMENT_OUT_DIR, os.path.basename(name))
+        method = _stage_file(src, dst, methods=s.ATTACHMENT_STAGE_METHODS)
+        print(f"  ✓ 找到文件（{how}）: {src}  [{method}]")
+
+    if cache is not None:
+        cache[cache_key] = dst
+    return dst
+
+
+def _locate_attachment(name: str, input_base_path: str = "",
+                       agent_user_id: str = "", task_id: str = "",
+                       search_dirs: Optional[List[str]] = None) -> Tuple[Optional[str], str]:
+    """按 拼接路径 -> 绝对路径 -> 搜索目录 的顺序定位附件，返回 (源路径, 命中方式)"""
     # 如果提供了路径参数，先尝试拼接路径
     if input_base_path and agent_user_id and task_id:
         # 去掉路径开头的 / 或 \ (避免os.path.join把它当作绝对路径)
@@ -128,49 +399,305 @@ def resolve_and_stage_attachment(name: str, input_base_path: str = "",
 
         # 如果拼接后的路径存在
         if os.path.exists(full_path):
-            dst = os.path.join(settings.ATTACHMENT_OUT_DIR, os.path.basename(name))
-            if os.path.abspath(full_path) != os.path.abspath(dst):
-                shutil.copy2(full_path, dst)
-            print(f"  ✓ 找到文件（拼接路径）: {full_path}")
-            return dst
+            return full_path, "拼接路径"
 
     # 原有逻辑：已是绝对路径且存在
     if os.path.isabs(name) and os.path.exists(name):
-        dst = os.path.join(settings.ATTACHMENT_OUT_DIR, os.path.basename(name))
-        if os.path.abspath(name) != os.path.abspath(dst):
-            shutil.copy2(name, dst)
-        print(f"  ✓ 找到文件（绝对路径）: {name}")
-        return dst
+        return name, "绝对路径"
 
     # 原有逻辑：在搜索目录中查找
-    for d in settings.ATTACHMENT_SEARCH_DIRS:
+    for d in (search_dirs if search_dirs is not None else settings.ATTACHMENT_SEARCH_DIRS):
         cand = os.path.join(d, name)
         if os.path.exists(cand):
-            dst = os.path.join(settings.ATTACHMENT_OUT_DIR, os.path.basename(name))
-            if os.path.abspath(cand) != os.path.abspath(dst):
-                shutil.copy2(cand, dst)
-            print(f"  ✓ 找到文件（搜索目录）: {cand}")
-            return dst
+            return cand, "搜索目录"
 
-    print(f"  ✗ 文件未找到: {name}")
-    return None
+    return None, ""
 
 
 # ---------- NEW: Excel 读取并展开合并 ----------
-def read_xlsx_expand_merged(path: str, sheet) -> pd.DataFrame:
+def read_xlsx_expand_merged(path: str, sheet, read_only: bool = False) -> pd.DataFrame:
+    """
+    读取工作表并展开合并单元格
+
+    Args:
+        path: xlsx 路径
+        sheet: sheet 名或序号
+        read_only: True 时使用 openpyxl 只读流式解析（适合数万行以上的大表），结果与默认模式一致
+    """
+    if read_only:
+        return pd.DataFrame(list(iter_xlsx_rows_expand_merged(path, sheet)))
     wb = load_workbook(path, data_only=True)
     ws = wb[wb.sheetnames[sheet]] if isinstance(sheet, int) else wb[sheet]
+    return _expand_merged_ws(ws)
+
+
+# 判断单元格是否为空（None 或 ""），对 object 数组逐元素向量化
+_is_blank_cell = np.frompyfunc(lambda x: x is None or x == "", 1, 1)
+
+
+def _expand_merged_ws(ws) -> pd.DataFrame:
+    """
+    读取已加载的工作表，展开合并单元格（合并区域内的空单元格用左上角值填充）
+    按行批量读取到 NumPy object 数组，合并区域用切片整体赋值
+    """
     max_row, max_col = ws.max_row, ws.max_column
-    grid = [[ws.cell(r, c).value for c in range(1, max_col + 1)]
-            for r in range(1, max_row + 1)]
-    for rng in list(ws.merged_cells.ranges):
+    grid = np.empty((max_row, max_col), dtype=object)
+    for r, row in enumerate(ws.iter_rows(min_row=1, max_row=max_row, min_col=1, max_col=max_col,
+                                         values_only=True)):
+        grid[r, :] = row
+    for rng in ws.merged_cells.ranges:
         r1, c1, r2, c2 = rng.min_row, rng.min_col, rng.max_row, rng.max_col
-        v = grid[r1 - 1][c1 - 1]
-        for r in range(r1 - 1, r2):
-            for c in range(c1 - 1, c2):
-                if grid[r][c] in (None, ""):
-                    grid[r][c] = v
-    return pd.DataFrame(grid)
+        block = grid[r1 - 1:r2, c1 - 1:c2]
+        block[_is_blank_cell(block).astype(bool)] = grid[r1 - 1, c1 - 1]
+    # 经 list 构造 DataFrame，列类型推断与逐格读取时完全一致
+    df = pd.DataFrame(grid.tolist())
+    # 记录合并区域（1-based 闭区间），供规则预判识别“表头是否有合并单元格”
+    df.attrs["merged_ranges"] = [(rng.min_row, rng.min_col, rng.max_row, rng.max_col)
+                                 for rng in ws.merged_cells.ranges]
+    return df
+
+
+def _scan_sheet_layout_streaming(ws) -> Tuple[int, int, List[Tuple[int, int, int, int]]]:
+    """
+    只读模式下 openpyxl 既不提供 merged_cells，也只信任文件里（可能不准确）的 <dimension>。
+    这里单独扫描一遍 sheet XML（只看 <row>/<c> 的坐标和 <mergeCell>，不解析单元格值），
+    按与常规模式相同的口径得到 max_row/max_col 和合并区域。
+
+    Returns:
+        (max_row, max_col, [(min_row, min_col, max_row, max_col), ...])，合并区域按起始行升序
+    """
+    from xml.etree.ElementTree import iterparse
+    from openpyxl.utils.cell import range_boundaries, coordinate_to_tuple
+
+    max_row = max_col = 0
+    cur_row = cur_col = 0
+    ranges = []
+    sheet_data = None
+    src = ws._get_source()  # 只读 sheet 的原始 XML 流
+    try:
+        for event, el in iterparse(src, events=("start", "end")):
+            tag = el.tag.rsplit("}", 1)[-1]
+            if event == "start":
+                if tag == "row":
+                    r = el.get("r")
+                    cur_row = int(r) if r else cur_row + 1
+                    cur_col = 0
+                elif tag == "sheetData":
+                    sheet_data = el
+                continue
+            if tag == "row" and sheet_data is not None:
+                sheet_data.clear()  # 已扫描的行及时释放，内存不随行数增长
+            elif tag == "c":
+                ref = el.get("r")
+                if ref:
+                    cur_row, cur_col = coordinate_to_tuple(ref)
+                else:
+                    cur_col += 1
+                max_row = max(max_row, cur_row)
+                max_col = max(max_col, cur_col)
+            elif tag == "mergeCell":
+                c1, r1, c2, r2 = range_boundaries(el.get("ref"))
+                if (r1, c1) != (r2, c2):
+                    ranges.append((r1, c1, r2, c2))
+                    # 常规模式会为合并区域内的单元格创建 MergedCell，尺寸随之扩展
+                    max_row, max_col = max(max_row, r2), max(max_col, c2)
+    finally:
+        src.close()
+    ranges.sort()
+    return max(max_row, 1), max(max_col, 1), ranges
+
+
+def iter_xlsx_rows_expand_merged(path: str, sheet, max_rows: Optional[int] = None,
+                                 layout: Optional[Tuple] = None) -> Iterator[List]:
+    """
+    流式读取工作表（openpyxl read_only），逐行产出已展开合并单元格的行（list）
+    内存占用只与列数和合并区域数量有关，与行数无关；产出的内容与 read_xlsx_expand_merged 一致
+
+    Args:
+        path: xlsx 路径
+        sheet: sheet 名或序号
+        max_rows: 最多读取的行数（None 表示全部）
+        layout: 已扫描过的 _scan_sheet_layout_streaming 结果（重复读取同一 sheet 时可省去扫描）
+    """
+    wb = load_workbook(path, data_only=True, read_only=True)
+    try:
+        ws = wb[wb.sheetnames[sheet]] if isinstance(sheet, int) else wb[sheet]
+        max_row, max_col, ranges = layout or _scan_sheet_layout_streaming(ws)
+        if max_rows is not None:
+            max_row = min(max_row, max_rows)
+
+        ri = 0
+        active: List[List] = []  # [r2, r1, c1, c2, value]
+        rows = ws.iter_rows(min_row=1, max_row=max_row, min_col=1, max_col=max_col, values_only=True)
+        for r in range(1, max_row + 1):
+            # 文件中缺失的尾部行（例如仅被合并区域覆盖）按空行补齐
+            row = list(next(rows, None) or (None,) * max_col)
+            while ri < len(ranges) and ranges[ri][0] == r:
+                _, c1, r2, c2 = ranges[ri]
+                active.append([r2, r, c1, c2, row[c1 - 1]])
+                ri += 1
+            if active:
+                # 与常规模式一致：合并区域内除左上角外的单元格一律取左上角的值
+                for r2, r1, c1, c2, v in active:
+                    for c in range(c1 - 1, c2):
+                        if r != r1 or c != c1 - 1:
+                            row[c] = v
+                active = [a for a in active if a[0] > r]
+            yield row
+    finally:
+        wb.close()
+
+
+def scan_xlsx_sheet_layout(path: str, sheet) -> Tuple[int, int, List[Tuple[int, int, int, int]]]:
+    """只读方式扫描单个工作表的 (max_row, max_col, 合并区域)，不解析单元格值"""
+    wb = load_workbook(path, data_only=True, read_only=True)
+    try:
+        ws = wb[wb.sheetnames[sheet]] if isinstance(sheet, int) else wb[sheet]
+        return _scan_sheet_layout_streaming(ws)
+    finally:
+        wb.close()
+
+
+_DIMENSION_RE = re.compile(rb'<(?:\w+:)?dimension\s+ref="[A-Z]+(\d+)(?::[A-Z]+(\d+))?"')
+
+
+def _read_xlsx_dimensions(path: str, head_bytes: int = 16384) -> Optional[Dict[str, int]]:
+    """
+    直接从 zip 读取各工作表 XML 开头的 <dimension>，得到 {sheet名: 行数}
+    不经过 load_workbook（只读模式也会完整解析共享字符串表），每个 sheet 只读开头几 KB
+    任一 sheet 缺少 dimension 或结构不标准时返回 None
+    """
+    import zipfile
+    import posixpath
+    from xml.etree import ElementTree as ET
+
+    try:
+        with zipfile.ZipFile(path) as zf:
+            rels = {el.get("Id"): el.get("Target")
+                    for el in ET.fromstring(zf.read("xl/_rels/workbook.xml.rels"))}
+            out = {}
+            for el in ET.fromstring(zf.read("xl/workbook.xml")).iter():
+                if el.tag.rsplit("}", 1)[-1] != "sheet":
+                    continue
+                rid = next((v for k, v in el.attrib.items() if k.rsplit("}", 1)[-1] == "id"), None)
+                target = rels.get(rid)
+                if not target:
+                    return None
+                member = target.lstrip("/") if target.startswith("/") else posixpath.normpath(
+                    posixpath.join("xl", target))
+                with zf.open(member) as f:
+                    m = _DIMENSION_RE.search(f.read(head_bytes))
+                if m is None:
+                    return None
+                out[el.get("name")] = int(m.group(2) or m.group(1))
+            return out
+    except (KeyError, OSError, zipfile.BadZipFile, ET.ParseError):
+        return None
+
+
+def probe_xlsx_sheet_rows(path: str) -> Dict[str, int]:
+    """
+    快速获取各工作表的行数，用于在完整加载之前判断是否需要走流式模式
+    优先读 zip 内各 sheet 记录的 <dimension>（不打开工作簿）；缺失时才以只读方式打开并扫描 XML
+    """
+    dims = _read_xlsx_dimensions(path)
+    if dims is not None:
+        return dims
+    wb = load_workbook(path, data_only=True, read_only=True)
+    try:
+        out = {}
+        for name in wb.sheetnames:
+            ws = wb[name]
+            out[name] = ws.max_row if ws.max_row is not None else _scan_sheet_layout_streaming(ws)[0]
+        return out
+    finally:
+        wb.close()
+
+
+def _norm_data_cell(x):
+    """data_rows 单元格规范化：去空白，空串/"null" 视为 None"""
+    if x is None: return None
+    s = str(x).strip()
+    return None if s == "" or s.lower() == "null" else s
+
+
+class StreamedRows:
+    """
+    超大工作表子表的 data_rows：不在内存中物化，每次迭代都从 xlsx 流式读取
+    （已展开合并单元格、已按 _norm_data_cell 规范化）
+    支持 len()、迭代、按块迭代；save_results 会按块直接写出
+    注意：不支持下标访问，且每次迭代都要重新打开工作簿、完整解析一遍 sheet XML，
+    调用方应尽量把多次遍历合并为一次（列画像一遍、收集关键信息一遍、写出一遍）
+    """
+
+    def __init__(self, path: str, sheet, start_row0: int, col_slice: Tuple[int, int],
+                 layout: Optional[Tuple] = None):
+        self.path = path
+        self.sheet = sheet
+        self.start_row0 = start_row0
+        self.col_slice = col_slice  # 0-based [s0, e0)
+        self.layout = layout or scan_xlsx_sheet_layout(path, sheet)
+
+    def __len__(self) -> int:
+        return max(0, self.layout[0] - self.start_row0)
+
+    def __iter__(self) -> Iterator[List]:
+        s0, e0 = self.col_slice
+        rows = iter_xlsx_rows_expand_merged(self.path, self.sheet, layout=self.layout)
+        for i, row in enumerate(rows):
+            if i < self.start_row0:
+                continue
+            yield [_norm_data_cell(x) for x in row[s0:e0]]
+
+    def iter_chunks(self, chunk_size: int) -> Iterator[List[List]]:
+        chunk = []
+        for row in self:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+# ---------- NEW: 工作簿句柄（整个文件只解析一次） ----------
+class XlsxWorkbook:
+    """
+    工作簿句柄：load_workbook 只调用一次，之后按需产出各工作表展开合并单元格后的 DataFrame
+    避免“列 sheet 名解析一次 + 每个 sheet 再解析一次”的 N+1 次全量解析
+
+    用法:
+        with XlsxWorkbook(path) as book:
+            for si, sname, df in book.iter_sheets():
+                ...
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.wb = load_workbook(path, data_only=True)
+
+    @property
+    def sheetnames(self) -> List[str]:
+        return list(self.wb.sheetnames)
+
+    def read_sheet(self, sheet) -> pd.DataFrame:
+        """按 sheet 名或序号读取工作表（已展开合并单元格）"""
+        ws = self.wb[self.wb.sheetnames[sheet]] if isinstance(sheet, int) else self.wb[sheet]
+        return _expand_merged_ws(ws)
+
+    def iter_sheets(self) -> Iterator[Tuple[int, str, pd.DataFrame]]:
+        """依次产出 (sheet序号(0-based), sheet名, DataFrame)"""
+        for si, sname in enumerate(self.wb.sheetnames):
+            yield si, sname, self.read_sheet(sname)
+
+    def close(self) -> None:
+        self.wb.close()
+
+    def __enter__(self) -> "XlsxWorkbook":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
 
 
 # ---------- NEW: DataFrame 转 markdown 预览行 ----------
@@ -190,12 +717,720 @@ def slice_df_columns(df: pd.DataFrame, col_range: List[int]) -> pd.DataFrame:
     return df.iloc[:, s0:e0]
 
 
+# ---------- NEW: 简单表规则预判 ----------
+_NUM_CELL_RE = re.compile(r"^[（(]?[-+−]?[¥$￥]?\d[\d,，]*(\.\d+)?%?[）)]?$")
+
+
+def _cell_kind(x) -> str:
+    """单元格类型：empty / num / date / text"""
+    if x is None or (isinstance(x, float) and np.isnan(x)):
+        return "empty"
+    if isinstance(x, bool):
+        return "text"
+    if isinstance(x, (int, float, np.integer, np.floating)):
+        return "num"
+    if isinstance(x, (datetime, pd.Timestamp)):
+        return "date"
+    s = str(x).strip()
+    if not s:
+        return "empty"
+    return "num" if _NUM_CELL_RE.match(s) else "text"
+
+
+def classify_simple_sheet(df: pd.DataFrame, sheet_id: str,
+                          merged_ranges: Optional[List[Tuple[int, int, int, int]]] = None,
+                          max_rows: int = 40) -> Optional[Dict]:
+    """
+    规则预判“简单表”：第一行是唯一表头行，表头无合并单元格、无重复/空列名，数据区各列类型一致，
+    且不存在左右并排子表的迹象（重复列名、整列空白的分隔列）。
+
+    Args:
+        df: 工作表（已展开合并单元格）
+        sheet_id: 表头结果中的 subtable_id
+        merged_ranges: 合并区域 (min_row, min_col, max_row, max_col)，1-based；None 表示未知
+        max_rows: 参与判断的预览行数
+
+    Returns:
+        不是简单表时返回 None；否则返回
+        {"header_pack": ..., "layout": ..., "confidence": float}，header_pack/layout 与 LLM 结果格式一致
+    """
+    nrows, ncols = df.shape
+    if nrows < 2 or ncols < 1:
+        return None
+    # 表头区域（前两行）不能有合并单元格
+    if any(r1 <= 2 for r1, _c1, _r2, _c2 in (merged_ranges or [])):
+        return None
+
+    view = df.iloc[:max_rows, :]
+    header = view.iloc[0].tolist()
+    kinds_header = [_cell_kind(x) for x in header]
+    # 表头每列都必须是非空文本
+    if any(k != "text" for k in kinds_header):
+        return None
+    names = [str(x).strip() for x in header]
+    if len(set(names)) != len(names):
+        return None
+
+    body = view.iloc[1:, :]
+    confidence = 1.0
+    numeric_cols = 0
+    for c in range(ncols):
+        kinds = [_cell_kind(x) for x in body.iloc[:, c].tolist()]
+        filled = [k for k in kinds if k != "empty"]
+        if not filled:
+            # 整列空白：可能是并排子表之间的分隔列
+            return None
+        dominant = max(set(filled), key=filled.count)
+        uniformity = filled.count(dominant) / len(filled)
+        if uniformity < 0.8:
+            return None
+        confidence -= (1.0 - uniformity) / ncols
+        if dominant == "num":
+            numeric_cols += 1
+            # 第一数据行在数值列上应为数值，否则更像第二级表头
+            if kinds[0] == "text":
+                return None
+    if numeric_cols == 0:
+        # 纯文本表无法用类型区分表头与数据，降低置信度
+        confidence -= 0.3
+    if len(body) < 3:
+        confidence -= 0.2
+
+    header_pack = {
+        "subtable_id": sheet_id,
+        "header_rows": 1,
+        "header_lines": [names],
+        "data_start_line": 2,
+        "resolved_headers": names,
+        "column_count": ncols,
+        "confidence": round(max(0.0, confidence), 4),
+    }
+    layout = {"is_composite": False, "subtables": [{"id": "T1", "name": "", "col_range": [1, ncols]}]}
+    return {"header_pack": header_pack, "layout": layout, "confidence": header_pack["confidence"]}
+
+
+# ---------- NEW: 列类型画像（向量化，一次扫描得到各列 数值/日期/文本/空 占比） ----------
+_TEXTINESS_NUM_PATTERN = r'[-+]?\d{1,3}(?:,\d{3})*(?:\.\d+)?%?'  # “数值/百分比/会计格式”，文本密度与噪声过滤共用
+_TEXTINESS_NUM_RE = re.compile(_TEXTINESS_NUM_PATTERN)
+_ALPHA_PATTERN = r'[\u4e00-\u9fa5A-Za-z]'
+_DATE_CELL_PATTERN = (r'^\d{4}(?:[-/.年]\d{1,2}(?:[-/.月]\d{1,2}日?)?月?|年度?)'
+                      r'(?:\s+\d{1,2}:\d{2}(?::\d{2})?)?$')
+
+
+def _profile_chunk(rows) -> Tuple[int, Dict[str, np.ndarray]]:
+    """统计一批行里每列的 非空/数值/日期/文本密度 计数（所有列拼成一个 Series 一次性做字符串运算）"""
+    frame = pd.DataFrame(rows)
+    nrows, ncols = frame.shape
+    if not nrows or not ncols:
+        return 0, {}
+    flat = pd.Series(frame.to_numpy(dtype=object).ravel(order="F")).fillna("").astype(str).str.strip()
+    filled = (flat != "").to_numpy()
+    texty_num = flat.str.fullmatch(_TEXTINESS_NUM_PATTERN).to_numpy()
+    alpha = flat.str.contains(_ALPHA_PATTERN, regex=True).to_numpy()
+    numeric = flat.str.match(_NUM_CELL_RE.pattern).to_numpy()
+    date = flat.str.match(_DATE_CELL_PATTERN).to_numpy()
+
+    def per_col(mask):
+        return mask.reshape((ncols, nrows)).sum(axis=1)
+
+    return nrows, {
+        "filled": per_col(filled),
+        "numeric": per_col(filled & numeric),
+        "date": per_col(filled & date & ~numeric),
+        "texty": per_col(filled & ~texty_num & alpha),
+    }
+
+
+def profile_columns(rows, chunk_size: int = 5000) -> pd.DataFrame:
+    """
+    列类型画像：对 data_rows（list 或 StreamedRows）按块向量化统计，每列一行
+
+    Returns:
+        DataFrame(index=列序号, columns=[filled, empty_ratio, numeric_ratio, date_ratio, text_ratio, textiness])
+        各 ratio 以非空单元格数为分母（empty_ratio 以总行数为分母）；
+        textiness 为非空单元格中“非数值且含中文/字母”的占比（越接近 1 越像名称列）
+    """
+    chunks = rows.iter_chunks(chunk_size) if isinstance(rows, StreamedRows) else (
+        rows[i:i + chunk_size] for i in range(0, len(rows or []), chunk_size))
+    total = 0
+    acc: Dict[str, np.ndarray] = {}
+    for chunk in chunks:
+        n, counts = _profile_chunk(chunk)
+        total += n
+        for k, v in counts.items():
+            cur = acc.get(k, np.zeros(0, dtype=np.int64))
+            if len(cur) < len(v):
+                cur = np.pad(cur, (0, len(v) - len(cur)))
+            cur[:len(v)] += v
+            acc[k] = cur
+    if not acc:
+        return pd.DataFrame(columns=["filled", "empty_ratio", "numeric_ratio", "date_ratio", "text_ratio", "textiness"])
+    filled = acc["filled"]
+    denom = np.maximum(filled, 1)
+    numeric_ratio = acc["numeric"] / denom
+    date_ratio = acc["date"] / denom
+    return pd.DataFrame({
+        "filled": filled,
+        "empty_ratio": 1.0 - filled / max(total, 1),
+        "numeric_ratio": numeric_ratio,
+        "date_ratio": date_ratio,
+        "text_ratio": np.where(filled > 0, 1.0 - numeric_ratio - date_ratio, 0.0),
+        "textiness": acc["texty"] / denom,
+    })
+
+
+class ColumnStats:
+    """
+    子表列统计：构造时一次扫描 data_rows 得到全部列的画像（profile_columns），
+    之后 textiness / 各类占比按列号查询都是 O(1)，不再按 角色 × 列 重复扫描
+    """
+
+    def __init__(self, profile: pd.DataFrame):
+        self.profile = profile
+        self._fields = {f: profile[f].to_numpy(dtype=float) for f in profile.columns}
+        self.ncols = len(profile)
+
+    @classmethod
+    def from_rows(cls, rows, chunk_size: int = 5000) -> "ColumnStats":
+        return cls(profile_columns(rows, chunk_size))
+
+    def get(self, col, field: str) -> float:
+        """按列号取画像字段；越界/非法列号视为空列"""
+        try:
+            c = int(col)
+        except (TypeError, ValueError):
+            return 0.0
+        return float(self._fields[field][c]) if 0 <= c < self.ncols else 0.0
+
+
+_TIME_HEADER_RE = re.compile(r"\d{4}|年|月|日|期末|期初|本期|上期|季度|时间|日期")
+# 序号/编号类列名：列值虽是数字，但属于 id 而非 value
+_ID_HEADER_RE = re.compile(r"序号|编号|注释|^\s*(No\.?|#)\s*$", re.IGNORECASE)
+
+
+# =========================
+# LLM HTTP 连接池（进程内共享）
+# =========================
+_HTTP_CLIENT: Optional[httpx.Client] = None
+_HTTP_CLIENT_LOCK = threading.Lock()
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def get_http_client(s: Optional[Settings] = None) -> httpx.Client:
+    """
+    获取进程内共享的 httpx.Client（长连接 + 连接池）
+    首次调用时按 Settings 创建，之后所有 LLMClient / MultiHeaderTableExtractor 复用同一个连接池
+    """
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is not None and not _HTTP_CLIENT.is_closed:
+        return _HTTP_CLIENT
+    with _HTTP_CLIENT_LOCK:
+        if _HTTP_CLIENT is None or _HTTP_CLIENT.is_closed:
+            s = s or settings
+            limits = httpx.Limits(
+                max_connections=s.LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=s.LLM_MAX_KEEPALIVE,
+                keepalive_expiry=s.LLM_KEEPALIVE_EXPIRY_S,
+            )
+            _HTTP_CLIENT = httpx.Client(
+                timeout=s.TIMEOUT_S,
+                limits=limits,
+                http2=bool(s.LLM_HTTP2 and _http2_available()),
+            )
+    return _HTTP_CLIENT
+
+
+def close_http_client() -> None:
+    """关闭共享连接池（服务关闭时调用，可重复调用）"""
+    global _HTTP_CLIENT
+    with _HTTP_CLIENT_LOCK:
+        if _HTTP_CLIENT is not None:
+            _HTTP_CLIENT.close()
+            _HTTP_CLIENT = None
+
+
+atexit.register(close_http_client)
+
+
+# 异步客户端与事件循环绑定，每个事件循环一个（循环结束后自动释放引用）
+_ASYNC_HTTP_CLIENTS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+
+
+def get_async_http_client(s: Optional[Settings] = None) -> httpx.AsyncClient:
+    """获取当前事件循环共享的 httpx.AsyncClient（连接池配置与同步客户端一致）"""
+    loop = asyncio.get_running_loop()
+    client = _ASYNC_HTTP_CLIENTS.get(loop)
+    if client is None or client.is_closed:
+        s = s or settings
+        client = httpx.AsyncClient(
+            timeout=_request_timeout(s),
+            limits=httpx.Limits(
+                max_connections=s.LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=s.LLM_MAX_KEEPALIVE,
+                keepalive_expiry=s.LLM_KEEPALIVE_EXPIRY_S,
+            ),
+            http2=bool(s.LLM_HTTP2 and _http2_available()),
+        )
+        _ASYNC_HTTP_CLIENTS[loop] = client
+    return client
+
+
+async def aclose_http_client() -> None:
+    """关闭当前事件循环的异步连接池（在该循环内调用，可重复调用）"""
+    loop = asyncio.get_running_loop()
+    client = _ASYNC_HTTP_CLIENTS.pop(loop, None)
+    if client is not None:
+        await client.aclose()
+
+
+def _request_timeout(s: Settings) -> httpx.Timeout:
+    """单请求超时：读/写/池等待用 LLM_CALL_TIMEOUT_S，建连用 LLM_CONNECT_TIMEOUT_S"""
+    return httpx.Timeout(s.LLM_CALL_TIMEOUT_S, connect=s.LLM_CONNECT_TIMEOUT_S)
+
+
+# =========================
+# LLM 限流（按提供方：并发信号量 + 令牌桶，进程内共享）
+# =========================
+class ProviderLimiter:
+    """
+    单个提供方的限流器
+    - 令牌桶：按 rate_per_s 匀速补充，容量 burst；同步/异步调用共用同一个桶
+    - 并发：同步/异步调用共用同一个 threading 信号量（异步调用非阻塞轮询获取，不占用事件循环），
+      多个任务、多个事件循环之间的并发上限是同一个
+    """
+
+    def __init__(self, max_concurrency: int = 4, rate_per_s: float = 0.0, burst: float = 1):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.rate_per_s = float(rate_per_s or 0.0)
+        self.burst = max(1.0, float(burst or 1))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+        self._sem = threading.BoundedSemaphore(self.max_concurrency)
+
+    def _reserve(self) -> float:
+        """预留一个令牌，返回需要等待的秒数（令牌允许透支，等待时间即为还清透支所需时间）"""
+        if self.rate_per_s <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate_per_s)
+            self._last = now
+            self._tokens -= 1.0
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate_per_s
+
+    def acquire(self) -> None:
+        self._sem.acquire()
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def release(self) -> None:
+        self._sem.release()
+
+    async def aacquire(self, poll_s: float = 0.02) -> None:
+        while not self._sem.acquire(blocking=False):
+            await asyncio.sleep(poll_s)
+        wait = self._reserve()
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except BaseException:  # 等待令牌时被取消，归还并发名额
+                self._sem.release()
+                raise
+
+    def arelease(self) -> None:
+        self._sem.release()
+
+
+_PROVIDER_LIMITERS: Dict[str, ProviderLimiter] = {}
+_PROVIDER_LIMITERS_LOCK = threading.Lock()
+
+
+def get_provider_limiter(provider: str, s: Optional[Settings] = None) -> ProviderLimiter:
+    """按提供方取进程内共享的限流器，配置见 Settings.LLM_PROVIDER_LIMITS"""
+    lim = _PROVIDER_LIMITERS.get(provider)
+    if lim is None:
+        with _PROVIDER_LIMITERS_LOCK:
+            lim = _PROVIDER_LIMITERS.get(provider)
+            if lim is None:
+                s = s or settings
+                cfg = {**s.LLM_DEFAULT_LIMITS, **(s.LLM_PROVIDER_LIMITS.get(provider) or {})}
+                lim = _PROVIDER_LIMITERS[provider] = ProviderLimiter(**cfg)
+    return lim
+
+
+_RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After 头：秒数或 HTTP 日期；无法解析返回 None"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        dt = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return max(0.0, (dt - datetime.now(timezone.utc)).total_seconds())
+
+
+def _retry_delay(s: Settings, attempt: int, resp: Optional[httpx.Response] = None) -> float:
+    """第 attempt 次（从 0 开始）失败后的等待时间：优先 Retry-After，否则指数退避 + 抖动"""
+    if resp is not None:
+        ra = _parse_retry_after(resp.headers.get("Retry-After"))
+        if ra is not None:
+            return min(ra, s.LLM_BACKOFF_MAX_S)
+    backoff = min(s.LLM_BACKOFF_MAX_S, s.LLM_BACKOFF_BASE_S * (2 ** attempt))
+    return backoff * (0.5 + random.random() / 2)
+
+
+# =========================
+# LLM 响应缓存（按 模型/提供方/提示词 内容寻址，落盘）
+# =========================
+class LLMResponseCache:
+    """
+    LLM 响应磁盘缓存
+    - key = sha256(provider, model_id, system_prompt, prompt)，相同提示词直接命中
+    - 每条记录一个文件：{cache_dir}/{key[:2]}/{key}.json，写入采用临时文件 + 原子替换
+    - 读取时按 TTL 判断过期；写入后总大小超过上限时按最近访问时间淘汰
+    """
+
+    def __init__(self, cache_dir: str, ttl_s: int = 0, max_bytes: int = 0):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.ttl_s = ttl_s
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._total_bytes: Optional[int] = None  # 首次写入时扫描目录得到
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(provider: str, model_id: str, prompt: str, system_prompt: str = "") -> str:
+        raw = json.dumps([provider, model_id, system_prompt, prompt], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _expired(self, mtime: float) -> bool:
+        return bool(self.ttl_s) and (datetime.now().timestamp() - mtime) > self.ttl_s
+
+    def get(self, key: str) -> Optional[Dict]:
+        path = self._path(key)
+        try:
+            st = os.stat(path)
+            if self._expired(st.st_mtime):
+                self._remove(path, st.st_size)
+                raise FileNotFoundError(path)
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f).get("response")
+            # 刷新访问时间（atime），用于按最近访问淘汰；mtime 保留为写入时间供 TTL 判断
+            os.utime(path, (datetime.now().timestamp(), st.st_mtime))
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key: str, response: Dict, provider: str = "", model_id: str = "") -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        body = json.dumps({
+            "provider": provider,
+            "model_id": model_id,
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "response": response,
+        }, ensure_ascii=False)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(body)
+        os.replace(tmp, path)
+
+        need_prune = False
+        with self._lock:
+            self.writes += 1
+            if self._total_bytes is not None:
+                self._total_bytes += len(body.encode("utf-8"))
+            if self.max_bytes and (self._total_bytes is None or self._total_bytes > self.max_bytes):
+                need_prune = True
+        if need_prune:
+            self.prune()
+
+    def _remove(self, path: str, size: int) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            self.evictions += 1
+            if self._total_bytes is not None:
+                self._total_bytes -= size
+
+    def prune(self) -> None:
+        """删除过期记录；总大小仍超过上限时，按最近访问时间从旧到新淘汰至上限的 90%"""
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for fn in files:
+                if not fn.endswith(".json"):
+                    continue
+                p = os.path.join(root, fn)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                if self._expired(st.st_mtime):
+                    self._remove(p, 0)
+                    continue
+                entries.append((st.st_atime, st.st_size, p))
+                total += st.st_size
+
+        if self.max_bytes and total > self.max_bytes:
+            target = int(self.max_bytes * 0.9)
+            entries.sort()
+            for _, size, p in entries:
+                if total <= target:
+                    break
+                self._remove(p, 0)
+                total -= size
+
+        with self._lock:
+            self._total_bytes = total
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "total_bytes": self._total_bytes,
+            }
+
+
+_LLM_CACHES: Dict[str, LLMResponseCache] = {}
+_LLM_CACHES_LOCK = threading.Lock()
+
+
+def get_llm_cache(s: Optional[Settings] = None) -> LLMResponseCache:
+    """按缓存目录获取进程内共享的 LLMResponseCache（命中计数在进程内累计）"""
+    s = s or settings
+    cache_dir = os.path.abspath(s.LLM_CACHE_DIR)
+    with _LLM_CACHES_LOCK:
+        cache = _LLM_CACHES.get(cache_dir)
+        if cache is None:
+            cache = LLMResponseCache(cache_dir, ttl_s=s.LLM_CACHE_TTL_S,
+                                     max_bytes=s.LLM_CACHE_MAX_MB * 1024 * 1024)
+            _LLM_CACHES[cache_dir] = cache
+    return cache
+
+
+_TABLE_SYSTEM_PROMPT = "You are an expert at document tables: detect titles, units, dates, composite layout, and multi-level headers. Output JSON only."
+
+
+# =========================
+# LLM 提供方注册表
+# =========================
+class LLMProvider(ABC):
+    """
+    LLM 提供方基类：负责拼请求 / 解析响应，HTTP 发送、限流与重试由 LLMClient 统一处理
+    新增提供方时继承本类（不走 HTTP 的继承 OfflineLLMProvider）并用 register_llm_provider 注册
+    """
+    name = ""
+    offline = False  # True 表示不走 HTTP，直接调用 complete
+
+    def __init__(self, s: Settings):
+        self.s = s
+
+    def default_model(self) -> str:
+        return self.s.MODEL_ID
+
+    @abstractmethod
+    def build_request(self, prompt: str, model_id: str) -> Tuple[str, Dict, Dict]:
+        """返回 (url, headers, json 请求体)"""
+
+    @abstractmethod
+    def parse_response(self, data: Dict) -> str:
+        """从响应 JSON 中取出模型输出的文本"""
+
+
+class OfflineLLMProvider(LLMProvider):
+    """不走 HTTP 的提供方：LLMClient 直接调用 complete，响应不入缓存"""
+    offline = True
+
+    @abstractmethod
+    def complete(self, prompt: str, model_id: str) -> str:
+        """直接返回模型输出的文本"""
+
+    def build_request(self, prompt: str, model_id: str) -> Tuple[str, Dict, Dict]:
+        raise TypeError(f"离线提供方 {self.name} 不发送 HTTP 请求")
+
+    def parse_response(self, data: Dict) -> str:
+        raise TypeError(f"离线提供方 {self.name} 不解析 HTTP 响应")
+
+
+class OpenAICompatibleProvider(LLMProvider):
+    """OpenAI 兼容的 /chat/completions 接口（OpenAI、vLLM、各类网关）"""
+    name = "openai"
+
+    def _base_url(self) -> str:
+        return self.s.OPENAI_BASE_URL
+
+    def _api_key(self) -> Optional[str]:
+        return self.s.OPENAI_API_KEY
+
+    def default_model(self) -> str:
+        return self.s.OPENAI_MODEL_ID
+
+    def build_request(self, prompt: str, model_id: str) -> Tuple[str, Dict, Dict]:
+        url = f"{self._base_url().rstrip('/')}/chat/completions"
+        headers = {"Content-Type": "application/json"}
+        if self._api_key():
+            headers["Authorization"] = f"Bearer {self._api_key()}"
+        payload = {
+            "model": model_id,
+            "messages": [
+                {"role": "system", "content": _TABLE_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt},
+            ],
+            "stream": False,
+            "response_format": {"type": "json_object"},
+            "temperature": 0.1,
+        }
+        return url, headers, payload
+
+    def parse_response(self, data: Dict) -> str:
+        return (data["choices"][0]["message"].get("content") or "").strip()
+
+
+class DeepSeekProvider(OpenAICompatibleProvider):
+    name = "deepseek"
+
+    def _base_url(self) -> str:
+        return self.s.DEEPSEEK_BASE_URL
+
+    def _api_key(self) -> Optional[str]:
+        return self.s.DEEPSEEK_API_KEY
+
+    def default_model(self) -> str:
+        return self.s.MODEL_ID if self.s.MODEL_PROVIDER == self.name else "deepseek-chat"
+
+    def build_request(self, prompt: str, model_id: str) -> Tuple[str, Dict, Dict]:
+        url, headers, payload = super().build_request(prompt, model_id)
+        payload.pop("temperature", None)
+        if model_id == "deepseek-chat":
+            payload.update({"temperature": 0.1, "top_p": 0.95})
+        return url, headers, payload
+
+    def parse_response(self, data: Dict) -> str:
+        msg = data["choices"][0]["message"]
+        content = (msg.get("content") or "").strip()
+        if not content and msg.get("reasoning_content"):
+            m = re.search(r"\{[\s\S]*\}", msg["reasoning_content"])
+            if m: content = m.group(0)
+        return content
+
+
+class OllamaProvider(LLMProvider):
+    """本地 Ollama（/api/chat，format=json）"""
+    name = "ollama"
+
+    def default_model(self) -> str:
+        return self.s.OLLAMA_MODEL_ID
+
+    def build_request(self, prompt: str, model_id: str) -> Tuple[str, Dict, Dict]:
+        url = f"{(self.s.OLLAMA_BASE_URL or 'http://localhost:11434').rstrip('/')}/api/chat"
+        payload = {
+            "model": model_id,
+            "messages": [
+                {"role": "system", "content": _TABLE_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt},
+            ],
+            "stream": False,
+            "format": "json",
+            "options": {"temperature": 0.1, "num_predict": self.s.LLM_MAX_PREDICT},
+        }
+        return url, {"Content-Type": "application/json"}, payload
+
+    def parse_response(self, data: Dict) -> str:
+        return ((data.get("message") or {}).get("content") or "").strip()
+
+
+class StubProvider(OfflineLLMProvider):
+    """
+    确定性本地桩：不发请求，固定返回 LLM_STUB_RESPONSE
+    用于离线调试 / 回归对比，各步骤会走各自的兜底逻辑
+    """
+    name = "stub"
+
+    def default_model(self) -> str:
+        return "stub"
+
+    def complete(self, prompt: str, model_id: str) -> str:
+        return self.s.LLM_STUB_RESPONSE
+
+
+class UnregisteredProvider(OfflineLLMProvider):
+    """
+    MODEL_PROVIDER / LLM_STEP_PROVIDERS 指向未注册的提供方（如 gemini）时的占位：
+    与旧版行为一致，不发请求、返回空响应，各步骤走兜底逻辑（不注册到 LLM_PROVIDERS）
+    """
+
+    def __init__(self, s: Settings, name: str):
+        super().__init__(s)
+        self.name = name
+
+    def complete(self, prompt: str, model_id: str) -> str:
+        return ""
+
+
+LLM_PROVIDERS: Dict[str, type] = {}
+
+
+def register_llm_provider(cls: type) -> type:
+    """注册提供方（可作装饰器使用），按 cls.name 索引"""
+    LLM_PROVIDERS[cls.name] = cls
+    return cls
+
+
+for _cls in (DeepSeekProvider, OpenAICompatibleProvider, OllamaProvider, StubProvider):
+    register_llm_provider(_cls)
+
+
 # =========================
 # LLM 客户端（与你现有的一致）
 # =========================
 class LLMClient:
-    def __init__(self, s: Settings):
+    def __init__(self, s: Settings, use_cache: Optional[bool] = None):
+        """
+        Args:
+            s: 配置
+            use_cache: 是否使用 LLM 响应缓存；None 表示跟随 Settings.LLM_CACHE_ENABLED
+        """
         self.s = s
+        self.use_cache = s.LLM_CACHE_ENABLED if use_cache is None else use_cache
+        self._providers: Dict[str, LLMProvider] = {}
 
     def _clean_json_response(self, response: str) -> str:
         import re
@@ -207,50 +1442,166 @@ class LLMClient:
         m = re.search(r'```\s*(.*?)\s*```', response, re.DOTALL)
         return m.group(1) if m else response
 
-    def _call_deepseek(self, prompt: str) -> str:
-        base = self.s.DEEPSEEK_BASE_URL.rstrip("/")
-        url = f"{base}/chat/completions"
-        headers = {"Authorization": f"Bearer {self.s.DEEPSEEK_API_KEY}", "Content-Type": "application/json"}
-        payload = {
-            "model": self.s.MODEL_ID,
-            "messages": [
-                {"role": "system", "content":
-                    "You are an expert at document tables: detect titles, units, dates, composite layout, and multi-level headers. Output JSON only."},
-                {"role": "user", "content": prompt},
-            ],
-            "stream": False,
-            "response_format": {"type": "json_object"},
-        }
-        if self.s.MODEL_ID == "deepseek-chat":
-            payload.update({"temperature": 0.1, "top_p": 0.95})
-        with httpx.Client(timeout=self.s.TIMEOUT_S) as client:
-            resp = client.post(url, headers=headers, json=payload)
-            resp.raise_for_status()
-            data = resp.json()
-            msg = data["choices"][0]["message"]
-            content = (msg.get("content") or "").strip()
-            if not content and msg.get("reasoning_content"):
-                import re
-                m = re.search(r"\{[\s\S]*\}", msg["reasoning_content"])
-                if m: content = m.group(0)
-            return content
-
-    def call(self, prompt: str) -> Dict:
-        raw = self._call_deepseek(prompt) if self.s.MODEL_PROVIDER == "deepseek" else ""
+    def _provider(self, name: str) -> LLMProvider:
+        p = self._providers.get(name)
+        if p is None:
+            cls = LLM_PROVIDERS.get(name)
+            if cls is None:
+                print(f"⚠️ 未注册的 LLM 提供方: {name}（可选: {', '.join(sorted(LLM_PROVIDERS))}），"
+                      f"不调用 LLM，各步骤按空响应兜底")
+                p = self._providers[name] = UnregisteredProvider(self.s, name)
+            else:
+                p = self._providers[name] = cls(self.s)
+        return p
+
+    def resolve_route(self, step: Optional[str] = None) -> Tuple[LLMProvider, str]:
+        """
+        按步骤选择提供方与模型：LLM_STEP_PROVIDERS[step] 形如 "provider" 或 "provider:model"
+        未配置的步骤使用 MODEL_PROVIDER / MODEL_ID
+        """
+        spec = (self.s.LLM_STEP_PROVIDERS.get(step) if step else None) or self.s.MODEL_PROVIDER
+        name, _, model_id = spec.partition(":")
+        provider = self._provider(name.strip())
+        if not model_id:
+            model_id = self.s.MODEL_ID if provider.name == self.s.MODEL_PROVIDER else provider.default_model()
+        return provider, model_id.strip()
+
+    def _should_retry(self, attempt: int, deadline: float, resp: Optional[httpx.Response] = None) -> Optional[float]:
+        """同步/异步共用的重试判定：返回等待秒数，None 表示不再重试"""
+        if attempt >= self.s.LLM_MAX_RETRIES:
+            return None
+        if resp is not None and resp.status_code not in _RETRYABLE_STATUS:
+            return None
+        delay = _retry_delay(self.s, attempt, resp)
+        if time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+    def _call_provider(self, provider: LLMProvider, model_id: str, prompt: str) -> str:
+        if provider.offline:
+            return provider.complete(prompt, model_id)
+        url, headers, payload = provider.build_request(prompt, model_id)
+        limiter = get_provider_limiter(provider.name, self.s)
+        deadline = time.monotonic() + self.s.TIMEOUT_S
+        attempt = 0
+        while True:
+            limiter.acquire()
+            try:
+                # 复用共享连接池，避免每次调用都重新建立 TCP/TLS 连接
+                resp = get_http_client(self.s).post(url, headers=headers, json=payload,
+                                                    timeout=_request_timeout(self.s))
+            except httpx.TransportError:
+                delay = self._should_retry(attempt, deadline)
+                if delay is None:
+                    raise
+            else:
+                if resp.is_success:
+                    return provider.parse_response(resp.json())
+                delay = self._should_retry(attempt, deadline, resp)
+                if delay is None:
+                    resp.raise_for_status()
+                print(f"⚠️ LLM 请求返回 {resp.status_code}，{delay:.1f}s 后重试（第 {attempt + 1} 次）")
+            finally:
+                limiter.release()
+            time.sleep(delay)
+            attempt += 1
+
+    async def _acall_provider(self, provider: LLMProvider, model_id: str, prompt: str) -> str:
+        if provider.offline:
+            return provider.complete(prompt, model_id)
+        url, headers, payload = provider.build_request(prompt, model_id)
+        limiter = get_provider_limiter(provider.name, self.s)
+        deadline = time.monotonic() + self.s.TIMEOUT_S
+        attempt = 0
+        while True:
+            await limiter.aacquire()
+            try:
+                resp = await get_async_http_client(self.s).post(url, headers=headers, json=payload,
+                                                                timeout=_request_timeout(self.s))
+            except httpx.TransportError:
+                delay = self._should_retry(attempt, deadline)
+                if delay is None:
+                    raise
+            else:
+                if resp.is_success:
+                    return provider.parse_response(resp.json())
+                delay = self._should_retry(attempt, deadline, resp)
+                if delay is None:
+                    resp.raise_for_status()
+                print(f"⚠️ LLM 请求返回 {resp.status_code}，{delay:.1f}s 后重试（第 {attempt + 1} 次）")
+            finally:
+                limiter.arelease()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def _cache_lookup(self, prompt: str, use_cache: Optional[bool], provider: LLMProvider,
+                      model_id: str) -> Tuple[Optional[LLMResponseCache], str, Optional[Dict]]:
+        use_cache = self.use_cache if use_cache is None else use_cache
+        # 桩提供方的结果不入缓存，避免污染真实模型的缓存
+        cache = get_llm_cache(self.s) if use_cache and not provider.offline else None
+        if cache is None:
+            return None, "", None
+        key = LLMResponseCache.make_key(provider.name, model_id, prompt, _TABLE_SYSTEM_PROMPT)
+        return cache, key, cache.get(key)
+
+    def _parse_and_store(self, raw: str, cache: Optional[LLMResponseCache], key: str,
+                         provider: LLMProvider, model_id: str) -> Dict:
         cleaned = self._clean_json_response(raw)
         try:
-            return json.loads(cleaned)
+            data = json.loads(cleaned)
         except Exception:
             return {}
+        # 只缓存解析成功的非空结果，失败的响应下次仍会重新请求
+        if cache is not None and data:
+            cache.put(key, data, provider=provider.name, model_id=model_id)
+        return data
+
+    def call(self, prompt: str, use_cache: Optional[bool] = None, step: Optional[str] = None) -> Dict:
+        """
+        调用 LLM 并解析 JSON；优先查询响应缓存
+
+        Args:
+            prompt: 提示词
+            use_cache: 本次调用是否使用缓存；None 表示跟随客户端设置，False 可单次绕过缓存
+            step: 步骤名（title / headers / layout / sheet_analysis / key_columns），用于按步骤路由提供方
+        """
+        provider, model_id = self.resolve_route(step)
+        cache, key, cached = self._cache_lookup(prompt, use_cache, provider, model_id)
+        if cached is not None:
+            return cached
+        raw = self._call_provider(provider, model_id, prompt)
+        return self._parse_and_store(raw, cache, key, provider, model_id)
+
+    async def acall(self, prompt: str, use_cache: Optional[bool] = None, step: Optional[str] = None) -> Dict:
+        """
+        call 的异步版本：共享同一份缓存、提供方限流器与重试策略，适合多个任务并发共用一个配额
+
+        Args:
+            prompt: 提示词
+            use_cache: 同 call
+            step: 同 call
+        """
+        provider, model_id = self.resolve_route(step)
+        # 缓存读写是阻塞的文件 I/O，放到线程里执行，不阻塞事件循环
+        cache, key, cached = await asyncio.to_thread(self._cache_lookup, prompt, use_cache, provider, model_id)
+        if cached is not None:
+            return cached
+        raw = await self._acall_provider(provider, model_id, prompt)
+        return await asyncio.to_thread(self._parse_and_store, raw, cache, key, provider, model_id)
 
 
 # =========================
 # 主解析器（新增 xlsx 分支）
 # =========================
 class MultiHeaderTableExtractor:
-    def __init__(self):
-        self.s = settings
-        self.llm = LLMClient(self.s)
+    def __init__(self, use_llm_cache: Optional[bool] = None, s: Optional[Settings] = None):
+        """
+        Args:
+            use_llm_cache: 是否使用 LLM 响应缓存；None 表示跟随配置
+            s: 任务配置（见 make_job_settings）；None 表示全局 settings。解析过程只读取 self.s，不修改全局配置
+        """
+        self.s = s or settings
+        self.llm = LLMClient(self.s, use_cache=use_llm_cache)
 
     # def _get_context_before(self, lines: List[str], table_start_idx: int) -> Dict:
     #     """
@@ -297,72 +1648,47 @@ class MultiHeaderTableExtractor:
     #         "numbered": _add_line_numbers(window_lines, actual_begin)
     #     }
 
-    def _get_context_before(self, lines: List[str], table_start_idx: int) -> Dict:
+    def _get_context_before(self, lines: List[str], table_start_idx: int,
+                            index: Optional[DocumentLineIndex] = None) -> Dict:
         """
         获取表格之前的上下文，智能跳过连续的xlsx文件引用
         优化：当遇到连续的xlsx文件时，继续向上查找共同的标题
+        index 为整篇文档的行索引（extract_from_xlsx_mentions 中只建一次），两个阶段都是查表/二分，不再逐行正则扫描
         """
+        if index is None:
+            index = DocumentLineIndex(lines)
         end = max(table_start_idx - 1, 0)
         max_lines = self.s.TITLE_CONTEXT_LINES
         max_chars = self.s.TITLE_CONTEXT_CHARS
         theoretical_begin = max(0, end - max_lines + 1)
 
         # 第一阶段：向上跳过连续的xlsx文件和空行
-        # 目的：找到最近的"有实质内容"的行
-        i = end
-        while i >= theoretical_begin:
-            if i < 0:
-                break
-            if i >= len(lines):
-                i -= 1
-                continue
-
-            # 跳过当前表格所在行
-            if i == table_start_idx:
-                i -= 1
-                continue
-
-            line = lines[i].strip()
-
-            # 如果是xlsx文件行或空行，继续向上跳过
-            if _XLSX_RE.search(lines[i]) or not line:
-                i -= 1
-                continue
-
-            # 遇到有内容的行，停止跳过
-            break
+        # 目的：找到最近的"有实质内容"的行（表格所在行本身不算）
+        i = index.last_content_at_or_before(end) if table_start_idx > 0 else -1
+        if i < theoretical_begin:
+            # 窗口内全是 xlsx 行/空行
+            i = theoretical_begin - 1
 
         # i 现在指向最近的有内容的非xlsx行
         context_end = max(i, 0)
 
         # 第二阶段：从有内容的行开始，正常向上查找上下文
         # 遇到更早的xlsx文件时才停止（说明是其他表格的区域）
-        actual_begin = context_end + 1
-
-        for j in range(context_end, max(0, context_end - max_lines + 1) - 1, -1):
-            if j < 0:
-                actual_begin = 0
-                break
-
-            if j >= len(lines):
-                actual_begin = max(0, j)
-                continue
-
+        lower = max(0, context_end - max_lines + 1)
+        if lower > context_end:
+            actual_begin = context_end + 1
+        else:
             # 如果遇到xlsx文件（且不在刚才跳过的连续区域内），说明到了其他表格区域，停止
-            if _XLSX_RE.search(lines[j]) and j < end - 1:
-                actual_begin = j + 1
-                break
-
-            actual_begin = j
+            stop = index.last_mention_in(lower, min(context_end, end - 2))
+            actual_begin = stop + 1 if stop is not None else lower
 
         # 确保范围有效
         actual_begin = max(0, min(actual_begin, context_end + 1))
         window_lines = lines[actual_begin:context_end + 1]
 
         # 处理字符长度限制
-        joined = "\n".join(window_lines)
-        if len(joined) > max_chars:
-            joined = joined[-max_chars:]
+        if index.joined_len(actual_begin, context_end) > max_chars:
+            joined = "\n".join(window_lines)[-max_chars:]
             tmp = joined.split("\n")
             if len(tmp) > 1 and not joined.startswith(tmp[0]):
                 tmp = tmp[1:]
@@ -378,6 +1704,47 @@ class MultiHeaderTableExtractor:
 
 
     def _infer_title_from_context(self, ctx: Dict) -> Dict:
+        prompt = self._title_prompt(ctx)
+        print('【表格标题/时间/单位抽取】')
+        print(prompt)
+        data = self.llm.call(prompt, step="title")
+        print('抽取结果：', data)
+        return self._title_result(data)
+
+    async def _ainfer_title_from_context(self, ctx: Dict) -> Dict:
+        """_infer_title_from_context 的异步版本（LLMClient.acall）"""
+        prompt = self._title_prompt(ctx)
+        print('【表格标题/时间/单位抽取】')
+        print(prompt)
+        data = await self.llm.acall(prompt, step="title")
+        print('抽取结果：', data)
+        return self._title_result(data)
+
+    def _infer_titles(self, ctxs: List[Dict]) -> List[Dict]:
+        """
+        批量推断标题/时间/单位，结果顺序与 ctxs 一致
+        所有请求在一个事件循环里并发发出，并发数与速率由提供方限流器控制；
+        当前线程已有运行中的事件循环时（无法 asyncio.run）退回线程池 + 同步调用
+        """
+        if not ctxs:
+            return []
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            return self._map_concurrent(self._infer_title_from_context, ctxs)
+
+        async def run_all() -> List[Dict]:
+            try:
+                return list(await asyncio.gather(*(self._ainfer_title_from_context(c) for c in ctxs)))
+            finally:
+                # 异步连接池与本次事件循环绑定，循环结束前关闭
+                await aclose_http_client()
+
+        return asyncio.run(run_all())
+
+    def _title_prompt(self, ctx: Dict) -> str:
         numbered = "\n".join(ctx.get("numbered", []))
         prompt = f"""
         你是"表格标题/时间/单位抽取助手"。下面是表格**之前**的原文片段（每行前有 Lxxx 行号）。
@@ -436,12 +1803,11 @@ class MultiHeaderTableExtractor:
         片段（带行号）：
         {numbered}
         """.strip()
+        return prompt
 
-        print('【表格标题/时间/单位抽取】')
-        print(prompt)
-        data = self.llm.call(prompt)
-        print('抽取结果：', data)
-
+    @staticmethod
+    def _title_result(data: Dict) -> Dict:
+        data = data or {}
         # 确保返回的数据包含所有必要字段
         result = {
             "primary_title": data.get("primary_title", ""),
@@ -484,8 +1850,8 @@ class MultiHeaderTableExtractor:
         # 添加数据行
         data_start = header_pack.get("data_start_line", 1)  # 注意这里改为data_start_line
         start_row0 = max(0, data_start - 1)
-        end_row = min(start_row0 + settings.SHEET_PREVIEW_ROWS, len(df))
-        data_df = df.iloc[start_row0:end_row, :settings.SHEET_PREVIEW_COLS]
+        end_row = min(start_row0 + self.s.SHEET_PREVIEW_ROWS, len(df))
+        data_df = df.iloc[start_row0:end_row, :self.s.SHEET_PREVIEW_COLS]
 
         for _, row in data_df.iterrows():
             cells = [str(x).strip() if x is not None else "" for x in row.tolist()]
@@ -549,7 +1915,7 @@ class MultiHeaderTableExtractor:
         """.strip()
 
         print('22222222222222222', prompt)
-        data = self.llm.call(prompt)
+        data = self.llm.call(prompt, step="layout")
         print(data)
         subs = data.get("subtables") or []
         if not subs:
@@ -642,7 +2008,7 @@ class MultiHeaderTableExtractor:
 
         print('【多级表头解析】')
         print(prompt)
-        data = self.llm.call(prompt)
+        data = self.llm.call(prompt, step="headers")
         print('解析结果：', data)
 
         return {
@@ -655,37 +2021,192 @@ class MultiHeaderTableExtractor:
             "confidence": data.get("confidence", 0.0),
         }
 
-    def _textiness_score(self, rows: List[List], col: int) -> float:
-        """计算列的“文本密度”：越接近 1 越像名称列"""
-        import re
-        total = 0
-        texty = 0
-        for r in rows:
-            if col >= len(r):
-                continue
-            v = r[col]
-            if v is None:
-                continue
-            s = str(v).strip()
-            if not s:
-                continue
-            total += 1
-            # 数值/百分比/会计格式判定
-            num_like = bool(re.fullmatch(r'[-+]?\d{1,3}(?:,\d{3})*(?:\.\d+)?%?', s))
-            # 含中文/字母视为“文本”
-            alpha_like = bool(re.search(r'[\u4e00-\u9fa5A-Za-z]', s))
-            if (not num_like) and alpha_like:
-                texty += 1
-        return (texty / total) if total else 0.0
+    # ---------- NEW: 单次整表分析（表头 + 布局 + 列角色 一个提示词） ----------
+    def _infer_sheet_analysis_md(self, md_text: str, sheet_id: str) -> Dict:
+        """
+        一次 LLM 请求同时返回多级表头、并列表布局和列角色，逐段校验
+        某段缺失或不合法时该段返回 None，由调用方回退到原有的分步请求
+
+        Returns:
+            {"header_pack": Dict|None, "layout": Dict|None, "key_columns": Dict|None}
+            key_columns 的列号为整张表的 0-based 列序号
+        """
+        md_lines = md_text.splitlines()
+        nl = "\n".join(_add_line_numbers(md_lines, 0))
+        col_count = max(1, md_lines[0].count("|") - 1) if md_lines else 1
+
+        prompt = f"""
+    你是"表格结构分析助手"。下面是一个 Markdown 表格的原文（带行号，只看这段，不能编造），共 {col_count} 列：
+    {nl}
+
+    请一次性完成三项任务，结果放在同一个 JSON 中：
+
+    1. headers（多级表头解析）
+       - 识别表头行和数据行：表头行包含列名称、分类、单位等描述性信息；数据行包含具体数值、具体内容；如果该行存在数据，必定不为表头
+       - 表头可能有多级（1-5行不等），上级表头可能跨越多列
+       - 多级表头从上到下逐层用"_"连接，上下层内容完全相同时去重只保留一个；下层为空单元格时不拼接
+       - resolved_headers 的数量必须等于 {col_count}，header_lines 逐字来自原文
+
+    2. layout（并列表识别）
+       - 判断是否为"复合表格"（多个子表左右并排，如"资产"和"负债"左右两部分可以独立成表、列头中间有明显分界或重复列名）
+       - 每个子表给出 col_range：[起始列号, 结束列号]（从1开始），必须连续、不重叠、合起来覆盖全部列
+       - 若不是复合表：is_composite=false，只有一个子表，col_range=[1, {col_count}]
+
+    3. key_columns（列角色判定，列号为整张表从0开始的列序号）
+       - item: 财务项目/科目/条目/对象等"关键信息名称列"
+       - company: 公司/单位/客户/供应商等组织名称列
+       - person: 人名列（如法定代表人/负责人/经办人）
+       - value: 金额/数量/比例等数值列（样本中70%以上是数值型数据）
+       - time: 年份、月份、年月、年末数、期末数、上年数等包含时间的列
+       - other_text: 以上均不适合，但为可读文本列
+       - ignore: 全为空白或无意义（如注释号、序号等）
+
+    输出严格 JSON（仅 JSON）：
+    {{
+      "headers": {{
+        "subtable_id": "{sheet_id}",
+        "header_rows": 2,
+        "header_lines": [["项目", "期末数", "期末数"], ["项目", "金额", "比例（%）"]],
+        "data_start_line": 3,
+        "resolved_headers": ["项目", "期末数_金额", "期末数_比例（%）"],
+        "column_count": 3,
+        "confidence": 0.95
+      }},
+      "layout": {{
+        "is_composite": false,
+        "subtables": [{{"id": "T1", "col_range": [1, 3]}}],
+        "confidence": 0.95
+      }},
+      "key_columns": {{
+        "item": [0], "company": [], "person": [], "value": [1, 2], "time": [], "other_text": [], "ignore": []
+      }}
+    }}
+    """.strip()
+
+        print('【整表结构分析（单次）】')
+        print(prompt)
+        data = self.llm.call(prompt, step="sheet_analysis")
+        print('解析结果：', data)
+
+        return {
+            "header_pack": self._validate_header_section(data.get("headers"), sheet_id, col_count),
+            "layout": self._validate_layout_section(data.get("layout"), col_count),
+            "key_columns": self._validate_key_columns_section(data.get("key_columns"), col_count),
+        }
+
+    @staticmethod
+    def _is_int(x) -> bool:
+        return isinstance(x, int) and not isinstance(x, bool)
+
+    @classmethod
+    def _coerce_col_indexes(cls, cols, col_count: int) -> List[int]:
+        """LLM 返回的列号统一转为 int（"3" / 3.0 -> 3）并去重，丢弃非数字、非整数与越界的列号"""
+        out = []
+        for c in cols if isinstance(cols, list) else []:
+            if isinstance(c, str) and c.strip().isdigit():
+                c = int(c.strip())
+            elif isinstance(c, float) and c.is_integer():
+                c = int(c)
+            if cls._is_int(c) and 0 <= c < col_count and c not in out:
+                out.append(c)
+        return out
+
+    def _validate_header_section(self, sec, sheet_id: str, col_count: int) -> Optional[Dict]:
+        """校验 headers 段，格式与 _infer_multilevel_headers_md 的返回一致；不合法返回 None"""
+        if not isinstance(sec, dict):
+            return None
+        headers = sec.get("resolved_headers")
+        data_start = sec.get("data_start_line")
+        if not isinstance(headers, list) or len(headers) != col_count \
+                or not all(isinstance(h, str) for h in headers):
+            return None
+        if not self._is_int(data_start) or data_start < 1:
+            return None
+        return {
+            "subtable_id": sec.get("subtable_id", sheet_id),
+            "header_rows": sec.get("header_rows", 1),
+            "header_lines": sec.get("header_lines", []),
+            "data_start_line": data_start,
+            "resolved_headers": headers,
+            "column_count": sec.get("column_count", col_count),
+            "confidence": sec.get("confidence", 0.0),
+        }
+
+    def _validate_layout_section(self, sec, col_count: int) -> Optional[Dict]:
+        """校验 layout 段：子表列范围必须是连续、不重叠、在总列数以内的整数区间；格式与 _infer_composite_layout_md 一致"""
+        if not isinstance(sec, dict):
+            return None
+        subs = sec.get("subtables")
+        if not isinstance(subs, list) or not subs:
+            return None
+        out = []
+        prev_end = 0
+        for i, st in enumerate(subs, 1):
+            cr = st.get("col_range") if isinstance(st, dict) else None
+            if not (isinstance(cr, list) and len(cr) == 2 and all(self._is_int(x) for x in cr)):
+                return None
+            if not (prev_end < cr[0] <= cr[1] <= col_count):
+                return None
+            prev_end = cr[1]
+            out.append({"id": st.get("id") or f"T{i}", "name": st.get("name", ""), "col_range": cr})
+        return {"is_composite": bool(sec.get("is_composite")), "subtables": out}
+
+    def _validate_key_columns_section(self, sec, col_count: int) -> Optional[Dict]:
+        """校验 key_columns 段：角色 -> 0-based 列号列表，列号必须在总列数以内"""
+        if not isinstance(sec, dict):
+            return None
+        roles = ["item", "company", "person", "value", "time", "other_text", "ignore"]
+        out = {}
+        for k in roles:
+            cols = sec.get(k, [])
+            if not isinstance(cols, list) or not all(self._is_int(c) and 0 <= c < col_count for c in cols):
+                return None
+            out[k] = cols
+        return out
+
+    def _column_stats(self, rows) -> ColumnStats:
+        """
+        扫描一遍 data_rows 得到全部列的统计；不做缓存，
+        由 _extract_key_information 每个子表算一次，再显式传给判列 / 兜底清洗
+        """
+        return ColumnStats.from_rows(rows or [], self.s.DATA_ROWS_CHUNK_SIZE)
+
+    def _local_column_roles(self, resolved_headers: List[str], stats: ColumnStats) -> Dict[int, str]:
+        """
+        按列类型画像直接判定高置信度的列角色（不调用 LLM）：
+        - 整列为空 -> ignore
+        - 日期占比高 -> time
+        - 数值占比高且列名不含时间含义 -> value（期末数/2023年 等列名交给 LLM 判断 time/value）
+          序号/编号/注释号/No/# 等 id 类列名不在本地判为 value，交给 LLM
+        文本列需要区分 item/company/person/other_text，仍交给 LLM
+        """
+        th = self.s.KEY_COLUMN_PROFILE_MIN_RATIO
+        roles = {}
+        for j, h in enumerate(resolved_headers or []):
+            if stats.get(j, "filled") == 0:
+                roles[j] = "ignore"
+            elif stats.get(j, "date_ratio") >= th:
+                roles[j] = "time"
+            elif (stats.get(j, "numeric_ratio") >= th
+                  and not _TIME_HEADER_RE.search(str(h)) and not _ID_HEADER_RE.search(str(h))):
+                roles[j] = "value"
+        return roles
 
     def _infer_key_columns_with_llm(
             self, resolved_headers: List[str], data_rows: List[List], sub_id: str,
-            sample_per_col: int = 8
+            sample_per_col: int = 8, stats: Optional[ColumnStats] = None,
+            sample_rows: Optional[List[List]] = None
     ) -> Dict:
         """
         让 LLM 只做“列角色判定”，输出每列是 item/company/person/value/date/id/other_text/ignore
         然后我们再用程序化方式抽取列值，避免 LLM 漏枚举。
+        列类型画像能确定的列（空列/日期列/纯数值列）直接本地判定，只把剩余的列交给 LLM；全部确定时不调用 LLM
+
+        Args:
+            sample_rows: 取样本用的行（流式模式下传预览行，避免为取样再读一遍整表）；None 时取 data_rows
         """
+        stats = stats or self._column_stats(data_rows)
+        local_roles = self._local_column_roles(resolved_headers, stats) if self.s.KEY_COLUMN_LOCAL_PROFILE else {}
 
         # 采样：给每列取少量“非空非纯数值”的样本，降低 token 压力
         def norm(x):
@@ -693,20 +2214,24 @@ class MultiHeaderTableExtractor:
             s = str(x).strip()
             return s
 
-        col_meta = []
-        for j, h in enumerate(resolved_headers or []):
-            samples = []
-            # 修改：对于数值列，也保留一些样本
-            for r in data_rows:
-                if j >= len(r):
-                    continue
-                s = norm(r[j])
-                if not s:
-                    continue
-                samples.append(s)  # 修改：保留所有样本（包括数值）
-                if len(samples) >= sample_per_col:
+        # 所有待判定列在同一遍扫描中取样，各列样本都取满后提前结束
+        pending = [j for j in range(len(resolved_headers or [])) if j not in local_roles]
+        samples: Dict[int, List[str]] = {j: [] for j in pending}
+        if pending:
+            for r in (data_rows if sample_rows is None else sample_rows):
+                for j in pending:
+                    if j >= len(r):
+                        continue
+                    s = norm(r[j])
+                    if not s:
+                        continue
+                    samples[j].append(s)  # 修改：保留所有样本（包括数值）
+                pending = [j for j in pending if len(samples[j]) < sample_per_col]
+                if not pending:
                     break
-            col_meta.append({"col_index": j, "header": str(h), "samples": samples})
+
+        col_meta = [{"col_index": j, "header": str(h), "samples": samples[j]}
+                    for j, h in enumerate(resolved_headers or []) if j in samples]
 
         # prompt = f"""
         # 你是"列角色判定器"。我们给你每一列的列名（已合并后的单行列头）和少量样本值。
@@ -791,20 +2316,41 @@ class MultiHeaderTableExtractor:
         {json.dumps(col_meta, ensure_ascii=False)}
         """.strip()
 
-        data = self.llm.call(prompt) or {}
+        data = (self.llm.call(prompt, step="key_columns") or {}) if col_meta else {}
         # 兜底与清洗
         cols = data.get("columns") or []
         key_cols = data.get("key_columns") or {}
+        # 先把列号规范为合法的 int，再与本地判定去重，避免 "3" 与 3 被当成两列、同一列拿到两个角色
+        col_count = len(resolved_headers or [])
+        key_cols = {k: [c for c in self._coerce_col_indexes(v, col_count) if c not in local_roles]
+                    for k, v in key_cols.items() if isinstance(v, list)} if isinstance(key_cols, dict) else {}
+        if local_roles:
+            print(f'【列角色本地判定】{sub_id}: {local_roles}')
+            for j, role in sorted(local_roles.items()):
+                key_cols.setdefault(role, []).append(j)
+        return {
+            "subtable_id": sub_id,
+            "key_columns": self._sanitize_key_columns(key_cols, data_rows, resolved_headers, stats=stats)
+        }
+
+    def _sanitize_key_columns(self, key_cols: Dict, data_rows: List[List],
+                              resolved_headers: List[str], stats: Optional[ColumnStats] = None) -> Dict:
+        """
+        列角色兜底与清洗：补齐角色字段、按文本密度剔除不像文本的 key 列、全空时兜底 item 列
+        文本密度取自列统计（stats 为空时按 data_rows 现算一次），不再逐列重复扫描 data_rows
+        """
+        key_cols = dict(key_cols or {})
         # 保证所有角色字段存在
         for k in ["item", "company", "person", "value", "time", "other_text", "ignore"]:
             key_cols.setdefault(k, [])
+        stats = stats or self._column_stats(data_rows)
 
         # 基于“文本密度”做 sanity check：把明显“非文本”的列从 key 中剔除
         for k in ["item", "company", "person", "other_text"]:
             sane_list = []
             for c in key_cols.get(k, []):
                 try:
-                    score = self._textiness_score(data_rows, int(c))
+                    score = stats.get(c, "textiness")
                     if score >= 0.4:  # 文本密度阈值，过低说明像数值列/空列
                         sane_list.append(int(c))
                 except Exception:
@@ -813,26 +2359,35 @@ class MultiHeaderTableExtractor:
 
         # 如果所有 key 列都空，用“文本密度最高”的列兜底为 item
         if not any(key_cols.values()):
-            scores = [(idx, self._textiness_score(data_rows, idx)) for idx in range(len(resolved_headers or []))]
+            scores = [(idx, stats.get(idx, "textiness")) for idx in range(len(resolved_headers or []))]
             scores.sort(key=lambda x: x[1], reverse=True)
             fallback = [i for i, s in scores if s >= 0.6][:1] or ([scores[0][0]] if scores else [])
             key_cols["item"] = fallback
 
-        return {
-            "subtable_id": sub_id,
-            "key_columns": key_cols
-        }
+        return key_cols
 
 
-    def _extract_key_information(self, data_rows: List[List], resolved_headers: List[str], sub_id: str) -> Dict:
+    def _extract_key_information(self, data_rows: List[List], resolved_headers: List[str], sub_id: str,
+                                 key_cols: Optional[Dict] = None,
+                                 sample_rows: Optional[List[List]] = None) -> Dict:
         """
         新方案：LLM 先判定“哪些列是关键信息列”，然后用代码把这些列里的文本全量收集。
         - 这样不会因为 LLM 漏枚举而漏项
         - 只在“判列”这一步使用 LLM，大幅降低维护成本
+        - key_cols 已由单次整表分析给出时，只做兜底清洗，不再单独请求 LLM
+        data_rows 只遍历两遍：列画像一遍、各角色列的全量收集合并为一遍
+        sample_rows 为判列取样用的行（流式模式下的预览行），None 时从 data_rows 取样
         """
+        # 0) 列统计：每个子表只扫描一遍，本地判列与文本密度兜底共用
+        stats = self._column_stats(data_rows)
+
         # 1) 让 LLM 判列（仅少量样本），我们再做文本密度兜底
-        col_pack = self._infer_key_columns_with_llm(resolved_headers or [], data_rows or [], sub_id=sub_id)
-        key_cols = col_pack.get("key_columns", {})
+        if key_cols is not None:
+            key_cols = self._sanitize_key_columns(key_cols, data_rows or [], resolved_headers or [], stats=stats)
+        else:
+            col_pack = self._infer_key_columns_with_llm(resolved_headers or [], data_rows or [], sub_id=sub_id,
+                                                        stats=stats, sample_rows=sample_rows)
+            key_cols = col_pack.get("key_columns", {})
 
         def norm_cell(x: Optional[str]) -> str:
             if x is None: return ""
@@ -846,7 +2401,7 @@ class MultiHeaderTableExtractor:
         def is_noise(s: str) -> bool:
             if not s: return True
             # 过滤纯数值/百分比
-            if re.fullmatch(r'[-+]?\d{1,3}(?:,\d{3})*(?:\.\d+)?%?', s):
+            if _TEXTINESS_NUM_RE.fullmatch(s):
                 return True
             # 常见无意义词（尽量保持极小集合，降低维护成本）
             if s in {"合计", "小计", "其中"}:
@@ -856,24 +2411,27 @@ class MultiHeaderTableExtractor:
                 return True
             return False
 
-        def collect_from_cols(cols: List[int]) -> List[str]:
-            bag = set()
-            for r in data_rows or []:
-                for c in cols or []:
-                    if c >= len(r): continue
-                    s = norm_cell(r[c])
-                    if is_noise(s):
-                        continue
-                    bag.add(s)
+        def collect_from_cols(roles: List[str]) -> Dict[str, List[str]]:
+            """各角色列一遍扫描同时收集（StreamedRows 每遍历一次就要重新解析整个 sheet）"""
+            bags = {k: set() for k in roles}
+            targets = [(c, bags[k]) for k in roles for c in key_cols.get(k, []) or []]
+            if targets:
+                for r in data_rows or []:
+                    for c, bag in targets:
+                        if c >= len(r): continue
+                        s = norm_cell(r[c])
+                        if is_noise(s):
+                            continue
+                        bag.add(s)
             # 稳妥：长度升序 + 字典序，便于稳定回放
-            out = sorted(bag, key=lambda x: (len(x), x))
-            return out
+            return {k: sorted(bag, key=lambda x: (len(x), x)) for k, bag in bags.items()}
 
         # 2) 程序化全量收集
-        items = collect_from_cols(key_cols.get("item", []))
-        company = collect_from_cols(key_cols.get("company", []))
-        person = collect_from_cols(key_cols.get("person", []))
-        other = collect_from_cols(key_cols.get("other_text", []))
+        collected = collect_from_cols(["item", "company", "person", "other_text"])
+        items = collected["item"]
+        company = collected["company"]
+        person = collected["person"]
+        other = collected["other_text"]
 
         # ✅ 简化：只打印key_columns，不生成summary
         print(f'【列角色判定】{sub_id}: {key_cols}')
@@ -890,44 +2448,313 @@ class MultiHeaderTableExtractor:
         }
 
 
+    # ---------- 并发工具 ----------
+    def _map_concurrent(self, fn, items: List, max_workers: Optional[int] = None) -> List:
+        """
+        用有界线程池并发执行 fn(item)，结果顺序与 items 一致
+        max_workers <= 1 或任务数 <= 1 时退化为串行
+        """
+        workers = max(1, int(max_workers if max_workers is not None else self.s.SHEET_CONCURRENCY))
+        if workers <= 1 or len(items) <= 1:
+            return [fn(x) for x in items]
+        with ThreadPoolExecutor(max_workers=min(workers, len(items))) as pool:
+            return list(pool.map(fn, items))
+
+    def _analyze_sheet(self, df: pd.DataFrame, sname: str, si: int, file_base_name: str,
+                       stream_path: Optional[str] = None, stream_layout: Optional[Tuple] = None) -> List[Dict]:
+        """
+        解析单个工作表：多级表头 -> 整理表格 -> 布局分析 -> 各子表关键信息
+        各工作表之间互不依赖，可并发调用
+
+        Args:
+            df: 工作表 DataFrame；流式模式下只是前若干行的预览
+            stream_path: 流式模式下的 xlsx 路径，data_rows 将以 StreamedRows 的形式按需读取
+            stream_layout: 流式模式下该 sheet 的 (max_row, max_col, 合并区域)
+
+        Returns:
+            List[Dict]: 该工作表下的子表列表
+        """
+        print('我是读取的excel内容：：：：：：：：：：：：：', df)
+        # 生成sheet标识：文件名_Sheet1 或 文件名_Sheet名称
+        sheet_id = f"{file_base_name}_Sheet{si + 1}"  # 例如: "excel_table_7_Sheet1"
+
+        # 3.1 先生成原始md预览
+        md_lines = df_to_md_lines(df, self.s.SHEET_PREVIEW_ROWS, self.s.SHEET_PREVIEW_COLS)
+        md_text = "\n".join(md_lines)
+
+        # 3.1.1 简单表规则预判：置信度足够时直接给出表头与布局，不调用 LLM
+        analysis = {}
+        if self.s.HEURISTIC_FAST_PATH:
+            merged = stream_layout[2] if stream_layout else df.attrs.get("merged_ranges")
+            simple = classify_simple_sheet(df, sheet_id, merged, max_rows=self.s.SHEET_PREVIEW_ROWS)
+            if simple and simple["confidence"] >= self.s.HEURISTIC_MIN_CONFIDENCE:
+                print(f"⚡ {sheet_id} 识别为简单表（置信度 {simple['confidence']}），跳过表头/布局 LLM 分析")
+                analysis = simple
+
+        # 3.1.2 单次整表分析（可选）：一个提示词同时拿到表头/布局/列角色，缺失或不合法的段再分步补请求
+        if not analysis and self.s.LLM_SINGLE_SHOT_ANALYSIS:
+            analysis = self._infer_sheet_analysis_md(md_text, sheet_id)
+
+        # 3.2 【新顺序】先进行多级表头解析
+        # 传入包含文件名的sheet_id
+        header_pack = analysis.get("header_pack") or self._infer_multilevel_headers_md(md_text, sub_id=sheet_id)
+
+        # 3.3 生成整理后的表格（表头合并为一行）
+        # 3.4 【新顺序】再进行布局分析（基于整理后的表格）
+        layout = analysis.get("layout")
+        if layout is None:
+            cleaned_md_text = self._generate_cleaned_table_md(df, header_pack)
+            layout = self._infer_composite_layout_md(cleaned_md_text)
+        subs = layout["subtables"] if layout.get("subtables") else [{"id": "T1", "col_range": [1, df.shape[1]]}]
+        sheet_key_cols = analysis.get("key_columns")
+
+        subtables_out = []
+        # 3.5 处理每个子表
+        for st in subs:
+            # 生成完整的子表ID：文件名_Sheet编号:子表编号
+            if layout.get("is_composite", False) and len(subs) > 1:
+                sub_id = f"{file_base_name}_Sheet{si + 1}_{st.get('id', 'T1')}"
+                # 例如: "excel_table_7_Sheet1:T1" （如果是复合表）
+            else:
+                sub_id = f"{file_base_name}_Sheet{si + 1}"
+                # 例如: "excel_table_7_Sheet1" （如果是单表）
+
+            col_range = st.get("col_range", [1, df.shape[1]])
+
+            # 获取子表数据
+            sub_df = slice_df_columns(df, col_range)
+            data_start = header_pack.get("data_start_line", 1)
+
+            # 从数据开始行提取数据
+            start_row0 = max(0, data_start - 1)
+            sample_rows = None
+            if stream_path:
+                s0 = max(1, col_range[0]) - 1
+                data_rows = StreamedRows(stream_path, sname, start_row0,
+                                         (s0, s0 + sub_df.shape[1]), layout=stream_layout)
+                # 判列取样直接用已读入的预览行，不为取样再流式读一遍整表（NaN 还原为 None，与流式读出的空格一致）
+                preview_df = sub_df.iloc[start_row0:, :].astype(object)
+                preview_df = preview_df.where(preview_df.notna(), None)
+                sample_rows = [[_norm_data_cell(x) for x in row] for row in preview_df.values.tolist()]
+            else:
+                data_df = sub_df.iloc[start_row0:, :].copy()
+                data_rows = [[_norm_data_cell(x) for x in row] for row in data_df.values.tolist()]
+
+            # 获取该子表对应的列头
+            resolved_headers = header_pack.get("resolved_headers", [])
+            sub_headers = resolved_headers[col_range[0] - 1:col_range[1]] if resolved_headers else []
+
+            # 单次分析给出的列角色是整表列号，换算为子表内列号
+            sub_key_cols = None
+            if sheet_key_cols is not None:
+                s0 = max(1, col_range[0]) - 1
+                width = sub_df.shape[1]
+                sub_key_cols = {k: [c - s0 for c in cols if s0 <= c < s0 + width]
+                                for k, cols in sheet_key_cols.items()}
+
+            # 【新增】提取关键信息
+            key_info = self._extract_key_information(data_rows, sub_headers, sub_id, key_cols=sub_key_cols,
+                                                     sample_rows=sample_rows)
+
+            subtables_out.append({
+                "sheet_name": sname,  # 保留原始sheet名称
+                "sheet_index": si + 1,  # 新增：sheet序号
+                "subtable_id": sub_id,  # 使用包含文件名的ID
+                "name": st.get("name", ""),
+                "col_range": col_range,
+                "resolved_headers": sub_headers,
+                "header_rows": header_pack.get("header_rows", 1),
+                "header_lines": header_pack.get("header_lines", []),
+                "header_confidence": header_pack.get("confidence", 0.0),
+                "data_start_line": data_start,
+                "data_rows": data_rows,
+                "is_composite": layout.get("is_composite", False),
+                # 【新增】关键信息字段
+                "key_information": key_info.get("key_information", {}),
+                "key_columns": key_info.get("key_columns", {})
+            })
+
+        return subtables_out
+
     # def extract_from_xlsx_mentions(self, text: str) -> List[Dict]:
 
+    def _input_fingerprint(self, file_name: str, staged: Optional[str], content_hash: Optional[str],
+                           ctx: Dict) -> str:
+        """表格输入指纹 = 解析配置/模型 + 附件名 + 落盘路径 + 附件内容哈希 + 标题上下文窗口内容"""
+        raw = json.dumps([
+            _FINGERPRINT_VERSION,
+            {k: getattr(self.s, k, None) for k in _FINGERPRINT_SETTINGS},
+            file_name, staged, content_hash, ctx.get("lines", []),
+        ], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _splice_reused(prev: Dict, line_idx: int) -> Dict:
+        """复用上次的表格结果：起止行改为本次引用所在行，标题/时间/单位行号随之平移"""
+        entry = dict(prev)
+        delta = line_idx + 1 - int(prev.get("start_line") or line_idx + 1)
+        entry["start_line"] = line_idx + 1
+        entry["end_line"] = line_idx + 1
+        for k in ("title_line", "time_line", "unit_line"):
+            if k in entry:
+                entry[k] = _shift_line_ref(entry[k], delta)
+        return entry
+
     def extract_from_xlsx_mentions(self, text: str,
                                        input_file_path: str = "",
                                        agent_user_id: str = "",
-                                       task_id: str = "") -> List[Dict]:
+                                       task_id: str = "",
+                                       previous_tables: Optional[List[Dict]] = None,
+                                       incremental: Optional[bool] = None) -> List[Dict]:
 
         """
         修正后的主函数，支持路径参数
+        各附件的标题推断、各工作表的 LLM 分析互相独立，按 SHEET_CONCURRENCY 并发执行，
+        输出 tables 的顺序与内容与串行执行一致
 
         Args:
             text: 文档文本
             input_file_path: 基础输入路径
             agent_user_id: 用户ID
             task_id: 任务ID
+            previous_tables: 上次的解析结果；输入指纹（附件内容 + 上文窗口 + 配置）一致的表格直接复用，不再调用 LLM
+            incremental: 是否计算输入指纹（需要对每个附件做全文哈希）；None 跟随 INCREMENTAL_REEXTRACT，
+                传入 previous_tables 时视为开启。关闭时结果中的 input_fingerprint 为 None
         """
         lines = text.splitlines()
         hits = find_xlsx_mentions(text)
-        tables: List[Dict] = []
+        doc_index = DocumentLineIndex(lines, hits)
+        contexts = [self._get_context_before(lines, hit["line_idx"], index=doc_index) for hit in hits]
+
+        # 1) 附件定位/落盘 - 传入路径参数（串行执行，避免同名附件并发写同一目标文件）
+        #    stage_cache：同一附件在文中被多次引用时只定位/落盘一次
+        stage_cache: Dict[Tuple, Optional[str]] = {}
+        staged_list = [
+            resolve_and_stage_attachment(
+                hit["file_name"],
+                input_base_path=input_file_path,
+                agent_user_id=agent_user_id,
+                task_id=task_id,
+                cache=stage_cache,
+                s=self.s
+            )
+            for hit in hits
+        ]
+
+        # 2) 输入指纹：与上次结果比对，未变化的表格直接复用（只在增量模式下计算，避免每次都全文哈希附件）
+        if incremental is None:
+            incremental = self.s.INCREMENTAL_REEXTRACT or bool(previous_tables)
+        fingerprints: List[Optional[str]] = [None] * len(hits)
+        if incremental:
+            content_hashes: Dict[str, str] = {}
+            for staged in staged_list:
+                if staged and staged not in content_hashes:
+                    content_hashes[staged] = file_content_hash(staged)
+            fingerprints = [
+                self._input_fingerprint(hit["file_name"], staged, content_hashes.get(staged) if staged else None, ctx)
+                for hit, staged, ctx in zip(hits, staged_list, contexts)
+            ]
+        reused: Dict[int, Dict] = {}
+        if previous_tables:
+            pool: Dict[str, List[Dict]] = {}
+            for t in previous_tables:
+                if t.get("input_fingerprint"):
+                    pool.setdefault(t["input_fingerprint"], []).append(t)
+            for hi, fp in enumerate(fingerprints):
+                if pool.get(fp):
+                    reused[hi] = self._splice_reused(pool[fp].pop(0), hits[hi]["line_idx"])
+            print(f"♻️ 增量解析：{len(reused)}/{len(hits)} 个表格输入未变化，复用上次结果")
+        todo = [hi for hi in range(len(hits)) if hi not in reused]
+
+        # 3) 标题/时间/单位（每个引用独立，走异步客户端并发请求）
+        title_packs = dict(zip(todo, self._infer_titles([contexts[hi] for hi in todo])))
+
+        # 4) 逐工作表解析：所有附件的所有工作表摊平为一个任务列表，由同一个有界线程池并发处理
+        #    任务规划只用廉价的行数探测（probe_xlsx_sheet_rows）拿到 sheet 名，不加载工作簿；
+        #    工作簿在它的第一个 sheet 任务里才加载（同一附件被多次引用时也共用），全部 sheet 处理完后立即释放，
+        #    同时驻留内存的工作簿数受并发数限制，加载也与其他 sheet 的 LLM 请求并行
+        #    超大工作簿（任一 sheet 行数 >= XLSX_STREAM_MIN_ROWS）不整本加载，改为只读流式：
+        #    LLM 只看前若干行预览，data_rows 在写出时按块流式读取
+        books: Dict[str, XlsxWorkbook] = {}
+        book_locks: Dict[str, threading.Lock] = {}  # 每个附件一把加载锁：只加载一次，不同附件的加载互不阻塞
+        sheet_names: Dict[str, List[str]] = {}
+        streamed: set = set()
+        pending: Dict[str, int] = {}
+        books_lock = threading.Lock()
+        sheet_jobs: List[Tuple[int, int, str]] = []
+        for hi in todo:
+            staged = staged_list[hi]
+            if not staged:
+                continue
+            if staged not in sheet_names:
+                sheet_rows = probe_xlsx_sheet_rows(staged)
+                sheet_names[staged] = list(sheet_rows)
+                threshold = self.s.XLSX_STREAM_MIN_ROWS
+                if threshold and max(sheet_rows.values(), default=0) >= threshold:
+                    print(f"  ↪ 大文件流式模式: {staged} {sheet_rows}")
+                    streamed.add(staged)
+                else:
+                    book_locks[staged] = threading.Lock()
+                    pending[staged] = 0
+            for si, sname in enumerate(sheet_names[staged]):
+                sheet_jobs.append((hi, si, sname))
+                if staged in pending:
+                    pending[staged] += 1
+
+        def analyze(job: Tuple[int, int, str]) -> List[Dict]:
+            hi, si, sname = job
+            staged = staged_list[hi]
+            file_base_name = os.path.splitext(hits[hi]["file_name"])[0]
+            if staged in streamed:
+                layout = scan_xlsx_sheet_layout(staged, sname)
+                # 预览行数留出表头余量：表头解析看前 SHEET_PREVIEW_ROWS 行，整理后的表格再从数据起始行取同样行数
+                preview = iter_xlsx_rows_expand_merged(staged, sname, max_rows=2 * self.s.SHEET_PREVIEW_ROWS,
+                                                       layout=layout)
+                df = pd.DataFrame(list(preview))
+                return self._analyze_sheet(df, sname, si, file_base_name,
+                                           stream_path=staged, stream_layout=layout)
+            with book_locks[staged]:
+                with books_lock:
+                    book = books.get(staged)
+                if book is None:
+                    book = XlsxWorkbook(staged)
+                    with books_lock:
+                        books[staged] = book
+            try:
+                df = book.read_sheet(sname)
+            finally:
+                with books_lock:
+                    pending[staged] -= 1
+                    done_book = books.pop(staged, None) if pending[staged] == 0 else None
+                if done_book is not None:
+                    done_book.close()
+            return self._analyze_sheet(df, sname, si, file_base_name)
 
-        for hit in hits:
+        try:
+            sheet_results = self._map_concurrent(analyze, sheet_jobs)
+        finally:
+            # 某个 sheet 任务出错时，其余未处理完的工作簿也要释放
+            with books_lock:
+                leftover = list(books.values())
+                books.clear()
+            for book in leftover:
+                book.close()
+        subtables_by_hit: Dict[int, List[Dict]] = {}
+        for (hi, _, _), subs in zip(sheet_jobs, sheet_results):
+            subtables_by_hit.setdefault(hi, []).extend(subs)
+
+        # 5) 按原始引用顺序组装结果
+        tables: List[Dict] = []
+        for hi, hit in enumerate(hits):
+            if hi in reused:
+                tables.append(reused[hi])
+                continue
             file_name = hit["file_name"]
             line_idx = hit["line_idx"]
-
             file_base_name = os.path.splitext(file_name)[0]
-
-            # 1) 标题/时间/单位
-            ctx = self._get_context_before(lines, line_idx)
-            title_pack = self._infer_title_from_context(ctx)
+            title_pack = title_packs[hi]
             title = title_pack.get("primary_title") or "未命名表格"
-
-            # 2) 附件定位/落盘 - 传入路径参数
-            staged = resolve_and_stage_attachment(
-                file_name,
-                input_base_path=input_file_path,
-                agent_user_id=agent_user_id,
-                task_id=task_id
-            )
+            staged = staged_list[hi]
 
             if not staged:
                 # 文件不存在的处理逻辑
@@ -946,90 +2773,14 @@ class MultiHeaderTableExtractor:
                     "file": file_name,
                     "file_path": None,
                     "subtables": [],
-                    "note": f"未找到该文件"
+                    "note": f"未找到该文件",
+                    "input_fingerprint": fingerprints[hi]
                 })
                 continue
 
             # 生成表ID（使用file_path + title）
             table_id = generate_table_id(staged, title)  # 新增
 
-            # 3) 逐工作表解析
-            wb = load_workbook(staged, data_only=True)
-            subtables_out = []
-
-            for si, sname in enumerate(wb.sheetnames):
-                df = read_xlsx_expand_merged(staged, sname)
-                print('我是读取的excel内容：：：：：：：：：：：：：', df)
-                # 生成sheet标识：文件名_Sheet1 或 文件名_Sheet名称
-                sheet_id = f"{file_base_name}_Sheet{si + 1}"  # 例如: "excel_table_7_Sheet1"
-
-                # 3.1 先生成原始md预览
-                md_lines = df_to_md_lines(df, settings.SHEET_PREVIEW_ROWS, settings.SHEET_PREVIEW_COLS)
-                md_text = "\n".join(md_lines)
-
-                # 3.2 【新顺序】先进行多级表头解析
-                # 传入包含文件名的sheet_id
-                header_pack = self._infer_multilevel_headers_md(md_text, sub_id=sheet_id)
-
-                # 3.3 生成整理后的表格（表头合并为一行）
-                cleaned_md_text = self._generate_cleaned_table_md(df, header_pack)
-
-                # 3.4 【新顺序】再进行布局分析（基于整理后的表格）
-                layout = self._infer_composite_layout_md(cleaned_md_text)
-                subs = layout["subtables"] if layout.get("subtables") else [{"id": "T1", "col_range": [1, df.shape[1]]}]
-
-                # 3.5 处理每个子表
-                for st in subs:
-                    # 生成完整的子表ID：文件名_Sheet编号:子表编号
-                    if layout.get("is_composite", False) and len(subs) > 1:
-                        sub_id = f"{file_base_name}_Sheet{si + 1}_{st.get('id', 'T1')}"
-                        # 例如: "excel_table_7_Sheet1:T1" （如果是复合表）
-                    else:
-                        sub_id = f"{file_base_name}_Sheet{si + 1}"
-                        # 例如: "excel_table_7_Sheet1" （如果是单表）
-
-                    col_range = st.get("col_range", [1, df.shape[1]])
-
-                    # 获取子表数据
-                    sub_df = slice_df_columns(df, col_range)
-                    data_start = header_pack.get("data_start_line", 1)
-
-                    # 从数据开始行提取数据
-                    start_row0 = max(0, data_start - 1)
-                    data_df = sub_df.iloc[start_row0:, :].copy()
-
-                    def norm(x):
-                        if x is None: return None
-                        s = str(x).strip()
-                        return None if s == "" or s.lower() == "null" else s
-
-                    data_rows = [[norm(x) for x in row] for row in data_df.values.tolist()]
-
-                    # 获取该子表对应的列头
-                    resolved_headers = header_pack.get("resolved_headers", [])
-                    sub_headers = resolved_headers[col_range[0] - 1:col_range[1]] if resolved_headers else []
-
-                    # 【新增】提取关键信息
-                    key_info = self._extract_key_information(data_rows, sub_headers, sub_id)
-
-                    subtables_out.append({
-                        "sheet_name": sname,  # 保留原始sheet名称
-                        "sheet_index": si + 1,  # 新增：sheet序号
-                        "subtable_id": sub_id,  # 使用包含文件名的ID
-                        "name": st.get("name", ""),
-                        "col_range": col_range,
-                        "resolved_headers": sub_headers,
-                        "header_rows": header_pack.get("header_rows", 1),
-                        "header_lines": header_pack.get("header_lines", []),
-                        "header_confidence": header_pack.get("confidence", 0.0),
-                        "data_start_line": data_start,
-                        "data_rows": data_rows,
-                        "is_composite": layout.get("is_composite", False),
-                        # 【新增】关键信息字段
-                        "key_information": key_info.get("key_information", {}),
-                        "key_columns": key_info.get("key_columns", {})
-                    })
-
             tables.append({
                 "table_id": table_id,  # 新增：添加在第一个位置
                 "start_line": line_idx + 1,
@@ -1045,24 +2796,16 @@ class MultiHeaderTableExtractor:
                 "file": file_name,
                 "file_base_name": file_base_name,  # 新增：文件基础名称
                 "file_path": staged,
-                "subtables": subtables_out
+                "subtables": subtables_by_hit.get(hi, []),
+                "input_fingerprint": fingerprints[hi]  # 增量重解析用
             })
 
         return tables
 
 
     # ---------- 输出 ----------
-    def save_results(self, tables: List[Dict], filename: Optional[str] = None):
-        """
-        保存表格提取结果
-
-        Args:
-            tables: 提取的表格列表
-            filename: 输出文件名（可选）
-
-        Returns:
-            str: 保存文件的完整绝对路径
-        """
+    def _results_path(self, filename: Optional[str] = None) -> str:
+        """结果文件的绝对路径：{OUTPUT_DIR}/{filename}_tables.json，未给文件名时按时间戳命名"""
         if filename is None:
             filename = f"tables_{_now_suffix()}"
         else:
@@ -1076,16 +2819,119 @@ class MultiHeaderTableExtractor:
 
         path = os.path.join(self.s.OUTPUT_DIR, filename)
         # 转换为绝对路径
-        path = os.path.abspath(path)
+        return os.path.abspath(path)
+
+    def load_previous_results(self, filename: Optional[str]) -> List[Dict]:
+        """读取上次同名输出的 tables，供增量重解析复用；文件不存在或损坏时返回空列表"""
+        if not filename:
+            return []
+        path = self._results_path(filename)
+        if not os.path.exists(path):
+            return []
+        try:
+            return json_io.load(path).get("tables", []) or []
+        except Exception as e:
+            print(f"⚠️ 读取上次结果失败，全部重新解析: {path} ({e})")
+            return []
+
+    def save_results(self, tables: List[Dict], filename: Optional[str] = None,
+                     return_document: bool = False):
+        """
+        保存表格提取结果
+
+        Args:
+            tables: 提取的表格列表
+            filename: 输出文件名（可选）
+            return_document: 为 True 时同时返回写入文件的文档对象
+
+        Returns:
+            str: 保存文件的完整绝对路径；
+            return_document=True 时为 (路径, {"tables", "count"} 文档)，含流式子表时文档为 None
+        """
+        path = self._results_path(filename)
+        if self.s.DATA_ROWS_SIDECAR and self.s.DATA_ROWS_SIDECAR != "off":
+            tables = self._externalize_data_rows(tables, path)
 
         # 直接覆盖旧文件（不需要检查是否存在）
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump({"tables": tables, "count": len(tables)}, f, ensure_ascii=False, indent=2)
+        doc = None
+        if any(isinstance(st.get("data_rows"), StreamedRows)
+               for t in tables for st in t.get("subtables", [])):
+            with open(path, "w", encoding="utf-8") as f:
+                self._dump_tables_streaming(f, tables)
+        else:
+            doc = {"tables": tables, "count": len(tables)}
+            json_io.dump(doc, path)
 
         print(f"[OK] 结果已保存：{path}")
+        if return_document:
+            return path, doc
         return path  # 返回完整的绝对路径
 
 
+    def _externalize_data_rows(self, tables: List[Dict], json_path: str) -> List[Dict]:
+        """
+        大子表的 data_rows 写成 sidecar（见 table_sidecar），返回替换为 data_rows_ref 的浅拷贝，原 tables 不变
+        已是 data_rows_ref 的子表（增量复用的旧结果）原样保留；目录中不再被引用的旧 sidecar 会被清理
+        """
+        out = []
+        keep_paths = []
+        for ti, t in enumerate(tables):
+            subs = []
+            for si, st in enumerate(t.get("subtables", [])):
+                rows = st.get("data_rows")
+                if rows is not None and len(rows) >= self.s.DATA_ROWS_SIDECAR_MIN_ROWS:
+                    name = f"{t.get('table_id') or ti}_{st.get('subtable_id') or si}"
+                    st = {k: v for k, v in st.items() if k != "data_rows"}
+                    st["data_rows_ref"] = table_sidecar.write_data_rows(
+                        rows, json_path, name, fmt=self.s.DATA_ROWS_SIDECAR, chunk_size=self.s.DATA_ROWS_CHUNK_SIZE)
+                if st.get("data_rows_ref"):
+                    keep_paths.append(st["data_rows_ref"]["path"])
+                subs.append(st)
+            out.append({**t, "subtables": subs})
+        table_sidecar.prune_sidecar_dir(json_path, keep_paths)
+        return out
+
+    def _dump_tables_streaming(self, f, tables: List[Dict]) -> None:
+        """
+        含 StreamedRows 的结果写出：其余结构照常序列化，
+        StreamedRows 先替换为占位符，写到占位符处时按块从 xlsx 读取并写出，内存峰值与总行数无关
+        占位符带本次调用的随机 token，并确认骨架里的数据不含该 token，避免与单元格内容冲突
+        """
+        while True:
+            token = uuid.uuid4().hex
+            streams: List[StreamedRows] = []
+            skeleton_tables = []
+            for t in tables:
+                t2 = dict(t)
+                subs = []
+                for st in t.get("subtables", []):
+                    rows = st.get("data_rows")
+                    if isinstance(rows, StreamedRows):
+                        st = dict(st)
+                        st["data_rows"] = f"{token}_{len(streams)}"
+                        streams.append(rows)
+                    subs.append(st)
+                t2["subtables"] = subs
+                skeleton_tables.append(t2)
+
+            text = json_io.dumps({"tables": skeleton_tables, "count": len(tables)})
+            if text.count(token) == len(streams):
+                break
+
+        # 占位符按插入顺序出现在骨架中，依次切开写出
+        rest = text
+        for i, rows in enumerate(streams):
+            head, _, rest = rest.partition(f'"{token}_{i}"')
+            f.write(head)
+            f.write("[")
+            first = True
+            for chunk in rows.iter_chunks(self.s.DATA_ROWS_CHUNK_SIZE):
+                body = ",\n".join(json_io.dumps(row, pretty=False) for row in chunk)
+                f.write(("\n" if first else ",\n") + body)
+                first = False
+            f.write("\n]" if not first else "]")
+        f.write(rest)
+
     def format_preview(self, tables: List[Dict]) -> str:
         out = []
         for ti, t in enumerate(tables, 1):
@@ -1101,7 +2947,7 @@ class MultiHeaderTableExtractor:
                 headers = st.get("resolved_headers", [])
                 if headers:
                     out.append("  │  列名: " + " | ".join(headers))
-                out.append(f"  │  数据行数: {len(st.get('data_rows', []))}")
+                out.append(f"  │  数据行数: {table_sidecar.data_rows_count(st)}")
 
                 # ✅ 删除 key_info_summary 的显示
                 # 改为直接显示 key_columns
@@ -1123,7 +2969,8 @@ class MultiHeaderTableExtractor:
 # 示例 main（改为从 xlsx 引用解析）
 # =========================
 def main(text, json_file_name=None, output_dir=None,
-         input_file_path=None, agent_user_id=None, task_id=None):
+         input_file_path=None, agent_user_id=None, task_id=None,
+         use_llm_cache=None, incremental=None, return_tables=False):
     """
     主处理函数
 
@@ -1134,31 +2981,26 @@ def main(text, json_file_name=None, output_dir=None,
         input_file_path: 输入文件基础路径（新增）
         agent_user_id: 用户ID（新增）
         task_id: 任务ID（新增）
+        use_llm_cache: 是否使用 LLM 响应缓存（None 跟随配置，False 表示本次强制重新请求）
+        incremental: 是否复用上次同名结果中输入未变化的表格（None 跟随 INCREMENTAL_REEXTRACT）
+        return_tables: 为 True 时同时返回与文件内容一致的 {"tables", "count"} 文档，供下游免去重读；
+            含流式子表（超大工作表）时无法在内存中给出，返回 None，下游应回退读文件
 
     Returns:
-        str: 生成的tables.json文件的完整绝对路径
+        str: 生成的tables.json文件的完整绝对路径；return_tables=True 时为 (路径, 文档或 None)
     """
-    # 更新全局配置
-    if input_file_path:
-        settings.INPUT_FILE_PATH = input_file_path
-    if agent_user_id:
-        settings.AGENT_USER_ID = str(agent_user_id)
-    if task_id:
-        settings.TASK_ID = str(task_id)
-
-    # 如果指定了输出目录，临时覆盖配置
-    original_output_dir = None
-    original_attachment_dir = None
+    # 本任务专用配置（全局 settings 不做任何修改，可在同一进程内并发处理多个文档）
+    s = make_job_settings(
+        INPUT_FILE_PATH=input_file_path,
+        AGENT_USER_ID=str(agent_user_id) if agent_user_id else None,
+        TASK_ID=str(task_id) if task_id else None,
+        OUTPUT_DIR=output_dir,
+        ATTACHMENT_OUT_DIR=output_dir,
+    )
 
     if output_dir:
-        original_output_dir = settings.OUTPUT_DIR
-        original_attachment_dir = settings.ATTACHMENT_OUT_DIR
-
-        settings.OUTPUT_DIR = output_dir
-        settings.ATTACHMENT_OUT_DIR = output_dir
-
-        os.makedirs(settings.OUTPUT_DIR, exist_ok=True)
-        os.makedirs(settings.ATTACHMENT_OUT_DIR, exist_ok=True)
+        os.makedirs(s.OUTPUT_DIR, exist_ok=True)
+        os.makedirs(s.ATTACHMENT_OUT_DIR, exist_ok=True)
 
         print(f"✅ 使用自定义输出目录: {output_dir}")
 
@@ -1171,30 +3013,29 @@ def main(text, json_file_name=None, output_dir=None,
         print(f"  用户ID: {agent_user_id}")
         print(f"  任务ID: {task_id}")
         print(f"  完整输入路径: {full_input_path}")
-        print(f"  输出目录: {settings.OUTPUT_DIR}")
+        print(f"  输出目录: {s.OUTPUT_DIR}")
         print("=" * 80)
 
-    try:
-        extractor = MultiHeaderTableExtractor()
-
-        # 传入路径参数
-        tables = extractor.extract_from_xlsx_mentions(
-            text,
-            input_file_path=input_file_path or "",
-            agent_user_id=agent_user_id or "",
-            task_id=task_id or ""
-        )
+    extractor = MultiHeaderTableExtractor(use_llm_cache=use_llm_cache, s=s)
 
-        print(extractor.format_preview(tables))
-        output_path = extractor.save_results(tables, filename=json_file_name)
-        return output_path
+    if incremental is None:
+        incremental = s.INCREMENTAL_REEXTRACT
+    previous_tables = extractor.load_previous_results(json_file_name) if incremental else []
 
-    finally:
-        # 恢复原始输出目录设置
-        if original_output_dir is not None:
-            settings.OUTPUT_DIR = original_output_dir
-        if original_attachment_dir is not None:
-            settings.ATTACHMENT_OUT_DIR = original_attachment_dir
+    # 传入路径参数
+    tables = extractor.extract_from_xlsx_mentions(
+        text,
+        input_file_path=input_file_path or "",
+        agent_user_id=agent_user_id or "",
+        task_id=task_id or "",
+        previous_tables=previous_tables,
+        incremental=incremental
+    )
+
+    print(extractor.format_preview(tables))
+    if extractor.llm.use_cache:
+        print(f"LLM 缓存统计: {get_llm_cache(extractor.s).stats()}")
+    return extractor.save_results(tables, filename=json_file_name, return_document=return_tables)
 
 
 if __name__ == "__main__":
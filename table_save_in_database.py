@@ -1,6 +1,7 @@
 # filename: import_table_cells.py
 # requirements: pip install pymysql
 
+import os
 import json
 import hashlib
 from decimal import Decimal
@@ -9,6 +10,9 @@ from typing import Any, Dict, Iterable, List, Tuple, Optional
 import pymysql
 from pymysql.connections import Connection
 
+import table_sidecar
+import json_io
+
 # ---- MySQL 连接参数 ----
 MYSQL_HOST = "localhost"
 MYSQL_USER = "root"
@@ -141,10 +145,11 @@ def process_heading_meta(heading_meta, default_title):
     return default_title
 
 
-def explode_rows(doc: Dict[str, Any]) -> Iterable[Tuple]:
+def explode_rows(doc: Dict[str, Any], base_dir: str = ".") -> Iterable[Tuple]:
     """
     将输入 JSON 炸平为多行 (values tuple)，顺序与 INSERT_SQL 对应。
     新增功能：优先使用 heading_meta 作为 title
+    子表 data_rows 可以是内联列表，也可以是 data_rows_ref 指向的 sidecar 文件（相对 base_dir，即 JSON 所在目录）
     """
     tables = doc.get("tables", [])
     for t in tables:
@@ -175,7 +180,7 @@ def explode_rows(doc: Dict[str, Any]) -> Iterable[Tuple]:
             col_range = st.get("col_range") or [1, 0]
             col_start = int(col_range[0])
             headers = st.get("resolved_headers", []) or []
-            data_rows = st.get("data_rows", []) or []
+            data_rows = table_sidecar.load_data_rows(st, base_dir) or []
 
             #  读取列角色信息，并转换 Decimal 为 int
             key_columns_raw = st.get("key_columns", {})
@@ -284,10 +289,10 @@ def import_json(conn: Connection, json_path: str) -> int:
     读取 json_path，解析并批量导入到 table_cells。
     返回导入的单元格数量。
     """
-    with open(json_path, "r", encoding="utf-8") as f:
-        doc = json.load(f, parse_float=Decimal, parse_int=Decimal)
+    # 数值按 Decimal 精确解析（标准库实现）
+    doc = json_io.load(json_path, decimal=True)
 
-    rows = list(explode_rows(doc))
+    rows = list(explode_rows(doc, base_dir=os.path.dirname(os.path.abspath(json_path))))
     if not rows:
         return 0
 
@@ -0,0 +1,175 @@
+# filename: table_sidecar.py
+# 子表 data_rows 的旁路文件（sidecar）读写
+# 主 JSON（_tables.json / _tables_with_heading.json）只保留元数据和 data_rows_ref 指针，
+# 大表的数据行单独存为 Parquet（需 pyarrow）或紧凑 JSON Lines，下游按需读取。
+# optional: pip install pyarrow
+
+import os
+import re
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow 可选，缺失时 parquet 自动退回 jsonl
+    pa = None
+    pq = None
+
+import json_io
+
+# sidecar 目录：与主 JSON 同目录，名为 "{主JSON文件名(去扩展名)}_data"
+SIDECAR_DIR_SUFFIX = "_data"
+FORMAT_EXT = {"parquet": ".parquet", "jsonl": ".jsonl"}
+
+
+def parquet_available() -> bool:
+    return pq is not None
+
+
+def sidecar_dir_for(json_path: str) -> str:
+    """主 JSON 对应的 sidecar 目录（绝对路径）"""
+    return os.path.splitext(os.path.abspath(json_path))[0] + SIDECAR_DIR_SUFFIX
+
+
+def _safe_name(name: str) -> str:
+    return re.sub(r'[^\w\-.]+', "_", name).strip("._") or "rows"
+
+
+def _iter_chunks(rows, chunk_size: int) -> Iterator[List[List]]:
+    """按块遍历 data_rows；支持带 iter_chunks 的流式对象（如 StreamedRows）"""
+    if hasattr(rows, "iter_chunks"):
+        yield from rows.iter_chunks(chunk_size)
+        return
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _cell_str(x: Any) -> Optional[str]:
+    return None if x is None else str(x)
+
+
+def write_data_rows(rows: Iterable[List], json_path: str, name: str,
+                    fmt: str = "parquet", chunk_size: int = 5000) -> Dict[str, Any]:
+    """
+    把一个子表的 data_rows 写成 sidecar 文件
+
+    Args:
+        rows: data_rows（list 或可按块迭代的流式对象）
+        json_path: 主 JSON 路径，sidecar 写到其 _data 目录下
+        name: 文件名（不含扩展名），同一主 JSON 内需唯一
+        fmt: "parquet" 或 "jsonl"；parquet 需要 pyarrow，缺失时退回 jsonl
+        chunk_size: 每块行数（parquet 的 row group 大小）
+
+    Returns:
+        data_rows_ref: {"format", "path"（相对主 JSON 所在目录）, "rows", "cols"}
+    """
+    if fmt == "parquet" and not parquet_available():
+        print("⚠️ 未安装 pyarrow，data_rows sidecar 改用 jsonl 格式")
+        fmt = "jsonl"
+    if fmt not in FORMAT_EXT:
+        raise ValueError(f"不支持的 sidecar 格式: {fmt}")
+
+    out_dir = sidecar_dir_for(json_path)
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, _safe_name(name) + FORMAT_EXT[fmt])
+    tmp = path + ".tmp"
+
+    n_rows = 0
+    n_cols = 0
+    if fmt == "jsonl":
+        with open(tmp, "w", encoding="utf-8") as f:
+            for chunk in _iter_chunks(rows, chunk_size):
+                f.write("".join(json_io.dumps(r, pretty=False) + "\n" for r in chunk))
+                n_rows += len(chunk)
+                n_cols = max([n_cols] + [len(r) for r in chunk])
+    else:
+        # parquet 需要固定列数：先确定最大列宽（流式对象需要多扫一遍，换取不物化全部行）
+        for chunk in _iter_chunks(rows, chunk_size):
+            n_cols = max([n_cols] + [len(r) for r in chunk])
+        schema = pa.schema([(f"c{j}", pa.string()) for j in range(n_cols)])
+        writer = pq.ParquetWriter(tmp, schema, compression="zstd")
+        try:
+            for chunk in _iter_chunks(rows, chunk_size):
+                cols = [[_cell_str(r[j]) if j < len(r) else None for r in chunk] for j in range(n_cols)]
+                writer.write_table(pa.Table.from_arrays([pa.array(c, type=pa.string()) for c in cols],
+                                                        schema=schema))
+                n_rows += len(chunk)
+        finally:
+            writer.close()
+    os.replace(tmp, path)
+
+    return {
+        "format": fmt,
+        "path": os.path.relpath(path, os.path.dirname(os.path.abspath(json_path))),
+        "rows": n_rows,
+        "cols": n_cols,
+    }
+
+
+def _ref_path(ref: Dict[str, Any], base_dir: str) -> str:
+    path = ref.get("path", "")
+    return path if os.path.isabs(path) else os.path.join(base_dir, path)
+
+
+def iter_data_rows(ref: Dict[str, Any], base_dir: str) -> Iterator[List]:
+    """按行读取 sidecar（base_dir 为引用它的主 JSON 所在目录）"""
+    path = _ref_path(ref, base_dir)
+    fmt = ref.get("format", "jsonl")
+    if fmt == "jsonl":
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json_io.loads(line)
+        return
+    if fmt == "parquet":
+        if not parquet_available():
+            raise RuntimeError(f"读取 parquet sidecar 需要安装 pyarrow: {path}")
+        pf = pq.ParquetFile(path)
+        for batch in pf.iter_batches():
+            # data_rows 按子表列数定宽，写入时不足的列补 None，读出即为原始行
+            cols = [c.to_pylist() for c in batch.columns]
+            yield from (list(r) for r in zip(*cols))
+        return
+    raise ValueError(f"不支持的 sidecar 格式: {fmt}")
+
+
+def load_data_rows(subtable: Dict[str, Any], base_dir: str) -> List[List]:
+    """
+    取子表的 data_rows：内联的直接返回，sidecar 形式的从文件读出
+    下游读取 _tables.json / _tables_with_heading.json 时统一用它，两种格式都兼容
+    """
+    if "data_rows" in subtable and subtable["data_rows"] is not None:
+        return subtable["data_rows"]
+    ref = subtable.get("data_rows_ref")
+    if not ref:
+        return []
+    return list(iter_data_rows(ref, base_dir))
+
+
+def data_rows_count(subtable: Dict[str, Any]) -> int:
+    """子表数据行数（sidecar 形式不读文件，直接取引用里的行数）"""
+    if subtable.get("data_rows") is not None:
+        return len(subtable["data_rows"])
+    return int((subtable.get("data_rows_ref") or {}).get("rows", 0))
+
+
+def prune_sidecar_dir(json_path: str, keep_paths: Iterable[str]) -> int:
+    """删除 sidecar 目录中不再被主 JSON 引用的文件，返回删除数量"""
+    out_dir = sidecar_dir_for(json_path)
+    if not os.path.isdir(out_dir):
+        return 0
+    base_dir = os.path.dirname(os.path.abspath(json_path))
+    keep = {os.path.normpath(os.path.join(base_dir, p)) for p in keep_paths}
+    removed = 0
+    for fn in os.listdir(out_dir):
+        full = os.path.normpath(os.path.join(out_dir, fn))
+        if full not in keep:
+            os.remove(full)
+            removed += 1
+    return removed
@@ -0,0 +1,263 @@
+# filename: task_registry.py
+# 各 FastAPI 服务共用的进程内任务登记表（替代无限增长的全局 dict）
+# - 用法与 dict 相同：registry[task_id] = {...}; registry[task_id]["status"] = "completed"
+# - 只有已结束（status 属于 done_statuses）的任务才会被淘汰，执行中 / 尚未写入 status 的任务永不淘汰
+# - 淘汰规则：超过 ttl_s 未访问的已结束任务直接删除；条目数或估算字节数超限时按 LRU 淘汰
+# - 配置了 spill_dir 时，LRU 淘汰的已结束任务整条写到磁盘，再次访问时自动读回（TTL 到期同样删除文件）
+#   落盘用 pickle（条目里的 datetime 等对象原样读回），先写临时文件再原子替换；写盘失败的条目留在内存，不丢结果
+
+import os
+import sys
+import time
+import pickle
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+DEFAULT_MAX_ENTRIES: int = 1000
+DEFAULT_MAX_BYTES: int = 256 * 1024 * 1024
+DEFAULT_TTL_S: float = 24 * 3600
+DEFAULT_SWEEP_INTERVAL_S: float = 30.0
+DEFAULT_DONE_STATUSES: Tuple[str, ...] = ("completed", "failed", "success")
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def default_spill_dir(service: str) -> str:
+    """
+    服务的落盘目录：{临时目录}/task_registry/{服务名}/{进程号}
+    每个进程（含 uvicorn 多 worker）各用一个子目录；顺带清理已退出进程遗留的子目录
+    """
+    base = os.path.join(tempfile.gettempdir(), "task_registry", service)
+    if os.path.isdir(base):
+        for name in os.listdir(base):
+            if name.isdigit() and int(name) != os.getpid() and not _pid_alive(int(name)):
+                shutil.rmtree(os.path.join(base, name), ignore_errors=True)
+    return os.path.join(base, str(os.getpid()))
+
+
+def _estimate_size(value: Any) -> int:
+    """条目大小估算：按 pickle 序列化后的字节数（与落盘格式一致）；无法序列化时退回浅层 sys.getsizeof"""
+    try:
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(value)
+
+
+class TaskRegistry(MutableMapping):
+    """
+    带 LRU / TTL 淘汰、大小统计、可选落盘的任务登记表
+
+    Args:
+        max_entries: 内存中最多保留的条目数
+        max_bytes: 内存中已结束任务的估算总字节数上限
+        ttl_s: 已结束任务多久未访问后删除（内存与磁盘都删）
+        spill_dir: 落盘目录；None 表示超限时直接删除
+        done_statuses: 视为已结束的 status 取值
+        status_key: 条目中表示状态的字段名
+        name: 日志中显示的名称
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, max_bytes: int = DEFAULT_MAX_BYTES,
+                 ttl_s: float = DEFAULT_TTL_S, spill_dir: Optional[str] = None,
+                 done_statuses: Tuple[str, ...] = DEFAULT_DONE_STATUSES, status_key: str = "status",
+                 sweep_interval_s: float = DEFAULT_SWEEP_INTERVAL_S, name: str = "tasks"):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self.spill_dir = spill_dir
+        self.done_statuses = tuple(done_statuses)
+        self.status_key = status_key
+        self.sweep_interval_s = sweep_interval_s
+        self.name = name
+
+        self._data: "OrderedDict[str, Any]" = OrderedDict()   # 内存条目，按最近访问排序（末尾最新）
+        self._touched: Dict[str, float] = {}                  # 内存条目最近访问时间
+        self._sizes: Dict[str, int] = {}                      # 已结束条目的估算大小（访问后失效，清扫时重算）
+        self._spilled: Dict[str, Tuple[str, float]] = {}      # 落盘条目：key -> (文件路径, 最近访问时间)
+        self._bytes = 0
+        self._last_sweep = 0.0
+        self._lock = threading.RLock()
+        self.evicted = 0
+        self.spilled_total = 0
+
+        if spill_dir:
+            # 落盘文件只在本进程生命周期内有效，启动时清掉上次遗留
+            shutil.rmtree(spill_dir, ignore_errors=True)
+            os.makedirs(spill_dir, exist_ok=True)
+
+    # ---------- 状态判断 ----------
+    def _is_done(self, value: Any) -> bool:
+        return isinstance(value, dict) and value.get(self.status_key) in self.done_statuses
+
+    # ---------- MutableMapping 接口 ----------
+    def __getitem__(self, key: str) -> Any:
+        with self._lock:
+            if key in self._data:
+                value = self._data[key]
+            elif key in self._spilled:
+                value = self._load_spilled(key)
+            else:
+                raise KeyError(key)
+            self._touch(key)
+            self._maybe_sweep()
+            return value
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._drop_spilled(key)
+            self._data[key] = value
+            self._touch(key)
+            # 平时按 sweep_interval_s 清扫；条目数超限时立即清扫（字节数在清扫时才重算）
+            self._maybe_sweep(force=len(self._data) > self.max_entries)
+
+    def __delitem__(self, key: str) -> None:
+        with self._lock:
+            if key in self._data:
+                self._forget(key)
+            elif key in self._spilled:
+                self._drop_spilled(key)
+            else:
+                raise KeyError(key)
+
+    def __contains__(self, key: object) -> bool:
+        with self._lock:
+            return key in self._data or key in self._spilled
+
+    def __iter__(self) -> Iterator[str]:
+        with self._lock:
+            keys = list(self._data) + list(self._spilled)
+        return iter(keys)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data) + len(self._spilled)
+
+    # ---------- 统计 ----------
+    def active_count(self) -> int:
+        """未结束的任务数（只看内存，落盘的都是已结束任务，不需要读回）"""
+        with self._lock:
+            return sum(1 for v in self._data.values() if not self._is_done(v))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "spilled": len(self._spilled),
+                "bytes": self._bytes,
+                "evicted": self.evicted,
+                "spilled_total": self.spilled_total,
+            }
+
+    # ---------- 内部 ----------
+    def _touch(self, key: str) -> None:
+        self._data.move_to_end(key)
+        self._touched[key] = time.time()
+        # 取出的 dict 可能被调用方原地修改，大小在下次清扫时重算
+        self._bytes -= self._sizes.pop(key, 0)
+
+    def _forget(self, key: str) -> None:
+        self._data.pop(key, None)
+        self._touched.pop(key, None)
+        self._bytes -= self._sizes.pop(key, 0)
+
+    def _spill_path(self, key: str) -> str:
+        return os.path.join(self.spill_dir, hashlib.sha1(str(key).encode("utf-8")).hexdigest() + ".pkl")
+
+    def _load_spilled(self, key: str) -> Any:
+        path, _ = self._spilled[key]
+        with open(path, "rb") as f:
+            value = pickle.load(f)
+        del self._spilled[key]
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        self._data[key] = value
+        return value
+
+    def _drop_spilled(self, key: str) -> None:
+        item = self._spilled.pop(key, None)
+        if item is not None:
+            try:
+                os.remove(item[0])
+            except OSError:
+                pass
+
+    def _evict(self, key: str) -> bool:
+        """
+        LRU 淘汰一个已结束条目：未配置落盘目录时直接删除；
+        配置了则写盘成功后才从内存移除，写盘失败时条目留在内存（下次清扫再试），返回是否已移出内存
+        """
+        if not self.spill_dir:
+            self._forget(key)
+            self.evicted += 1
+            return True
+        touched = self._touched.get(key, time.time())
+        path = self._spill_path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            # 先写临时文件再原子替换，写到一半失败不会留下残缺的落盘文件
+            with open(tmp_path, "wb") as f:
+                pickle.dump(self._data[key], f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except Exception as e:  # 不可序列化的对象可能抛 PicklingError / TypeError / AttributeError 等
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            print(f"[TaskRegistry:{self.name}] 任务 {key} 落盘失败，保留在内存中: {e}")
+            return False
+        self._forget(key)
+        self._spilled[key] = (path, touched)
+        self.spilled_total += 1
+        return True
+
+    def _maybe_sweep(self, force: bool = False) -> None:
+        now = time.time()
+        if not force and now - self._last_sweep < self.sweep_interval_s:
+            return
+        self._last_sweep = now
+        self.sweep(now)
+
+    def sweep(self, now: Optional[float] = None) -> None:
+        """执行一次清扫：TTL 过期删除 + 超限 LRU 淘汰 / 落盘"""
+        with self._lock:
+            now = now or time.time()
+            expire_before = now - self.ttl_s
+
+            # 1) TTL：已结束且长时间未访问的条目删除（内存 / 磁盘）
+            for key in [k for k, v in self._data.items()
+                        if self._touched.get(k, now) < expire_before and self._is_done(v)]:
+                self._forget(key)
+                self.evicted += 1
+            for key in [k for k, (_, t) in self._spilled.items() if t < expire_before]:
+                self._drop_spilled(key)
+                self.evicted += 1
+
+            # 2) 已结束条目补算大小
+            for key, value in self._data.items():
+                if key not in self._sizes and self._is_done(value):
+                    size = _estimate_size(value)
+                    self._sizes[key] = size
+                    self._bytes += size
+
+            # 3) 条目数 / 字节数超限：从最久未访问的已结束条目开始淘汰
+            if len(self._data) <= self.max_entries and self._bytes <= self.max_bytes:
+                return
+            for key in [k for k, v in self._data.items() if self._is_done(v)]:
+                if len(self._data) <= self.max_entries and self._bytes <= self.max_bytes:
+                    break
+                self._evict(key)
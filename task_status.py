@@ -0,0 +1,206 @@
+# filename: task_status.py
+# 流水线任务状态（进度 / 结果）存储，后端可插拔：
+# - memory：进程内字典，只适合单进程部署（SERVER_WORKERS=1 且任务在本进程的线程中执行）
+# - sqlite：SQLite WAL 模式文件，多个 API 进程 / 工作进程共享，任一进程写入的进度其他进程都能立即读到
+# 通过 open_status_store("memory") / open_status_store("sqlite:/path/to/status.sqlite3") 获取
+# 每条记录带递增的 version，进度推送（SSE / 长轮询）据此只在有变化时下发增量
+
+import os
+import time
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, Optional
+
+import json_io
+from task_registry import TaskRegistry
+
+# 状态记录的字段（与原 GLOBAL_TASK_STORE 中的任务结构一致）
+RECORD_FIELDS = ("status", "percent", "current_step", "message", "result", "branches")
+_JSON_FIELDS = ("result", "branches")
+
+
+def _blank_record() -> Dict[str, Any]:
+    return {"status": None, "percent": 0, "current_step": None, "message": None, "result": None, "branches": None}
+
+
+def _next_version(prev: Optional[int]) -> int:
+    # put 覆盖记录时版本号继续递增，而不是从 1 重来，订阅方不会把新任务误当成旧版本
+    return (prev or 0) + 1
+
+
+class StatusStore:
+    """状态存储接口；get 返回的记录含 RECORD_FIELDS 及递增的 version"""
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def get_version(self, key: str) -> Optional[int]:
+        """只取版本号（轮询变化用，比 get 便宜）；记录不存在时返回 None"""
+        rec = self.get(key)
+        return None if rec is None else rec.get("version")
+
+    def put(self, key: str, record: Dict[str, Any]) -> None:
+        """整条写入（覆盖）"""
+        raise NotImplementedError
+
+    def update(self, key: str, **fields) -> None:
+        """只更新给定字段；记录不存在时忽略；值为 None 的字段不覆盖"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryStatusStore(StatusStore):
+    def __init__(self):
+        # 已结束的任务按 LRU / TTL 淘汰，执行中的不淘汰（结果文件本身已在输出目录，不再落盘）
+        self._data = TaskRegistry(name="pipeline_status")
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            rec = self._data.get(key)
+            return dict(rec) if rec is not None else None
+
+    def get_version(self, key: str) -> Optional[int]:
+        with self._lock:
+            rec = self._data.get(key)
+            return None if rec is None else rec["version"]
+
+    def put(self, key: str, record: Dict[str, Any]) -> None:
+        rec = _blank_record()
+        rec.update({k: v for k, v in record.items() if k in RECORD_FIELDS})
+        with self._lock:
+            prev = self._data.get(key)
+            rec["version"] = _next_version(prev["version"] if prev else None)
+            self._data[key] = rec
+
+    def update(self, key: str, **fields) -> None:
+        with self._lock:
+            rec = self._data.get(key)
+            if rec is not None:
+                rec.update({k: v for k, v in fields.items() if k in RECORD_FIELDS and v is not None})
+                rec["version"] += 1
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS task_status (
+    key          TEXT PRIMARY KEY,
+    status       TEXT,
+    percent      INTEGER NOT NULL DEFAULT 0,
+    current_step TEXT,
+    message      TEXT,
+    result       TEXT,
+    branches     TEXT,
+    version      INTEGER NOT NULL DEFAULT 1,
+    updated_at   REAL NOT NULL
+);
+"""
+
+
+class SQLiteStatusStore(StatusStore):
+    """
+    SQLite WAL 后端：读不阻塞写，进度更新是单行 UPDATE（synchronous=NORMAL，不逐条 fsync）
+    每个线程使用各自的连接
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = os.path.abspath(db_path)
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        conn = self._conn()
+        conn.executescript(_SQLITE_SCHEMA)
+        cols = {r["name"] for r in conn.execute("PRAGMA table_info(task_status)")}
+        if "version" not in cols:  # 旧库补列
+            conn.execute("ALTER TABLE task_status ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _encode(field: str, value: Any) -> Any:
+        if field in _JSON_FIELDS and value is not None:
+            return json_io.dumps(value, pretty=False)
+        return value
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(
+            "SELECT status, percent, current_step, message, result, branches, version FROM task_status WHERE key=?",
+            (key,)).fetchone()
+        if row is None:
+            return None
+        rec = {k: row[k] for k in RECORD_FIELDS}
+        for k in _JSON_FIELDS:
+            rec[k] = json_io.loads(rec[k]) if rec[k] else None
+        rec["version"] = row["version"]
+        return rec
+
+    def get_version(self, key: str) -> Optional[int]:
+        row = self._conn().execute("SELECT version FROM task_status WHERE key=?", (key,)).fetchone()
+        return None if row is None else row["version"]
+
+    def put(self, key: str, record: Dict[str, Any]) -> None:
+        rec = _blank_record()
+        rec.update({k: v for k, v in record.items() if k in RECORD_FIELDS})
+        self._conn().execute(
+            "INSERT INTO task_status (key, status, percent, current_step, message, result, branches,"
+            " version, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, 1, ?)"
+            " ON CONFLICT(key) DO UPDATE SET status=excluded.status, percent=excluded.percent,"
+            " current_step=excluded.current_step, message=excluded.message, result=excluded.result,"
+            " branches=excluded.branches, version=task_status.version+1, updated_at=excluded.updated_at",
+            (key, *(self._encode(k, rec[k]) for k in RECORD_FIELDS), time.time()))
+
+    def update(self, key: str, **fields) -> None:
+        fields = {k: v for k, v in fields.items() if k in RECORD_FIELDS and v is not None}
+        if not fields:
+            return
+        sets = ", ".join(f"{k}=?" for k in fields)
+        self._conn().execute(
+            f"UPDATE task_status SET {sets}, version=version+1, updated_at=? WHERE key=?",
+            (*(self._encode(k, v) for k, v in fields.items()), time.time(), key))
+
+    def close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+# ---------- 后端注册 ----------
+# 工厂函数接收 "后端名:" 之后的部分（memory 为空串）
+STATUS_BACKENDS: Dict[str, Callable[[str], StatusStore]] = {}
+_shared_memory_store = MemoryStatusStore()
+
+
+def register_status_backend(name: str, factory: Callable[[str], StatusStore]) -> None:
+    STATUS_BACKENDS[name] = factory
+
+
+register_status_backend("memory", lambda _arg: _shared_memory_store)  # 同一进程内共享一个实例
+register_status_backend("sqlite", SQLiteStatusStore)
+
+
+def backend_name(url: str) -> str:
+    return url.partition(":")[0]
+
+
+def open_status_store(url: str) -> StatusStore:
+    """
+    按 URL 打开状态存储
+
+    Args:
+        url: "memory" 或 "sqlite:/path/to/file.sqlite3"（其余后端见 register_status_backend）
+    """
+    name, _, arg = url.partition(":")
+    factory = STATUS_BACKENDS.get(name)
+    if factory is None:
+        raise ValueError(f"未知的任务状态后端: {name}（可选: {', '.join(STATUS_BACKENDS)}）")
+    return factory(arg)